@@ -0,0 +1,133 @@
+import datetime
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from ingest import BATCH_SIZE, new_ids
+from ledger import DEPARTMENT, UNALLOCATED, post_entry
+from money import format_money
+from query_cache import bump_generation
+
+# Largest gap in cents allowed between an allocation's amount and the sum of its
+# splits; amounts are whole cents, so splits must add up exactly
+SPLIT_TOLERANCE = 0
+
+
+@dataclass
+class BatchAllocationResult:
+    allocated: list = field(default_factory=list)
+    failures: dict = field(default_factory=dict)
+    rows_written: int = 0
+    elapsed: float = 0.0
+
+
+def _load_placeholders(c, allocation_ids):
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS batch_allocation_ids (id TEXT PRIMARY KEY)")
+    c.execute("DELETE FROM batch_allocation_ids")
+    c.executemany("INSERT OR IGNORE INTO batch_allocation_ids (id) VALUES (?)",
+                  [(allocation_id,) for allocation_id in allocation_ids])
+    c.execute("""
+    SELECT a.id, a.treasury_ref, a.amount, a.transaction_type
+    FROM allocations a
+    JOIN batch_allocation_ids b ON b.id = a.id
+    WHERE a.department_id IS NULL
+    """)
+    placeholders = {row[0]: row[1:] for row in c.fetchall()}
+    c.execute("DELETE FROM batch_allocation_ids")
+    return placeholders
+
+
+def apply_allocations(c, splits, created_by, tolerance=SPLIT_TOLERANCE,
+                      source='allocation_batch', source_ref=None):
+    """Allocate pending allocations inside the caller's write transaction.
+
+    ``splits`` maps a pending allocation id to ``{department_id: amount}`` in cents.
+    Placeholders and department balances are read once, then every item is
+    checked in order against the running balances: an item that fails (already
+    allocated, splits not adding up, unknown department, or a debit the
+    department cannot cover) is reported in ``failures`` and leaves no trace,
+    while the rest are inserted, applied and removed from pending set-wise.
+    """
+    result = BatchAllocationResult()
+    if not splits:
+        return result
+
+    placeholders = _load_placeholders(c, splits.keys())
+    c.execute("SELECT id, name, COALESCE(balance, 0) FROM departments")
+    departments = {row[0]: (row[1], int(row[2])) for row in c.fetchall()}
+    balances = {department_id: balance for department_id, (_, balance) in departments.items()}
+
+    now = datetime.datetime.now().isoformat()
+    rows, deltas = [], defaultdict(int)
+    for allocation_id, department_amounts in splits.items():
+        placeholder = placeholders.get(allocation_id)
+        if placeholder is None:
+            result.failures[allocation_id] = "Not a pending allocation"
+            continue
+        treasury_ref, amount, transaction_type = placeholder
+        department_amounts = {department_id: int(value)
+                              for department_id, value in department_amounts.items() if value}
+
+        unknown = [department_id for department_id in department_amounts if department_id not in departments]
+        if unknown:
+            result.failures[allocation_id] = f"Unknown department: {', '.join(map(str, unknown))}"
+            continue
+        if any(value < 0 for value in department_amounts.values()):
+            result.failures[allocation_id] = "Split amounts must be positive"
+            continue
+        total = sum(department_amounts.values())
+        if abs(total - amount) > tolerance:
+            result.failures[allocation_id] = (f"Total amount allocated ({format_money(total)}) must equal "
+                                              f"the transaction amount ({format_money(amount)})")
+            continue
+
+        sign = -1 if transaction_type == "Debit" else 1
+        if sign < 0:
+            short = [departments[department_id][0] for department_id, value in department_amounts.items()
+                     if balances[department_id] < value]
+            if short:
+                result.failures[allocation_id] = f"Insufficient balance in {', '.join(short)}"
+                continue
+
+        for department_id, value in department_amounts.items():
+            balances[department_id] += sign * value
+            deltas[department_id] += sign * value
+            rows.append((treasury_ref, department_id, value, transaction_type))
+        result.allocated.append(allocation_id)
+
+    if result.allocated:
+        ids = new_ids(len(rows))
+        for start in range(0, len(rows), BATCH_SIZE):
+            c.executemany("""
+            INSERT INTO allocations (
+                id, treasury_ref, department_id, amount, created_by, created_at, transaction_type
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, [(ids[i], *rows[i][:3], created_by, now, rows[i][3])
+                  for i in range(start, min(start + BATCH_SIZE, len(rows)))])
+        c.executemany("DELETE FROM allocations WHERE id = ?",
+                      [(allocation_id,) for allocation_id in result.allocated])
+        # One balance update and one ledger leg per department for the whole batch
+        c.executemany("UPDATE departments SET balance = COALESCE(balance, 0) + ? WHERE id = ?",
+                      [(delta, department_id) for department_id, delta in deltas.items()])
+        post_entry(c, datetime.date.today(), source, source_ref or f"{len(result.allocated)} allocations",
+                   [((DEPARTMENT, str(department_id)), delta) for department_id, delta in deltas.items()]
+                   + [(UNALLOCATED, -sum(deltas.values()))])
+        bump_generation(c, 'allocations', 'departments')
+        result.rows_written = len(rows)
+    return result
+
+
+def allocate_batch(conn, splits, created_by, tolerance=SPLIT_TOLERANCE):
+    """Allocate many pending allocations to departments in one transaction; see ``apply_allocations``."""
+    started = time.perf_counter()
+    if not splits:
+        return BatchAllocationResult()
+
+    c = conn.cursor()
+    with conn:
+        # Take the write lock up front so balances cannot move between check and apply
+        c.execute("BEGIN IMMEDIATE")
+        result = apply_allocations(c, splits, created_by, tolerance)
+
+    result.elapsed = time.perf_counter() - started
+    return result
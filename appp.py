@@ -1,9 +1,6 @@
 import streamlit as st
 import pandas as pd
-import sqlite3
 import datetime
-import hashlib
-import uuid
 import matplotlib.pyplot as plt
 import io
 import base64
@@ -11,148 +8,50 @@ from datetime import timedelta
 import plotly.graph_objects as go
 from streamlit_option_menu import option_menu
 
-# Database Setup
-def init_db():
-    conn = sqlite3.connect('treasury.db')
-    c = conn.cursor()
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS main_account (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT DEFAULT 'Main Account',
-        balance REAL NOT NULL DEFAULT 0.0,
-        created_at TEXT NOT NULL
-    )''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        role TEXT NOT NULL,
-        department_id TEXT,
-        created_by TEXT NOT NULL,
-        created_at TEXT NOT NULL
-    )''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS departments (
-        id TEXT PRIMARY KEY NOT NULL UNIQUE,
-        name TEXT NOT NULL UNIQUE,
-        balance REAL DEFAULT 0,
-        created_by TEXT NOT NULL,
-        created_at TEXT NOT NULL
-    )''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS transactions (
-        id TEXT PRIMARY KEY NOT NULL,
-        ref_number TEXT UNIQUE NOT NULL,
-        transaction_date TEXT NOT NULL,
-        value_date TEXT,
-        narration TEXT,
-        debit_amount REAL,
-        credit_amount REAL,
-        tax_percentage REAL,
-        tax_amount REAL,
-        statement_id TEXT,
-        created_by TEXT NOT NULL,
-        created_at TEXT NOT NULL,
-        type TEXT,
-        credit_type TEXT,
-        debit_type TEXT,
-        account_name TEXT
-    )''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS statements (
-        id TEXT PRIMARY KEY,
-        filename TEXT NOT NULL,
-        upload_date TEXT NOT NULL,
-        created_by TEXT NOT NULL,
-        created_at TEXT NOT NULL
-    )''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS investments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        ref_number TEXT UNIQUE NOT NULL,
-        amount REAL,
-        created_by TEXT NOT NULL,
-        created_at TEXT NOT NULL,
-        status TEXT NOT NULL DEFAULT 'pending',
-        transaction_ref TEXT,
-        department_id TEXT,
-        account_name TEXT,
-        period INTEGER,
-        value_date TEXT,
-        interest_rate REAL,
-        maturity_date TEXT,
-        interest REAL,
-        withholding_tax REAL,
-        maturity_amount REAL,
-        allocation_id TEXT
-    )''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS allocations (
-        id TEXT PRIMARY KEY,
-        treasury_ref TEXT NOT NULL,
-        department_id TEXT,
-        amount REAL NOT NULL,
-        statement_id TEXT,
-        created_by TEXT NOT NULL,
-        created_at TEXT NOT NULL,
-        transaction_type TEXT
-    )''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS taxes_tariffs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        description TEXT NOT NULL,
-        rate REAL NOT NULL,
-        created_by TEXT NOT NULL,
-        created_at TEXT NOT NULL
-    )''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS audit_logs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        action TEXT NOT NULL,
-        user_id INTEGER NOT NULL,
-        created_at TEXT NOT NULL
-    )''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS bank_tariff_guides (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        bank_name TEXT NOT NULL,
-        document_name TEXT NOT NULL,
-        document_data BLOB NOT NULL,
-        upload_date TEXT NOT NULL,
-        created_by TEXT NOT NULL,
-        created_at TEXT NOT NULL
-    )''')
-
-    # Initialize main account if not exists
-    c.execute("SELECT COUNT(*) FROM main_account")
-    if c.fetchone()[0] == 0:
-        c.execute("INSERT INTO main_account (name, balance, created_at) VALUES (?, ?, ?)",
-                  ('Main Account', 0, datetime.datetime.now().isoformat()))
+from allocation import allocate_batch
+from audit import (AUDIT_PAGE_SIZE, audit_filter_options, count_audit_events, get_audit_writer,
+                   query_audit_events, record_audit)
+from auto_allocate import auto_allocate, delete_rule, load_rule_set, save_rule
+from explorer import PAGE_SIZE as EXPLORER_PAGE_SIZE, TransactionFilter, fetch_page, filtered_totals
+from export import EXPORT_FORMATS, available_formats, export_statement
+from ingest import (TEXT_DTYPES, DuplicateRefsError, IngestError, find_duplicates, ingest_statement,
+                    ingest_upload_stream)
+from database import ensure_schema, get_connection, shared_database_path
+from ledger import balances_at
+from maturity import process_maturities, start_scheduler
+from money import dollar_columns, format_money, percent_of, to_cents, to_dollars
+from portfolio import LADDER_FREQUENCIES, load_portfolio, maturity_ladder, portfolio_summary, value_portfolio
+from profiler import PAGE_TOTAL, get_profiler
+from query_cache import cached_read_sql, query_cache
+from reconcile import MONEY_REPORT_COLUMNS, MONEY_SUMMARY_COLUMNS, reconcile_batch
+from services import (TreasuryError, add_department, add_tax, add_transaction, add_user, allocate_investment,
+                      allocate_pending, confirm_investment, deal_terms, hash_password, main_balance,
+                      reconcile_statement, submit_investment, transaction_amounts, upload_tariff,
+                      verify_statement_taxes)
+from slow_query import advisor_report, get_slow_query_log, read_log
+from tariff_store import get_store
+from summary import load_dashboard_summary, rebuild_summary
 
-    # Create default admin user if not exists
-    c.execute("SELECT COUNT(*) FROM users WHERE username = 'admin'")
-    if c.fetchone()[0] == 0:
-        c.execute("INSERT INTO users (username, password, role, department_id, created_by, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                  ('admin', hashlib.sha256('admin123'.encode('utf-8')).hexdigest(), 'admin', None, 'system', datetime.datetime.now().isoformat()))
+# Upload choices for ref numbers and statement lines that are already posted
+DUPLICATE_CHOICES = {
+    "Reject the upload": 'reject',
+    "Skip them": 'skip',
+    "Skip them, updating narration and value date": 'upsert',
+}
 
-    # Create Treasury Department if not exists
-    c.execute("SELECT COUNT(*) FROM departments WHERE name = 'Treasury'")
-    if c.fetchone()[0] == 0:
-        c.execute("INSERT INTO departments (id, name, balance, created_by, created_at) VALUES (?, ?, ?, ?, ?)",
-                  (str(uuid.uuid4())[:8], 'Treasury', 0, 'system', datetime.datetime.now().isoformat()))
-
-    conn.commit()
-    conn.close()
+# Database Setup
+def init_db():
+    # Migrations run once per process; later reruns return immediately
+    ensure_schema()
+    start_scheduler()
 
 # Authentication
 def check_credentials(username, password):
-    conn = sqlite3.connect('treasury.db')
-    c = conn.cursor()
-    c.execute("SELECT role, department_id FROM users WHERE username = ? AND password = ?",
-              (username, hashlib.sha256(password.encode('utf-8')).hexdigest()))
-    result = c.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT role, department_id, id, username FROM users WHERE username = ? AND password = ?",
+                  (username, hash_password(password)))
+        result = c.fetchone()
     return result if result else None
 
 # CSS Styling
@@ -319,14 +218,18 @@ def show_login_page():
                         st.session_state.logged_in = True
                         st.session_state.role = result[0]
                         st.session_state.department_id = result[1]
+                        st.session_state.user_id = result[2]
+                        st.session_state.username = result[3]
+                        audit_event("login")
                         st.rerun()
                     else:
+                        record_audit("login.failed", username=username)
                         st.error("Invalid username or password")
             
             st.markdown('</div>', unsafe_allow_html=True)
 
 def show_dashboard(conn):
-    st.markdown('<div class="section-header">Dashboard Overview</div>', unsafe_allow_html=True)
+    section_header("Dashboard Overview")
     
     try:
         c = conn.cursor()
@@ -334,37 +237,22 @@ def show_dashboard(conn):
         # Main metrics
         c.execute("SELECT balance FROM main_account LIMIT 1")
         main_balance_result = c.fetchone()
-        main_balance = main_balance_result[0] if main_balance_result else 0.0
+        main_balance = main_balance_result[0] if main_balance_result else 0
         
         c.execute("SELECT balance FROM departments WHERE name = 'Treasury' LIMIT 1")
         treasury_result = c.fetchone()
-        treasury_balance = treasury_result[0] if treasury_result else 0.0
-        
-        c.execute("SELECT COUNT(*) FROM departments")
-        department_count = c.fetchone()[0]
+        treasury_balance = treasury_result[0] if treasury_result else 0
         
-        c.execute("SELECT COUNT(*) FROM transactions")
-        transaction_count = c.fetchone()[0]
+        # Counts and distributions come from the maintained summary, not the base tables
+        summary = load_dashboard_summary(conn)
+        department_count = summary['department_count']
+        transaction_count = summary['transaction_count']
+        active_investments = summary['active_investments']
+        account_dist = summary['account_dist']
         
         # Department data
-        department_df = pd.read_sql("SELECT name, balance FROM departments WHERE balance IS NOT NULL", conn)
-        
-        # Investment data
-        active_investments = pd.read_sql("""
-        SELECT d.name AS department, COUNT(i.id) AS count
-        FROM investments i
-        JOIN departments d ON i.department_id = d.id
-        WHERE i.status = 'confirmed' AND i.maturity_date >= date('now')
-        GROUP BY d.name
-        """, conn)
-        
-        # Account distribution
-        account_dist = pd.read_sql("""
-        SELECT account_name, COUNT(*) as count
-        FROM transactions
-        WHERE account_name IN ('CBZ Account One', 'CBZ Account Two', 'ZB Account One', 'ZB Account Two')
-        GROUP BY account_name
-        """, conn)
+        department_df = dollar_columns(cached_read_sql(
+            "SELECT name, balance FROM departments WHERE balance IS NOT NULL", conn, ('departments',)), 'balance')
         
         # ===== TOP ROW - 4 METRICS =====
         col1, col2, col3, col4 = st.columns(4)
@@ -373,7 +261,7 @@ def show_dashboard(conn):
             st.markdown(f"""
             <div class="metric-card">
                 <div class="metric-title">Main Account</div>
-                <div class="metric-value">${main_balance:,.2f}</div>
+                <div class="metric-value">{format_money(main_balance)}</div>
             </div>
             """, unsafe_allow_html=True)
         
@@ -381,7 +269,7 @@ def show_dashboard(conn):
             st.markdown(f"""
             <div class="metric-card">
                 <div class="metric-title">Treasury Account</div>
-                <div class="metric-value">${treasury_balance:,.2f}</div>
+                <div class="metric-value">{format_money(treasury_balance)}</div>
             </div>
             """, unsafe_allow_html=True)
         
@@ -401,45 +289,65 @@ def show_dashboard(conn):
             </div>
             """, unsafe_allow_html=True)
         
+        # ===== PORTFOLIO ROW - 4 METRICS =====
+        portfolio = portfolio_summary(value_portfolio(load_portfolio(
+            conn, None if st.session_state.role == "admin" else st.session_state.department_id)))
+        portfolio_metrics = [
+            ("Invested Principal", format_money(portfolio['principal'])),
+            ("Accrued Net Interest", format_money(portfolio['accrued_net_interest'])),
+            ("Weighted After-Tax Yield", f"{portfolio['weighted_yield']:.2f}%"),
+            ("Maturing in 7 Days", format_money(portfolio['maturing_soon'])),
+        ]
+        for column, (title, value) in zip(st.columns(4), portfolio_metrics):
+            with column:
+                st.markdown(f"""
+                <div class="metric-card">
+                    <div class="metric-title">{title}</div>
+                    <div class="metric-value">{value}</div>
+                </div>
+                """, unsafe_allow_html=True)
+        
         # ===== SECOND ROW - GRAPH + PIE CHART =====
         col5, col6 = st.columns([2, 1])
         
         with col5:
-            st.markdown('<div class="section-header">Department Balances</div>', unsafe_allow_html=True)
+            section_header("Department Balances")
             if not department_df.empty:
-                fig = go.Figure()
-                fig.add_trace(go.Bar(
-                    x=department_df['name'],
-                    y=department_df['balance'],
-                    marker_color='#003366'
-                ))
-                fig.update_layout(
-                    height=300,
-                    margin=dict(l=20, r=20, t=40, b=20),
-                    xaxis_title="Department",
-                    yaxis_title="Amount ($)",
-                    plot_bgcolor='rgba(0,0,0,0)'
-                )
-                st.plotly_chart(fig, use_container_width=True)
+                with get_profiler().section("Chart: Department Balances"):
+                    fig = go.Figure()
+                    fig.add_trace(go.Bar(
+                        x=department_df['name'],
+                        y=department_df['balance'],
+                        marker_color='#003366'
+                    ))
+                    fig.update_layout(
+                        height=300,
+                        margin=dict(l=20, r=20, t=40, b=20),
+                        xaxis_title="Department",
+                        yaxis_title="Amount ($)",
+                        plot_bgcolor='rgba(0,0,0,0)'
+                    )
+                    st.plotly_chart(fig, use_container_width=True)
             else:
                 st.info("No department data available")
         
         with col6:
-            st.markdown('<div class="section-header">Department Allocation</div>', unsafe_allow_html=True)
+            section_header("Department Allocation")
             if not department_df.empty:
-                fig = go.Figure()
-                fig.add_trace(go.Pie(
-                    labels=department_df['name'],
-                    values=department_df['balance'],
-                    marker_colors=['#003366', '#D4AF37', '#0077B6', '#2A9D8F'],
-                    hole=0.4
-                ))
-                fig.update_layout(
-                    height=300,
-                    margin=dict(l=20, r=20, t=40, b=20),
-                    showlegend=False
-                )
-                st.plotly_chart(fig, use_container_width=True)
+                with get_profiler().section("Chart: Department Allocation"):
+                    fig = go.Figure()
+                    fig.add_trace(go.Pie(
+                        labels=department_df['name'],
+                        values=department_df['balance'],
+                        marker_colors=['#003366', '#D4AF37', '#0077B6', '#2A9D8F'],
+                        hole=0.4
+                    ))
+                    fig.update_layout(
+                        height=300,
+                        margin=dict(l=20, r=20, t=40, b=20),
+                        showlegend=False
+                    )
+                    st.plotly_chart(fig, use_container_width=True)
             else:
                 st.info("No department data available")
         
@@ -447,43 +355,64 @@ def show_dashboard(conn):
         col7, col8 = st.columns([2, 1])
         
         with col7:
-            st.markdown('<div class="section-header">Active Investments by Department</div>', unsafe_allow_html=True)
+            section_header("Active Investments by Department")
             if not active_investments.empty:
-                fig = go.Figure()
-                fig.add_trace(go.Bar(
-                    x=active_investments['department'],
-                    y=active_investments['count'],
-                    marker_color='#D4AF37'
-                ))
-                fig.update_layout(
-                    height=300,
-                    margin=dict(l=20, r=20, t=40, b=20),
-                    xaxis_title="Department",
-                    yaxis_title="Number of Investments",
-                    plot_bgcolor='rgba(0,0,0,0)'
-                )
-                st.plotly_chart(fig, use_container_width=True)
+                with get_profiler().section("Chart: Active Investments by Department"):
+                    fig = go.Figure()
+                    fig.add_trace(go.Bar(
+                        x=active_investments['department'],
+                        y=active_investments['count'],
+                        marker_color='#D4AF37'
+                    ))
+                    fig.update_layout(
+                        height=300,
+                        margin=dict(l=20, r=20, t=40, b=20),
+                        xaxis_title="Department",
+                        yaxis_title="Number of Investments",
+                        plot_bgcolor='rgba(0,0,0,0)'
+                    )
+                    st.plotly_chart(fig, use_container_width=True)
             else:
                 st.info("No active investments found")
         
         with col8:
-            st.markdown('<div class="section-header">Account Distribution</div>', unsafe_allow_html=True)
+            section_header("Account Distribution")
             if not account_dist.empty:
-                fig = go.Figure()
-                fig.add_trace(go.Pie(
-                    labels=account_dist['account_name'],
-                    values=account_dist['count'],
-                    marker_colors=['#003366', '#D4AF37', '#0077B6', '#2A9D8F'],
-                    hole=0.4
-                ))
-                fig.update_layout(
-                    height=300,
-                    margin=dict(l=20, r=20, t=40, b=20),
-                    showlegend=False
-                )
-                st.plotly_chart(fig, use_container_width=True)
+                with get_profiler().section("Chart: Account Distribution"):
+                    fig = go.Figure()
+                    fig.add_trace(go.Pie(
+                        labels=account_dist['account_name'],
+                        values=account_dist['count'],
+                        marker_colors=['#003366', '#D4AF37', '#0077B6', '#2A9D8F'],
+                        hole=0.4
+                    ))
+                    fig.update_layout(
+                        height=300,
+                        margin=dict(l=20, r=20, t=40, b=20),
+                        showlegend=False
+                    )
+                    st.plotly_chart(fig, use_container_width=True)
             else:
                 st.info("No transaction data available")
+        
+        if st.session_state.role == "admin":
+            with st.expander("Balance History"):
+                as_of = st.date_input("Balances as of", value=datetime.date.today(), key="balances_as_of")
+                history = dollar_columns(balances_at(conn, as_of), 'balance')
+                if not history.empty:
+                    st.dataframe(history, hide_index=True)
+                else:
+                    st.info("No ledger postings on or before this date.")
+            
+            with st.expander("Maintenance"):
+                if st.button("Rebuild Dashboard Summary"):
+                    rebuild_summary(conn)
+                    audit_event("summary.rebuild")
+                    st.success("Dashboard summary rebuilt from the transaction tables.")
+                stats = query_cache.stats()
+                st.caption(f"Query cache: {stats['entries']}/{stats['max_entries']} entries, "
+                           f"{stats['hits']:,} hits, {stats['misses']:,} misses, {stats['evictions']:,} evictions "
+                           f"({stats['hit_rate']:.0%} hit rate)")
     
     except Exception as e:
         st.error(f"Error loading dashboard data: {str(e)}")
@@ -511,36 +440,99 @@ def generate_transaction_template():
     df.to_csv(output, index=False)
     return output.getvalue()
 
-def generate_statement_csv(start_date, end_date):
-    conn = sqlite3.connect('treasury.db')
-    query = """
-    SELECT transaction_date, value_date, narration, ref_number,
-           debit_amount, credit_amount, tax_percentage, tax_amount, account_name
-    FROM transactions
-    WHERE transaction_date BETWEEN ? AND ?
-    ORDER BY transaction_date ASC
-    """
-    df = pd.read_sql(query, conn, params=(start_date.isoformat(), end_date.isoformat()))
-    conn.close()
-    
-    output = io.StringIO()
-    df.to_csv(output, index=False)
-    return output.getvalue()
+def generate_statement_export(start_date, end_date, accounts=None, fmt='csv'):
+    with get_connection() as conn:
+        with export_statement(conn, start_date.isoformat(), end_date.isoformat(), accounts, fmt) as export:
+            return export.read()
 
-def main():
-    init_db()
-    load_css()
-    
-    if 'logged_in' not in st.session_state:
-        st.session_state.logged_in = False
-        st.session_state.role = None
-        st.session_state.department_id = None
-    
-    if not st.session_state.logged_in:
-        show_login_page()
+def run_auto_allocation(conn, statement_id):
+    if not load_rule_set(conn).rules:
         return
-    
-    conn = sqlite3.connect('treasury.db')
+    try:
+        result = auto_allocate(conn, statement_id=statement_id, created_by=st.session_state.role)
+    except Exception as e:
+        st.error(f"Error applying auto-allocation rules: {str(e)}")
+        return
+    audit_event("allocation_rule.apply", "statement", statement_id,
+                pending=result.pending, allocated=result.allocated)
+    st.info(f"Auto-allocated {result.allocated:,} of {result.pending:,} rows "
+            f"({result.match_rate:.0%} matched a rule); the rest remain pending.")
+    if result.failures:
+        st.warning(f"{len(result.failures):,} matched row(s) could not be allocated "
+                   f"(e.g. {next(iter(result.failures.values()))}) and remain pending.")
+
+def show_duplicate_report(report):
+    """Summarize an upload's known, overlapping and repeated rows before anything is written."""
+    if not len(report):
+        st.success(f"None of the {report.rows:,} rows are already posted or repeated.")
+        return
+    st.warning(report.describe())
+    counts = report.duplicates['status'].value_counts()
+    cols = st.columns(5)
+    for col, (status, label) in zip(cols, [('unchanged', "Unchanged"), ('changed', "New Narration/Value Date"),
+                                           ('conflict', "Different Amounts"), ('overlap', "Overlapping Lines"),
+                                           ('repeated', "Repeated in File")]):
+        col.metric(label, f"{int(counts.get(status, 0)):,}")
+    st.dataframe(report.duplicates.head(1000), hide_index=True)
+    if len(report) > 1000:
+        st.caption(f"Showing the first 1,000 of {len(report):,} duplicate rows.")
+
+def show_ingest_result(conn, result, account_name, filename, chunked, apply_rules):
+    """Report a finished upload; returns False when every row was already posted."""
+    if result.skipped or result.updated:
+        st.info(f"Skipped {result.skipped:,} row(s) already posted or repeated in the file"
+                + (f" and refreshed the narration/value date of {result.updated:,}" if result.updated else "") + ".")
+    if result.statement_id is None:
+        if result.updated:
+            audit_event("transaction.refresh", "transaction", None, account_name=account_name,
+                        filename=filename, updated=result.updated)
+        st.info("Every line in the file is already posted; no statement was created.")
+        return False
+    audit_event("statement.upload", "statement", result.statement_id, account_name=account_name,
+                filename=filename, rows=result.rows, chunked=chunked,
+                skipped=result.skipped, updated=result.updated)
+    st.success(f"Transactions uploaded successfully! Statement ID: {result.statement_id}")
+    st.info(f"Transactions are pending allocation in the Allocations section. Updated Main Account Balance: {format_money(result.new_balance)}")
+    st.caption(f"Ingested {result.rows:,} rows in {result.elapsed:.2f}s ({result.rows_per_sec:,.0f} rows/sec)")
+    if apply_rules:
+        run_auto_allocation(conn, result.statement_id)
+    return True
+
+def section_header(title):
+    """Render a section header; the page profile times each section up to the next header."""
+    get_profiler().mark(title)
+    st.markdown(f'<div class="section-header">{title}</div>', unsafe_allow_html=True)
+
+def audit_event(action, entity_type=None, entity_id=None, **details):
+    """Queue an audit event for the signed-in user; written in the background."""
+    record_audit(action, user_id=st.session_state.get('user_id'), username=st.session_state.get('username'),
+                 role=st.session_state.get('role'), entity_type=entity_type, entity_id=entity_id, **details)
+
+def main():
+    profiler = get_profiler()
+    # Statements and sections of this run are filed under the page it renders
+    with profiler.page("Startup"):
+        with profiler.section("init_db and CSS"):
+            init_db()
+            load_css()
+        
+        if 'logged_in' not in st.session_state:
+            st.session_state.logged_in = False
+            st.session_state.role = None
+            st.session_state.department_id = None
+            st.session_state.user_id = None
+            st.session_state.username = None
+        
+        if not st.session_state.logged_in:
+            profiler.set_page("Login")
+            show_login_page()
+            return
+        
+        # The pooled connection is released however the page exits (return, st.stop, st.rerun)
+        with get_connection() as conn:
+            show_app(conn)
+
+def show_app(conn):
     c = conn.cursor()
     
     # Define account options at the start of main function
@@ -551,6 +543,7 @@ def main():
         "ZB Account Two"
     ]
     
+    get_profiler().mark("Sidebar")
     with st.sidebar:
         st.markdown("""
         <style>
@@ -596,9 +589,11 @@ def main():
             selected = option_menu(
                 menu_title=None,
                 options=["Dashboard", "Transactions", "Allocations", "Statements",
-                         "Investments", "Reconciliation", "Tariff & Tax", "User Management"],
+                         "Investments", "Reconciliation", "Tariff & Tax", "User Management", "Audit Log",
+                         "Performance"],
                 icons=["speedometer", "cash-stack", "arrow-left-right", "file-earmark-text",
-                       "graph-up-arrow", "check-circle", "percent", "people"],
+                       "graph-up-arrow", "check-circle", "percent", "people", "journal-text",
+                       "stopwatch"],
                 menu_icon="cast",
                 default_index=0,
                 styles={
@@ -638,16 +633,18 @@ def main():
             )
         
         if st.button("Logout", key="logout_btn", use_container_width=True, type="primary"):
+            audit_event("logout")
             st.session_state.logged_in = False
             st.session_state.role = None
             st.session_state.department_id = None
             st.rerun()
     
+    get_profiler().set_page(selected)
     if selected == "Dashboard":
         show_dashboard(conn)
     
     elif selected == "Transactions" and st.session_state.role == "admin":
-        st.markdown('<div class="section-header">Add New Transaction</div>', unsafe_allow_html=True)
+        section_header("Add New Transaction")
         
         with st.form("transaction_form"):
             col1, col2 = st.columns(2)
@@ -676,123 +673,85 @@ def main():
             tax_percentage = st.number_input("Tax Percentage (%)", min_value=0.0, max_value=100.0, value=0.0)
             investment_transaction = st.checkbox("Investment Transaction")
             
-            tax_amount = 0.0
-            net_amount = 0.0
-            
-            if debit_amount > 0:
-                tax_amount = debit_amount * (tax_percentage / 100)
-                net_amount = debit_amount
-            elif credit_amount > 0:
-                tax_amount = credit_amount * (tax_percentage / 100)
-                net_amount = credit_amount - tax_amount
+            tax_amount, net_amount = transaction_amounts(to_cents(debit_amount), to_cents(credit_amount), tax_percentage)
             
             if tax_percentage > 0:
-                st.markdown(f"**Tax Amount ($):** {tax_amount:,.2f}")
-                st.markdown(f"**Net Amount ($):** {net_amount:,.2f}")
+                st.markdown(f"**Tax Amount:** {format_money(tax_amount)}")
+                st.markdown(f"**Net Amount:** {format_money(net_amount)}")
             
             if st.form_submit_button("Add Transaction"):
-                if debit_amount > 0 and credit_amount > 0:
-                    st.error("Cannot have both debit and credit amounts")
-                elif debit_amount == 0 and credit_amount == 0:
-                    st.error("Must enter either debit or credit amount")
+                try:
+                    posted = add_transaction(
+                        conn, transaction_date, narration, account_name,
+                        debit_amount=to_cents(debit_amount), credit_amount=to_cents(credit_amount),
+                        tax_percentage=tax_percentage, investment=investment_transaction,
+                        created_by=st.session_state.role)
+                except TreasuryError as e:
+                    st.error(str(e))
+                except Exception as e:
+                    st.error(f"Error processing transaction: {str(e)}")
                 else:
-                    transaction_type = "Debit" if debit_amount > 0 else "Credit"
-                    amount = debit_amount if debit_amount > 0 else credit_amount
-                    
-                    debit_type = "Investment" if investment_transaction and transaction_type == "Debit" else "Other" if transaction_type == "Debit" else None
-                    credit_type = "Credit Investments" if investment_transaction and transaction_type == "Credit" else "Other" if transaction_type == "Credit" else None
-                    
-                    ref_number = str(uuid.uuid4())[:8]
-                    value_date = transaction_date
-                    transaction_id = str(uuid.uuid4())[:8]
-                    
-                    c.execute("SELECT balance FROM main_account LIMIT 1")
-                    main_balance = c.fetchone()[0] or 0.0
-                    
-                    total_debit = debit_amount + tax_amount if transaction_type == "Debit" else 0.0
-                    
-                    if transaction_type == "Debit" and main_balance < total_debit:
-                        st.error(f"Insufficient Main Account balance for debit transaction (${total_debit:,.2f} required).")
-                    else:
-                        try:
-                            with conn:
-                                # Insert transaction with all 16 columns
-                                c.execute("""
-                                INSERT INTO transactions (
-                                    id, ref_number, transaction_date, value_date, narration,
-                                    debit_amount, credit_amount, tax_percentage, tax_amount,
-                                    type, debit_type, credit_type, created_by, created_at, account_name
-                                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                                """, (
-                                    transaction_id,  # id
-                                    ref_number,  # ref_number
-                                    transaction_date.isoformat(),  # transaction_date
-                                    value_date.isoformat(),  # value_date
-                                    narration,  # narration
-                                    debit_amount,  # debit_amount
-                                    credit_amount,  # credit_amount
-                                    tax_percentage,  # tax_percentage
-                                    tax_amount,  # tax_amount
-                                    transaction_type,  # type
-                                    debit_type,  # debit_type
-                                    credit_type,  # credit_type
-                                    st.session_state.role,  # created_by
-                                    datetime.datetime.now().isoformat(),  # created_at
-                                    account_name  # account_name
-                                ))
-                                
-                                if transaction_type == "Debit":
-                                    c.execute("UPDATE main_account SET balance = balance - ?", (total_debit,))
-                                else:
-                                    c.execute("UPDATE main_account SET balance = balance + ?", (net_amount,))
-                                
-                                allocation_id = str(uuid.uuid4())[:8]
-                                allocation_amount = net_amount if transaction_type == "Credit" else debit_amount
-                                
-                                c.execute("""
-                                INSERT INTO allocations (
-                                    id, treasury_ref, amount, created_by, created_at, transaction_type
-                                ) VALUES (?, ?, ?, ?, ?, ?)
-                                """, (
-                                    allocation_id, ref_number, allocation_amount, st.session_state.role,
-                                    datetime.datetime.now().isoformat(), transaction_type
-                                ))
-                                
-                                if investment_transaction:
-                                    c.execute("""
-                                    INSERT INTO investments (
-                                        ref_number, amount, created_by, created_at, status, transaction_ref, allocation_id
-                                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
-                                    """, (
-                                        ref_number, allocation_amount, st.session_state.role,
-                                        datetime.datetime.now().isoformat(), 'pending', ref_number, allocation_id
-                                    ))
-                                
-                                st.success("Transaction added successfully! Investment transactions must be allocated in the Investments section.")
-                                
-                                c.execute("SELECT balance FROM main_account LIMIT 1")
-                                new_main_balance = c.fetchone()[0]
-                                st.info(f"Updated Main Account Balance: ${new_main_balance:,.2f}")
-                        
-                        except Exception as e:
-                            st.error(f"Error processing transaction: {str(e)}")
-                            conn.rollback()
-        
-        st.markdown('<div class="section-header">Recent Transactions</div>', unsafe_allow_html=True)
-        recent_transactions = pd.read_sql("""
-        SELECT t.ref_number, t.transaction_date, t.account_name,
-               t.narration, t.debit_amount, t.credit_amount, t.tax_percentage, t.tax_amount
-        FROM transactions t
-        ORDER BY t.transaction_date DESC
-        LIMIT 20
-        """, conn)
+                    audit_event("transaction.add", "transaction", posted.ref_number, account_name=account_name,
+                                type=posted.transaction_type, amount=to_dollars(posted.amount), investment=investment_transaction)
+                    st.success("Transaction added successfully! Investment transactions must be allocated in the Investments section.")
+                    st.info(f"Updated Main Account Balance: {format_money(posted.new_balance)}")
         
-        if not recent_transactions.empty:
-            st.dataframe(recent_transactions)
+        section_header("Transaction Explorer")
+        with st.expander("Filters"):
+            col1, col2 = st.columns(2)
+            with col1:
+                explorer_accounts = st.multiselect("Accounts", options=account_options, key="explorer_accounts")
+                explorer_start = st.date_input("From", value=None, key="explorer_start")
+                explorer_min = st.number_input("Min Amount", min_value=0.0, value=0.0, key="explorer_min")
+                explorer_type = st.selectbox("Type", ["Any", "Debit", "Credit"], key="explorer_type")
+            with col2:
+                explorer_narration = st.text_input("Narration contains", key="explorer_narration")
+                explorer_end = st.date_input("To", value=None, key="explorer_end")
+                explorer_max = st.number_input("Max Amount (0 for none)", min_value=0.0, value=0.0, key="explorer_max")
+                explorer_statement = st.text_input("Statement ID", key="explorer_statement")
+        
+        explorer_filter = TransactionFilter(
+            accounts=tuple(explorer_accounts),
+            start_date=explorer_start.isoformat() if explorer_start else None,
+            end_date=explorer_end.isoformat() if explorer_end else None,
+            min_amount=to_cents(explorer_min) or None,
+            max_amount=to_cents(explorer_max) or None,
+            transaction_type=None if explorer_type == "Any" else explorer_type,
+            statement_id=explorer_statement.strip() or None,
+            narration=explorer_narration.strip() or None,
+        )
+        # Cursors of the pages already visited; reset whenever the filters change
+        if st.session_state.get('explorer_filter') != explorer_filter:
+            st.session_state.explorer_filter = explorer_filter
+            st.session_state.explorer_cursors = [None]
+        cursors = st.session_state.explorer_cursors
+        
+        totals = filtered_totals(conn, explorer_filter)
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Transactions", f"{totals['rows']:,}")
+        col2.metric("Total Debit", format_money(totals['total_debit']))
+        col3.metric("Total Credit", format_money(totals['total_credit']))
+        col4.metric("Total Tax", format_money(totals['total_tax']))
+        
+        page, next_cursor = fetch_page(conn, explorer_filter, after=cursors[-1])
+        if not page.empty:
+            st.dataframe(dollar_columns(page, 'debit_amount', 'credit_amount', 'tax_amount'), hide_index=True)
         else:
-            st.info("No recent transactions found")
+            st.info("No transactions match the filters")
+        
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            if st.button("Previous", disabled=len(cursors) == 1):
+                cursors.pop()
+                st.rerun()
+        with col2:
+            st.caption(f"Page {len(cursors):,} of {max(1, -(-totals['rows'] // EXPLORER_PAGE_SIZE)):,}")
+        with col3:
+            if st.button("Next", disabled=next_cursor is None):
+                cursors.append(next_cursor)
+                st.rerun()
         
-        st.markdown('<div class="section-header">Bulk Transaction Upload</div>', unsafe_allow_html=True)
+        section_header("Bulk Transaction Upload")
         st.markdown("""
         **Expected CSV Format**<br>
         Columns: transaction_date, value_date, narration, ref_number, debit_amount, credit_amount, tax_percentage, tax_amount<br>
@@ -809,169 +768,97 @@ def main():
         with st.form("bulk_upload_form"):
             uploaded_file = st.file_uploader("Upload Transactions CSV", type=['csv'])
             account_name = st.selectbox("Account Name", options=account_options)
+            duplicate_choice = st.radio("Rows already posted (known ref numbers or overlapping lines)",
+                                        list(DUPLICATE_CHOICES), horizontal=True)
+            chunked_ingest = st.checkbox("Chunked ingest for large statements (resumes interrupted uploads)")
+            apply_rules = st.checkbox("Apply auto-allocation rules", value=True)
+            duplicate_mode = DUPLICATE_CHOICES[duplicate_choice]
             
-            if st.form_submit_button("Upload Transactions"):
+            col1, col2 = st.columns(2)
+            with col1:
+                upload_clicked = st.form_submit_button("Upload Transactions")
+            with col2:
+                check_clicked = st.form_submit_button("Check for Duplicates")
+            
+            if check_clicked:
                 if uploaded_file is not None:
                     try:
-                        df = pd.read_csv(uploaded_file, encoding='utf-8-sig')
-                        
-                        required_columns = ['transaction_date', 'value_date', 'narration', 'ref_number',
-                                           'debit_amount', 'credit_amount', 'tax_percentage', 'tax_amount']
-                        
-                        # Check if all required columns are present
-                        missing_columns = [col for col in required_columns if col not in df.columns]
-                        if missing_columns:
-                            st.error(f"CSV is missing required columns: {', '.join(missing_columns)}")
-                        else:
-                            # Validate data
-                            for index, row in df.iterrows():
-                                if not validate_date(row['transaction_date']) or not validate_date(row['value_date']):
-                                    st.error(f"Invalid date format in row {index + 2} with ref_number {row['ref_number']}. Use YYYY-MM-DD.")
-                                    return
-                                
-                                if row['debit_amount'] < 0 or row['credit_amount'] < 0:
-                                    st.error(f"Negative amounts not allowed in row {index + 2} with ref_number {row['ref_number']}.")
-                                    return
-                                
-                                if row['debit_amount'] > 0 and row['credit_amount'] > 0:
-                                    st.error(f"Cannot have both debit and credit amounts in row {index + 2} with ref_number {row['ref_number']}.")
-                                    return
-                                
-                                if row['tax_percentage'] < 0 or row['tax_percentage'] > 100:
-                                    st.error(f"Invalid tax percentage in row {index + 2} with ref_number {row['ref_number']}.")
-                                    return
-                                
-                                # Ensure all required CSV values are not NaN
-                                for col in required_columns:
-                                    if pd.isna(row[col]):
-                                        st.error(f"Missing or invalid value for {col} in row {index + 2} with ref_number {row['ref_number']}.")
-                                        return
-                            
-                            # Check main account balance
-                            c.execute("SELECT balance FROM main_account LIMIT 1")
-                            main_balance = c.fetchone()[0] or 0.0
-                            
-                            total_debit = sum(row['debit_amount'] + row['tax_amount'] for _, row in df.iterrows() if row['debit_amount'] > 0)
-                            total_credit = sum(row['credit_amount'] - row['tax_amount'] for _, row in df.iterrows() if row['credit_amount'] > 0)
-                            net_balance_change = total_credit - total_debit
-                            
-                            if main_balance + net_balance_change < 0:
-                                st.error(f"Insufficient Main Account balance for debit transactions (${total_debit:,.2f} required).")
-                            else:
-                                try:
-                                    with conn:
-                                        statement_id = str(uuid.uuid4())[:8]
-                                        
-                                        c.execute("""
-                                        INSERT INTO statements (
-                                            id, filename, upload_date, created_by, created_at
-                                        ) VALUES (?, ?, ?, ?, ?)
-                                        """, (
-                                            statement_id, uploaded_file.name, datetime.datetime.now().isoformat(),
-                                            st.session_state.role, datetime.datetime.now().isoformat()
-                                        ))
-                                        
-                                        for index, row in df.iterrows():
-                                            transaction_id = str(uuid.uuid4())[:8]
-                                            transaction_type = "Debit" if row['debit_amount'] > 0 else "Credit"
-                                            debit_type = "Other" if transaction_type == "Debit" else None
-                                            credit_type = "Other" if transaction_type == "Credit" else None
-                                            
-                                            allocation_amount = row['debit_amount'] if transaction_type == "Debit" else row['credit_amount'] - row['tax_amount']
-                                            
-                                            # Validate values, allowing None for credit_type (Debit) or debit_type (Credit)
-                                            values = (
-                                                transaction_id, row['ref_number'], row['transaction_date'],
-                                                row['value_date'], row['narration'], row['debit_amount'],
-                                                row['credit_amount'], row['tax_percentage'], row['tax_amount'],
-                                                transaction_type, debit_type, credit_type, st.session_state.role,
-                                                datetime.datetime.now().isoformat(), account_name, statement_id
-                                            )
-                                            # Check for None in critical columns only
-                                            critical_columns = ['id', 'ref_number', 'transaction_date', 'created_by', 'created_at', 'account_name', 'statement_id']
-                                            for i, col in enumerate(['id', 'ref_number', 'transaction_date', 'value_date', 'narration', 
-                                                                    'debit_amount', 'credit_amount', 'tax_percentage', 'tax_amount', 
-                                                                    'type', 'debit_type', 'credit_type', 'created_by', 'created_at', 
-                                                                    'account_name', 'statement_id']):
-                                                if col in critical_columns and values[i] is None:
-                                                    st.error(f"Missing critical value for {col} in row {index + 2} with ref_number {row['ref_number']}: {values}")
-                                                    return
-                                            # Allow debit_type to be None for Credit transactions, and credit_type to be None for Debit transactions
-                                            if transaction_type == "Debit" and values[11] is not None:  # credit_type
-                                                st.error(f"Credit type must be None for Debit transaction in row {index + 2} with ref_number {row['ref_number']}: {values}")
-                                                return
-                                            if transaction_type == "Credit" and values[10] is not None:  # debit_type
-                                                st.error(f"Debit type must be None for Credit transaction in row {index + 2} with ref_number {row['ref_number']}: {values}")
-                                                return
-                                            
-                                            c.execute("""
-                                            INSERT INTO transactions (
-                                                id, ref_number, transaction_date, value_date, narration,
-                                                debit_amount, credit_amount, tax_percentage, tax_amount,
-                                                type, debit_type, credit_type, created_by, created_at,
-                                                account_name, statement_id
-                                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                                            """, values)
-                                            
-                                            # Insert allocation with department_id NULL
-                                            allocation_id = str(uuid.uuid4())[:8]
-                                            c.execute("""
-                                            INSERT INTO allocations (
-                                                id, treasury_ref, department_id, amount, created_by, created_at, transaction_type, statement_id
-                                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                                            """, (
-                                                allocation_id, row['ref_number'], None, allocation_amount,
-                                                st.session_state.role, datetime.datetime.now().isoformat(), transaction_type, statement_id
-                                            ))
-                                            
-                                            # Update main account balance
-                                            if transaction_type == "Debit":
-                                                c.execute("UPDATE main_account SET balance = balance - ?",
-                                                         (row['debit_amount'] + row['tax_amount'],))
-                                            else:
-                                                c.execute("UPDATE main_account SET balance = balance + ?",
-                                                         (row['credit_amount'] - row['tax_amount'],))
-                                        
-                                        c.execute("SELECT balance FROM main_account LIMIT 1")
-                                        new_main_balance = c.fetchone()[0]
-                                        
-                                        st.success(f"Transactions uploaded successfully! Statement ID: {statement_id}")
-                                        st.info(f"Transactions are pending allocation in the Allocations section. Updated Main Account Balance: ${new_main_balance:,.2f}")
-                                        
-                                        # Display uploaded transactions
-                                        st.markdown('<div class="section-header">Uploaded Transactions</div>', unsafe_allow_html=True)
-                                        st.dataframe(df)
-                                
-                                except Exception as e:
-                                    st.error(f"Error processing transactions: {str(e)}")
-                                    conn.rollback()
+                        df = pd.read_csv(uploaded_file, encoding='utf-8-sig', dtype=TEXT_DTYPES)
+                        show_duplicate_report(find_duplicates(conn, df, account_name))
+                    except Exception as e:
+                        st.error(f"Error checking ref numbers: {str(e)}")
+                else:
+                    st.error("Please upload a CSV file.")
+            
+            if upload_clicked:
+                if uploaded_file is not None and chunked_ingest:
+                    progress_bar = st.progress(0.0, text="Validating statement...")
+                    try:
+                        result = ingest_upload_stream(
+                            conn, uploaded_file, account_name, st.session_state.role, duplicates=duplicate_mode,
+                            progress=lambda done, total: progress_bar.progress(
+                                done / total, text=f"Committed {done:,} of {total:,} rows"))
+                    except DuplicateRefsError as e:
+                        st.error(str(e))
+                        show_duplicate_report(e.report)
+                    except IngestError as e:
+                        st.error(str(e))
+                    except Exception as e:
+                        st.error(f"Error processing transactions: {str(e)}")
+                    else:
+                        if result.resumed_rows:
+                            st.info(f"Resumed after {result.resumed_rows:,} previously committed rows.")
+                        show_ingest_result(conn, result, account_name, uploaded_file.name, chunked_ingest, apply_rules)
+                elif uploaded_file is not None:
+                    try:
+                        df = pd.read_csv(uploaded_file, encoding='utf-8-sig', dtype=TEXT_DTYPES)
                     except Exception as e:
                         st.error(f"Error reading CSV: {str(e)}")
+                    else:
+                        try:
+                            result = ingest_statement(conn, df, account_name, uploaded_file.name,
+                                                      st.session_state.role, duplicates=duplicate_mode)
+                        except DuplicateRefsError as e:
+                            st.error(str(e))
+                            show_duplicate_report(e.report)
+                        except IngestError as e:
+                            st.error(str(e))
+                        except Exception as e:
+                            st.error(f"Error processing transactions: {str(e)}")
+                        else:
+                            if show_ingest_result(conn, result, account_name, uploaded_file.name,
+                                                  chunked_ingest, apply_rules):
+                                # Display uploaded transactions
+                                section_header("Uploaded Transactions")
+                                st.dataframe(df)
                 else:
                     st.error("Please upload a CSV file.")
     
     elif selected == "Statements":
-        st.markdown('<div class="section-header">Statement Management</div>', unsafe_allow_html=True)
+        section_header("Statement Management")
         
         if st.session_state.role == "admin":
-            st.markdown('<div class="section-header">Download Statements</div>', unsafe_allow_html=True)
+            section_header("Download Statements")
             start_date = st.date_input("Start Date")
             end_date = st.date_input("End Date")
             
-            if st.button("Generate Statement"):
-                if start_date <= end_date:
-                    csv_data = generate_statement_csv(start_date, end_date)
-                    st.download_button(
-                        label="Download CSV",
-                        data=csv_data,
-                        file_name=f"statement_{start_date}_to_{end_date}.csv",
-                        mime="text/csv"
-                    )
-                else:
-                    st.error("Start date must be before or equal to end date.")
+            accounts = st.multiselect("Accounts (leave empty for all)", options=account_options)
+            fmt = st.selectbox("Format", available_formats())
             
-            st.markdown('<div class="section-header">Uploaded Statements</div>', unsafe_allow_html=True)
-            df = pd.read_sql("SELECT id, filename, upload_date FROM statements ORDER BY upload_date DESC", conn)
+            if start_date <= end_date:
+                extension, mime = EXPORT_FORMATS[fmt]
+                # The export only runs when the button is clicked
+                st.download_button(
+                    label="Download Statement",
+                    data=lambda: generate_statement_export(start_date, end_date, accounts, fmt),
+                    file_name=f"statement_{start_date}_to_{end_date}.{extension}",
+                    mime=mime
+                )
+            else:
+                st.error("Start date must be before or equal to end date.")
+            
+            section_header("Uploaded Statements")
+            df = cached_read_sql("SELECT id, filename, upload_date FROM statements ORDER BY upload_date DESC", conn, ('statements',))
             
             if not df.empty:
                 st.dataframe(df)
@@ -979,10 +866,10 @@ def main():
                 st.info("No statements uploaded.")
     
     elif selected == "Allocations" and st.session_state.role == "admin":
-        st.markdown('<div class="section-header">Allocation Management</div>', unsafe_allow_html=True)
+        section_header("Allocation Management")
         
-        st.markdown('<div class="section-header">Pending Allocations</div>', unsafe_allow_html=True)
-        pending_allocations = pd.read_sql("""
+        section_header("Pending Allocations")
+        pending_allocations = cached_read_sql("""
         SELECT a.id, a.treasury_ref, a.amount, a.transaction_type, t.debit_type
         FROM allocations a
         JOIN transactions t ON a.treasury_ref = t.ref_number
@@ -991,11 +878,11 @@ def main():
              (a.transaction_type = 'Debit' AND t.debit_type != 'Investment'))
         AND t.credit_type != 'Credit Investments'
         ORDER BY a.created_at DESC
-        """, conn)
+        """, conn, ('allocations', 'transactions'))
         
         if not pending_allocations.empty:
-            st.markdown('<div class="section-header">Pending Allocations Table</div>', unsafe_allow_html=True)
-            pending_df = pd.read_sql("""
+            section_header("Pending Allocations Table")
+            pending_df = cached_read_sql("""
             SELECT a.treasury_ref, a.amount, a.transaction_type, t.transaction_date,
                    t.narration, t.account_name, t.tax_percentage, t.tax_amount
             FROM allocations a
@@ -1005,26 +892,86 @@ def main():
                  (a.transaction_type = 'Debit' AND t.debit_type != 'Investment'))
             AND t.credit_type != 'Credit Investments'
             ORDER BY t.transaction_date DESC
-            """, conn)
-            st.dataframe(pending_df)
+            """, conn, ('allocations', 'transactions'))
+            st.dataframe(dollar_columns(pending_df, 'amount', 'tax_amount'))
+            
+            with st.expander("Batch Allocation"):
+                departments = cached_read_sql("SELECT id, name FROM departments", conn, ('departments',))
+                dept_names = dict(zip(departments['id'], departments['name']))
+                batch_limit = st.number_input("Rows to load", min_value=1, value=500, step=100)
+                batch_df = cached_read_sql("""
+                SELECT a.id, a.treasury_ref, a.amount, a.transaction_type, t.transaction_date,
+                       t.narration, t.account_name
+                FROM allocations a
+                JOIN transactions t ON a.treasury_ref = t.ref_number
+                WHERE a.department_id IS NULL
+                AND (a.transaction_type = 'Credit' OR 
+                     (a.transaction_type = 'Debit' AND t.debit_type != 'Investment'))
+                AND t.credit_type != 'Credit Investments'
+                ORDER BY t.transaction_date DESC
+                LIMIT ?
+                """, conn, ('allocations', 'transactions'), params=(int(batch_limit),))
+                batch_df = dollar_columns(batch_df, 'amount')
+                batch_df.insert(0, 'assign_to', None)
+                for dept_id, dept_name in dept_names.items():
+                    batch_df[dept_name] = 0.0
+                
+                st.caption("Pick a department under 'assign_to' to allocate the full amount, "
+                           "or enter a split across the department columns.")
+                edited = st.data_editor(
+                    batch_df,
+                    hide_index=True,
+                    disabled=['id', 'treasury_ref', 'amount', 'transaction_type',
+                              'transaction_date', 'narration', 'account_name'],
+                    column_config={'assign_to': st.column_config.SelectboxColumn(
+                        "assign_to", options=list(dept_names.values()))},
+                    key="batch_allocation_editor"
+                )
+                
+                if st.button("Allocate Batch"):
+                    dept_ids = {name: dept_id for dept_id, name in dept_names.items()}
+                    splits = {}
+                    for row in edited.to_dict('records'):
+                        if row['assign_to']:
+                            splits[row['id']] = {dept_ids[row['assign_to']]: to_cents(row['amount'])}
+                        else:
+                            split = {dept_id: to_cents(row[name]) for dept_id, name in dept_names.items() if row[name]}
+                            if split:
+                                splits[row['id']] = split
+                    
+                    if not splits:
+                        st.warning("Nothing to allocate: assign a department or enter a split.")
+                    else:
+                        try:
+                            result = allocate_batch(conn, splits, st.session_state.role)
+                            audit_event("allocation.batch", allocated=len(result.allocated), failed=len(result.failures),
+                                        rows=result.rows_written)
+                            st.success(f"Allocated {len(result.allocated):,} of {len(splits):,} "
+                                       f"({result.rows_written:,} department rows) in {result.elapsed:.2f}s.")
+                            if result.failures:
+                                st.error(f"{len(result.failures):,} allocation(s) failed:")
+                                st.dataframe(pd.DataFrame(list(result.failures.items()),
+                                                          columns=['id', 'reason']), hide_index=True)
+                        except Exception as e:
+                            st.error(f"Error processing batch allocation: {str(e)}")
             
             with st.form("allocate_pending", clear_on_submit=True):
                 selected_ref = st.selectbox("Select Ref Number", pending_allocations['treasury_ref'])
                 alloc_record = pending_allocations[pending_allocations['treasury_ref'] == selected_ref].iloc[0]
                 alloc_id = alloc_record['id']
-                amount = float(alloc_record['amount'])
+                amount = int(alloc_record['amount'])
                 transaction_type = alloc_record['transaction_type']
                 
-                st.markdown(f"**Amount to Allocate: ${amount:,.2f} ({transaction_type})**", unsafe_allow_html=True)
+                st.markdown(f"**Amount to Allocate: {format_money(amount)} ({transaction_type})**", unsafe_allow_html=True)
                 
-                departments = pd.read_sql("SELECT id, name FROM departments", conn)
+                departments = cached_read_sql("SELECT id, name FROM departments", conn, ('departments',))
                 allocations = {}
                 
                 for _, dept in departments.iterrows():
                     allocations[dept['id']] = st.number_input(
                         f"Allocation for {dept['name']}",
                         min_value=0.0,
-                        max_value=float(amount),
+                        max_value=to_dollars(amount),
                         value=0.0,
                         step=0.01
                     )
@@ -1032,55 +979,18 @@ def main():
                 submit_button = st.form_submit_button("Allocate", use_container_width=True)
                 
                 if submit_button:
-                    total_allocated = sum(allocations.values())
-                    
-                    if abs(total_allocated - amount) > 0.01:
-                        st.error(f"Total amount allocated (${total_allocated:,.2f}) must equal the transaction amount (${amount:,.2f})")
+                    allocations = {dept_id: to_cents(value) for dept_id, value in allocations.items()}
+                    try:
+                        allocate_pending(conn, alloc_id, allocations, st.session_state.role, source_ref=selected_ref)
+                    except TreasuryError as e:
+                        st.error(str(e))
+                    except Exception as e:
+                        st.error(f"Error processing allocation: {str(e)}")
                     else:
-                        try:
-                            with conn:
-                                # Process each department allocation
-                                for dept_id, alloc_amount in allocations.items():
-                                    if alloc_amount > 0:
-                                        if transaction_type == "Debit":
-                                            c.execute("SELECT balance FROM departments WHERE id = ?", (dept_id,))
-                                            dept_balance = c.fetchone()[0] or 0.0
-                                            
-                                            if dept_balance < alloc_amount:
-                                                c.execute("SELECT name FROM departments WHERE id = ?", (dept_id,))
-                                                dept_name = c.fetchone()[0]
-                                                st.error(f"Insufficient balance in {dept_name} for debit allocation of ${alloc_amount:,.2f}.")
-                                                conn.rollback()
-                                                st.stop()
-                                        
-                                        new_alloc_id = str(uuid.uuid4())[:8]
-                                        c.execute("""
-                                        INSERT INTO allocations (
-                                            id, treasury_ref, department_id, amount,
-                                            created_by, created_at, transaction_type
-                                        ) VALUES (?, ?, ?, ?, ?, ?, ?)
-                                        """, (
-                                            new_alloc_id, selected_ref, dept_id,
-                                            alloc_amount, st.session_state.role,
-                                            datetime.datetime.now().isoformat(), transaction_type
-                                        ))
-                                        
-                                        if transaction_type == "Credit":
-                                            c.execute("UPDATE departments SET balance = balance + ? WHERE id = ?",
-                                                     (alloc_amount, dept_id))
-                                        elif transaction_type == "Debit":
-                                            c.execute("UPDATE departments SET balance = balance - ? WHERE id = ?",
-                                                     (alloc_amount, dept_id))
-                                
-                                # Remove the original unallocated record
-                                c.execute("DELETE FROM allocations WHERE id = ?", (alloc_id,))
-                                conn.commit()
-                                st.success("Allocation completed successfully!")
-                                st.session_state.allocated = True  # Set a flag
-                        
-                        except Exception as e:
-                            st.error(f"Error processing allocation: {str(e)}")
-                            conn.rollback()
+                        audit_event("allocation.allocate", "allocation", selected_ref,
+                                    splits={dept_id: to_dollars(value) for dept_id, value in allocations.items() if value > 0})
+                        st.success("Allocation completed successfully!")
+                        st.session_state.allocated = True  # Set a flag
                 
                 # This will force a rerun if allocation was successful
                 if st.session_state.get('allocated', False):
@@ -1089,42 +999,138 @@ def main():
         else:
             st.info("No pending allocations found")
         
-        st.markdown('<div class="section-header">Recent Allocations</div>', unsafe_allow_html=True)
-        df = pd.read_sql("""
+        section_header("Auto-Allocation Rules")
+        with st.expander("Add Rule"):
+            with st.form("allocation_rule_form", clear_on_submit=True):
+                rule_name = st.text_input("Rule Name")
+                narration_pattern = st.text_input("Narration contains (leave empty for any)")
+                rule_account = st.selectbox("Account", ["Any"] + account_options)
+                rule_type = st.selectbox("Transaction Type", ["Any", "Credit", "Debit"])
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    min_amount = st.number_input("Min Amount (0 for none)", min_value=0.0, value=0.0)
+                with col2:
+                    max_amount = st.number_input("Max Amount (0 for none)", min_value=0.0, value=0.0)
+                with col3:
+                    priority = st.number_input("Priority (lower runs first)", min_value=0, value=100)
+                
+                departments = cached_read_sql("SELECT id, name FROM departments", conn, ('departments',))
+                shares = {}
+                for _, dept in departments.iterrows():
+                    shares[dept['id']] = st.number_input(f"Share for {dept['name']} (%)",
+                                                         min_value=0.0, max_value=100.0, value=0.0)
+                
+                if st.form_submit_button("Add Rule"):
+                    if not rule_name.strip():
+                        st.error("Rule name required.")
+                    else:
+                        try:
+                            save_rule(
+                                conn, rule_name.strip(), shares, st.session_state.role,
+                                narration_pattern=narration_pattern.strip(),
+                                account_name=None if rule_account == "Any" else rule_account,
+                                transaction_type=None if rule_type == "Any" else rule_type,
+                                min_amount=to_cents(min_amount) or None, max_amount=to_cents(max_amount) or None,
+                                priority=int(priority)
+                            )
+                            audit_event("allocation_rule.add", "allocation_rule", rule_name.strip())
+                            st.success("Rule added!")
+                        except ValueError as e:
+                            st.error(str(e))
+        
+        rules = cached_read_sql("""
+        SELECT r.id, r.name, r.narration_pattern, r.account_name, r.transaction_type,
+               r.min_amount, r.max_amount, r.priority,
+               GROUP_CONCAT(d.name || ' ' || s.share || '%', ', ') AS split
+        FROM allocation_rules r
+        LEFT JOIN allocation_rule_splits s ON s.rule_id = r.id
+        LEFT JOIN departments d ON d.id = s.department_id
+        WHERE r.active = 1
+        GROUP BY r.id
+        ORDER BY r.priority, r.id
+        """, conn, ('allocation_rules', 'allocation_rule_splits', 'departments'))
+        
+        if not rules.empty:
+            st.dataframe(dollar_columns(rules, 'min_amount', 'max_amount'), hide_index=True)
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                if st.button("Dry Run on Pending"):
+                    result = auto_allocate(conn, dry_run=True)
+                    st.info(f"{result.matched:,} of {result.pending:,} pending rows match a rule "
+                            f"({result.match_rate:.0%}).")
+                    if not result.by_rule.empty:
+                        st.dataframe(dollar_columns(result.by_rule, 'amount'), hide_index=True)
+            with col2:
+                if st.button("Apply Rules to Pending"):
+                    result = auto_allocate(conn, created_by=st.session_state.role)
+                    audit_event("allocation_rule.apply", pending=result.pending, allocated=result.allocated)
+                    st.success(f"Auto-allocated {result.allocated:,} of {result.pending:,} pending rows "
+                               f"in {result.elapsed:.2f}s.")
+                    if result.failures:
+                        st.warning(f"{len(result.failures):,} matched row(s) could not be allocated.")
+            with col3:
+                rule_to_delete = st.selectbox("Rule", rules['id'],
+                                              format_func=lambda rule_id: rules.set_index('id')['name'][rule_id],
+                                              label_visibility="collapsed")
+                if st.button("Delete Rule"):
+                    delete_rule(conn, int(rule_to_delete))
+                    audit_event("allocation_rule.delete", "allocation_rule", int(rule_to_delete))
+                    st.rerun()
+        else:
+            st.info("No auto-allocation rules defined.")
+        
+        section_header("Recent Allocations")
+        df = cached_read_sql("""
         SELECT a.treasury_ref, a.department_id, a.amount, a.transaction_type,
                a.created_at, d.name AS department_name
         FROM allocations a
         LEFT JOIN departments d ON a.department_id = d.id
-        WHERE a.created_at >= date('now', '-30 days') AND a.department_id IS NOT NULL
+        WHERE a.created_at >= ? AND a.department_id IS NOT NULL
         ORDER BY a.created_at DESC
-        """, conn)
+        """, conn, ('allocations', 'departments'),
+        params=((datetime.date.today() - timedelta(days=30)).isoformat(),))
         
         if not df.empty:
             st.markdown('<div class="card">Recent Allocations</div>', unsafe_allow_html=True)
-            st.dataframe(df)
+            st.dataframe(dollar_columns(df, 'amount'))
         else:
             st.info("No recent allocations found")
         
-        st.markdown('<div class="section-header">Your Department Allocations</div>', unsafe_allow_html=True)
-        dept_allocations = pd.read_sql("""
+        section_header("Your Department Allocations")
+        dept_allocations = cached_read_sql("""
         SELECT a.treasury_ref, a.amount, a.transaction_type, t.transaction_date,
                t.narration, t.account_name, t.tax_percentage, t.tax_amount
         FROM allocations a
         JOIN transactions t ON a.treasury_ref = t.ref_number
         WHERE a.department_id = ?
         ORDER BY t.transaction_date DESC
-        """, conn, params=(st.session_state.department_id,))
+        """, conn, ('allocations', 'transactions'), params=(st.session_state.department_id,))
         
         if not dept_allocations.empty:
-            st.dataframe(dept_allocations)
+            st.dataframe(dollar_columns(dept_allocations, 'amount', 'tax_amount'))
         else:
             st.warning("No allocations found for your department.")
     
     elif selected == "Investments" and st.session_state.role == "admin":
-        st.markdown('<div class="section-header">Investment Management</div>', unsafe_allow_html=True)
+        section_header("Investment Management")
+        
+        with st.expander("Maturity Processing"):
+            due = process_maturities(conn, dry_run=True)
+            st.write(f"{due.matured} confirmed investment(s) have reached maturity "
+                     f"({format_money(due.credited)} to credit).")
+            if st.button("Settle Matured Investments", disabled=not due.matured):
+                try:
+                    result = process_maturities(conn, created_by=st.session_state.role)
+                    audit_event("investment.mature", matured=result.matured, credited=to_dollars(result.credited))
+                    st.success(f"Settled {result.matured} investment(s), crediting {format_money(result.credited)} "
+                               f"in {result.elapsed:.2f}s.")
+                except Exception as e:
+                    st.error(f"Error settling maturities: {str(e)}")
+            st.caption("Maturities are also settled automatically in the background "
+                       "(TREASURY_MATURITY_INTERVAL seconds, 0 to disable) and by python maturity.py.")
         
-        st.markdown('<div class="section-header">Pending Investment Allocations</div>', unsafe_allow_html=True)
-        pending_investment_allocations = pd.read_sql("""
+        section_header("Pending Investment Allocations")
+        pending_investment_allocations = cached_read_sql("""
         SELECT a.id, a.treasury_ref, a.amount, a.transaction_type, t.debit_type, t.credit_type,
                t.transaction_date, t.narration, t.account_name, t.tax_percentage, t.tax_amount
         FROM allocations a
@@ -1133,10 +1139,10 @@ def main():
         WHERE a.department_id IS NULL
         AND (t.debit_type = 'Investment' OR t.credit_type = 'Credit Investments')
         ORDER BY t.transaction_date DESC
-        """, conn)
+        """, conn, ('allocations', 'transactions', 'investments'))
         
         if not pending_investment_allocations.empty:
-            st.dataframe(pending_investment_allocations)
+            st.dataframe(dollar_columns(pending_investment_allocations, 'amount', 'tax_amount'))
             
             with st.form("allocate_investment"):
                 selected_ref = st.selectbox("Select Investment Allocation", pending_investment_allocations['treasury_ref'])
@@ -1153,94 +1159,47 @@ def main():
                     pending_investment_allocations['treasury_ref'] == selected_ref
                 ]['transaction_type'].iloc[0]
                 
-                st.markdown(f"**Amount to Allocate: ${amount:,.2f} ({transaction_type})**", unsafe_allow_html=True)
+                st.markdown(f"**Amount to Allocate: {format_money(amount)} ({transaction_type})**", unsafe_allow_html=True)
                 
-                departments = pd.read_sql("SELECT id, name FROM departments", conn)
+                departments = cached_read_sql("SELECT id, name FROM departments", conn, ('departments',))
                 allocations = {}
                 
                 for _, dept in departments.iterrows():
                     allocations[dept['id']] = st.number_input(f"Allocation for {dept['name']}", min_value=0.0, value=0.0)
                 
                 if st.form_submit_button("Allocate Investment"):
-                    total_allocated = sum(allocations.values())
-                    
-                    if total_allocated != amount:
-                        st.error("Total allocated amount must equal the transaction amount.")
+                    allocations = {dept_id: to_cents(value) for dept_id, value in allocations.items()}
+                    try:
+                        allocate_investment(conn, alloc_id, selected_ref, allocations, st.session_state.role)
+                    except TreasuryError as e:
+                        st.error(str(e))
+                    except Exception as e:
+                        st.error(f"Error processing allocation: {str(e)}")
                     else:
-                        if transaction_type == "Debit":
-                            for dept_id, alloc_amount in allocations.items():
-                                if alloc_amount > 0:
-                                    c.execute("SELECT balance FROM departments WHERE id = ?", (dept_id,))
-                                    dept_balance = c.fetchone()[0] or 0.0
-                                    
-                                    if dept_balance < alloc_amount:
-                                        c.execute("SELECT name FROM departments WHERE id = ?", (dept_id,))
-                                        dept_name = c.fetchone()[0]
-                                        st.error(f"Insufficient balance in {dept_name} for debit allocation of ${alloc_amount:,.2f}.")
-                                        return
-                        
-                        try:
-                            with conn:
-                                representative_dept_id = None
-                                
-                                for dept_id, alloc_amount in allocations.items():
-                                    if alloc_amount > 0:
-                                        if not representative_dept_id:
-                                            representative_dept_id = dept_id
-                                        
-                                        c.execute("""
-                                        INSERT INTO allocations (
-                                            id, treasury_ref, department_id, amount, created_by, created_at, transaction_type
-                                        ) VALUES (?, ?, ?, ?, ?, ?, ?)
-                                        """, (
-                                            str(uuid.uuid4())[:8], selected_ref, dept_id,
-                                            alloc_amount, st.session_state.role,
-                                            datetime.datetime.now().isoformat(), transaction_type
-                                        ))
-                                        
-                                        if transaction_type == "Credit":
-                                            c.execute("UPDATE departments SET balance = balance + ? WHERE id = ?", (alloc_amount, dept_id))
-                                        elif transaction_type == "Debit":
-                                            c.execute("UPDATE departments SET balance = balance - ? WHERE id = ?", (alloc_amount, dept_id))
-                                
-                                if representative_dept_id:
-                                    c.execute("UPDATE investments SET department_id = ? WHERE ref_number = ?",
-                                             (representative_dept_id, selected_ref))
-                                
-                                c.execute("DELETE FROM allocations WHERE id = ?", (alloc_id,))
-                                st.success("Investment allocation completed successfully!")
-                                
-                                c.execute("SELECT balance FROM main_account LIMIT 1")
-                                new_main_balance = c.fetchone()[0]
-                                
-                                dept_balances = []
-                                for dept_id in allocations:
-                                    if allocations[dept_id] > 0:
-                                        c.execute("SELECT name, balance FROM departments WHERE id = ?", (dept_id,))
-                                        dept_result = c.fetchone()
-                                        dept_balances.append(f"{dept_result[0]}: ${dept_result[1]:,.2f}")
-                                
-                                st.info(f"Updated Balances:\n- Main Account: ${new_main_balance:,.2f}\n- " + "\n- ".join(dept_balances))
+                        audit_event("investment.allocate", "investment", selected_ref,
+                                    splits={dept_id: to_dollars(value) for dept_id, value in allocations.items() if value > 0})
+                        st.success("Investment allocation completed successfully!")
                         
-                        except Exception as e:
-                            st.error(f"Error processing allocation: {str(e)}")
-                            conn.rollback()
+                        dept_balances = [f"{dept['name']}: {format_money(dept['balance'])}" for _, dept in cached_read_sql(
+                            "SELECT id, name, balance FROM departments", conn, ('departments',)).iterrows()
+                            if allocations.get(dept['id'], 0) > 0]
+                        st.info(f"Updated Balances:\n- Main Account: {format_money(main_balance(c))}\n- " + "\n- ".join(dept_balances))
         else:
             st.info("No pending investment allocations.")
         
-        st.markdown('<div class="section-header">Confirm Investments</div>', unsafe_allow_html=True)
-        pending_investments = pd.read_sql("""
+        section_header("Confirm Investments")
+        pending_investments = cached_read_sql("""
         SELECT i.ref_number, i.amount, i.created_at, t.narration, t.transaction_date, i.department_id
         FROM investments i
         JOIN transactions t ON i.ref_number = t.ref_number
         WHERE i.status = 'pending' AND i.department_id IS NOT NULL
         ORDER BY i.created_at DESC
-        """, conn)
+        """, conn, ('investments', 'transactions'))
         
         deal_note_data = None
         
         if not pending_investments.empty:
-            st.dataframe(pending_investments)
+            st.dataframe(dollar_columns(pending_investments, 'amount'))
             
             with st.form("confirm_investment"):
                 selected_ref = st.selectbox("Select Investment", pending_investments['ref_number'])
@@ -1251,60 +1210,43 @@ def main():
                     default_narration = pending_investments.loc[pending_investments['ref_number'] == selected_ref]['narration'].iloc[0]
                     
                     account_name = st.selectbox("Account Name", options=account_options)
-                    nominal_value = st.number_input("Nominal Value ($)", min_value=0.0, value=float(amount), disabled=True)
+                    nominal_value = st.number_input("Nominal Value ($)", min_value=0.0, value=to_dollars(amount), disabled=True)
                     period = st.number_input("Tenure (days)", min_value=1, value=30)
                     interest_rate = st.number_input("Interest Rate (%)", min_value=0.0, value=0.0)
                     
-                    interest = (amount * interest_rate * period) / (100 * 365)
-                    withholding_tax = interest * 0.2
-                    st.markdown(f"**Withholding Tax (20% of Interest):** ${withholding_tax:,.2f}")
+                    terms = deal_terms(int(amount), interest_rate, period, value_date)
+                    st.markdown(f"**Withholding Tax (20% of Interest):** {format_money(terms.withholding_tax)}")
                     
                     if st.form_submit_button("Confirm Investment"):
-                        maturity_date = datetime.datetime.strptime(value_date, '%Y-%m-%d') + timedelta(days=period)
-                        maturity_value = amount + interest
-                        net_interest = interest - withholding_tax
-                        tax_maturity_value = amount + net_interest
-                        after_tax_yield = (net_interest / amount) * (365 / period) * 100 if period > 0 and amount > 0 else 0.0
-                        profit_loss = tax_maturity_value - amount
-                        
                         try:
-                            with conn:
-                                c.execute("""
-                                UPDATE investments
-                                SET account_name = ?, period = ?, value_date = ?,
-                                    interest_rate = ?, maturity_date = ?, interest = ?,
-                                    withholding_tax = ?, maturity_amount = ?, status = 'confirmed'
-                                WHERE ref_number = ?
-                                """, (
-                                    account_name, period, value_date,
-                                    interest_rate, maturity_date.isoformat(), interest,
-                                    withholding_tax, tax_maturity_value, selected_ref
-                                ))
-                                
-                                st.success("Investment confirmed successfully!")
-                                
-                                # Store deal note data for download button outside the form
-                                deal_note_data = f"""
-                                Deal Note
-                                
-                                Reference Number: {selected_ref}
-                                Account Name: {account_name}
-                                Nominal Value: ${amount:,.2f}
-                                Tenure: {period} days
-                                Value Date: {value_date}
-                                Interest Rate: {interest_rate:.2f}%
-                                Maturity Date: {maturity_date}
-                                Interest: ${interest:,.2f}
-                                Withholding Tax: ${withholding_tax:,.2f}
-                                Maturity Value: ${maturity_value:,.2f}
-                                Net Interest: ${net_interest:,.2f}
-                                Tax Maturity Value: ${tax_maturity_value:,.2f}
-                                After-Tax Yield: {after_tax_yield:.2f}%
-                                Profit/Loss: ${profit_loss:,.2f}
-                                """
+                            terms = confirm_investment(conn, selected_ref, account_name, period, interest_rate)
+                        except TreasuryError as e:
+                            st.error(str(e))
                         except Exception as e:
                             st.error(f"Error confirming investment: {str(e)}")
-                            conn.rollback()
+                        else:
+                            audit_event("investment.confirm", "investment", selected_ref, maturity_date=terms.maturity_date)
+                            st.success("Investment confirmed successfully!")
+                            
+                            # Store deal note data for download button outside the form
+                            deal_note_data = f"""
+                            Deal Note
+                            
+                            Reference Number: {selected_ref}
+                            Account Name: {account_name}
+                            Nominal Value: {format_money(terms.amount)}
+                            Tenure: {terms.period} days
+                            Value Date: {terms.value_date}
+                            Interest Rate: {terms.interest_rate:.2f}%
+                            Maturity Date: {terms.maturity_date}
+                            Interest: {format_money(terms.interest)}
+                            Withholding Tax: {format_money(terms.withholding_tax)}
+                            Maturity Value: {format_money(terms.maturity_value)}
+                            Net Interest: {format_money(terms.net_interest)}
+                            Tax Maturity Value: {format_money(terms.tax_maturity_value)}
+                            After-Tax Yield: {terms.after_tax_yield:.2f}%
+                            Profit/Loss: {format_money(terms.tax_maturity_value - terms.amount)}
+                            """
                 else:
                     st.error("Selected reference number not found.")
             
@@ -1319,36 +1261,46 @@ def main():
         else:
             st.info("No pending investments to confirm.")
         
-        st.markdown('<div class="section-header">Pending Investments</div>', unsafe_allow_html=True)
-        pending_unallocated = pd.read_sql("""
+        section_header("Pending Investments")
+        pending_unallocated = cached_read_sql("""
         SELECT i.ref_number, i.amount, i.created_at, t.narration, t.transaction_date
         FROM investments i
         JOIN transactions t ON i.ref_number = t.ref_number
         WHERE i.status = 'pending' AND i.department_id IS NULL
         ORDER BY i.created_at DESC
-        """, conn)
+        """, conn, ('investments', 'transactions'))
         
         if not pending_unallocated.empty:
-            st.dataframe(pending_unallocated)
+            st.dataframe(dollar_columns(pending_unallocated, 'amount'))
         else:
             st.info("No unallocated pending investments found.")
         
-        st.markdown('<div class="section-header">Active Investments</div>', unsafe_allow_html=True)
-        active_investments = pd.read_sql("""
-        SELECT i.ref_number, d.name AS department_name, i.account_name, i.period,
-               i.value_date, i.maturity_date, i.amount AS amount_invested,
-               (i.amount + i.interest) AS maturity_value, i.withholding_tax,
-               (i.interest - i.withholding_tax) AS net_interest, i.maturity_amount AS tax_maturity_value,
-               ((i.interest - i.withholding_tax) / i.amount * 365 / i.period * 100) AS after_tax_yield,
-               (i.maturity_amount - i.amount) AS profit_loss
-        FROM investments i
-        JOIN departments d ON i.department_id = d.id
-        WHERE i.status = 'confirmed' AND i.maturity_date >= ?
-        ORDER BY i.value_date DESC
-        """, conn, params=(datetime.datetime.now().isoformat(),))
+        section_header("Active Investments")
+        valued = value_portfolio(load_portfolio(conn))
+        active = valued[valued['days_to_maturity'] >= 0].sort_values('value_date', ascending=False)
         
-        if not active_investments.empty:
-            st.dataframe(active_investments)
+        if not active.empty:
+            active_investments = pd.DataFrame({
+                'ref_number': active['ref_number'],
+                'department_name': active['department'],
+                'account_name': active['account_name'],
+                'period': active['period'],
+                'value_date': active['value_date'].dt.date,
+                'maturity_date': active['maturity_date'].dt.date,
+                'days_to_maturity': active['days_to_maturity'].astype(int),
+                'amount_invested': active['amount'],
+                'maturity_value': active['amount'] + active['interest'],
+                'withholding_tax': active['withholding_tax'],
+                'net_interest': active['interest'] - active['withholding_tax'],
+                'accrued_net_interest': active['accrued_net_interest'],
+                'tax_maturity_value': active['maturity_amount'],
+                'after_tax_yield': active['after_tax_yield'].round(4),
+                'profit_loss': active['maturity_amount'] - active['amount'],
+            })
+            active_investments = dollar_columns(
+                active_investments, 'amount_invested', 'maturity_value', 'withholding_tax', 'net_interest',
+                'accrued_net_interest', 'tax_maturity_value', 'profit_loss')
+            st.dataframe(active_investments, hide_index=True)
             
             csv_data = active_investments.to_csv(index=False)
             st.download_button(
@@ -1357,131 +1309,93 @@ def main():
                 file_name="active_investments.csv",
                 mime="text/csv"
             )
+            
+            section_header("Maturity Ladder")
+            col1, col2 = st.columns(2)
+            with col1:
+                ladder_frequency = st.radio("Bucket", list(LADDER_FREQUENCIES), horizontal=True)
+            with col2:
+                ladder_group = st.radio("Group by", ["Department", "Account"], horizontal=True)
+            group_column = 'department' if ladder_group == "Department" else 'account_name'
+            ladder = dollar_columns(maturity_ladder(valued, LADDER_FREQUENCIES[ladder_frequency], by=(group_column,)),
+                                    'principal', 'maturity_amount')
+            
+            with get_profiler().section("Chart: Maturity Ladder"):
+                fig = go.Figure()
+                for group, rows in ladder.groupby(group_column):
+                    fig.add_trace(go.Bar(x=rows['bucket'], y=rows['maturity_amount'], name=group or "Unspecified"))
+                fig.update_layout(
+                    barmode='stack',
+                    height=350,
+                    margin=dict(l=20, r=20, t=40, b=20),
+                    xaxis_title="Maturity " + ("Week" if ladder_frequency == "Weekly" else "Month"),
+                    yaxis_title="Maturity Amount ($)",
+                    plot_bgcolor='rgba(0,0,0,0)'
+                )
+                st.plotly_chart(fig, use_container_width=True)
+            st.dataframe(ladder, hide_index=True)
         else:
             st.info("No active investments.")
     
     elif selected == "Investments" and st.session_state.role != "admin":
-        st.markdown('<div class="section-header">Investments</div>', unsafe_allow_html=True)
+        section_header("Investments")
         
-        st.markdown('<div class="section-header">Add Investments</div>', unsafe_allow_html=True)
+        section_header("Add Investments")
         with st.form("dept_investment_form"):
             account_name = st.selectbox("Account Name", options=account_options)
             currency = st.selectbox("Currency", ["USD", "EUR", "GBP"])
             period = st.number_input("Period (days)", min_value=1, value=30)
             value_date = st.date_input("Value Date")
             interest_rate = st.number_input("Interest Rate (%)", min_value=0.0, value=0.0)
-            amount = st.number_input("Investment Amount ($)", min_value=0.0, value=0.0)
+            amount = to_cents(st.number_input("Investment Amount ($)", min_value=0.0, value=0.0))
             tax_percentage = st.number_input("Tax Percentage (%)", min_value=0.0, max_value=100.0, value=0.0)
             
-            tax_amount = amount * (tax_percentage / 100)
+            tax_amount = percent_of(amount, tax_percentage)
             if tax_percentage > 0:
-                st.markdown(f"**Tax Amount:** ${tax_amount:,.2f}")
-                st.markdown(f"**Net Amount:** ${amount:,.2f}")
+                st.markdown(f"**Tax Amount:** {format_money(tax_amount)}")
+                st.markdown(f"**Net Amount:** {format_money(amount)}")
             
             if st.form_submit_button("Submit"):
-                c = conn.cursor()
-                c.execute("SELECT balance FROM main_account LIMIT 1")
-                main_balance = c.fetchone()[0] or 0.0
-                
-                c.execute("SELECT balance FROM departments WHERE id = ?", (st.session_state.department_id,))
-                dept_balance = c.fetchone()[0] or 0.0
-                
-                total_amount = amount + tax_amount
-                
-                if main_balance < total_amount:
-                    st.error(f"Insufficient Main Account balance for investment (${total_amount:,.2f} required).")
-                elif dept_balance < amount:
-                    c.execute("SELECT name FROM departments WHERE id = ?", (st.session_state.department_id,))
-                    dept_name = c.fetchone()[0]
-                    st.error(f"Insufficient balance in {dept_name} for investment (${amount:,.2f} required).")
+                try:
+                    ref_number, terms, tax_amount = submit_investment(
+                        conn, st.session_state.department_id, account_name, amount, period, value_date,
+                        interest_rate, tax_percentage=tax_percentage, currency=currency,
+                        created_by=st.session_state.role)
+                except TreasuryError as e:
+                    st.error(str(e))
+                except Exception as e:
+                    st.error(f"Error processing investment: {str(e)}")
                 else:
-                    ref_number = str(uuid.uuid4())[:8]
-                    maturity_date = value_date + timedelta(days=period)
-                    interest = (amount * interest_rate * period) / (100 * 365)
-                    withholding_tax = interest * 0.2
-                    maturity_amount = amount + interest - withholding_tax
-                    allocation_id = str(uuid.uuid4())[:8]
+                    audit_event("investment.submit", "investment", ref_number, amount=to_dollars(amount), account_name=account_name)
+                    st.success("Investment submitted successfully! Awaiting allocation by admin.")
                     
-                    try:
-                        with conn:
-                            # Insert investment with user's department_id
-                            c.execute("""
-                            INSERT INTO investments (
-                                ref_number, transaction_ref, account_name, currency, period,
-                                amount, value_date, interest_rate, maturity_date, interest,
-                                withholding_tax, maturity_amount, created_by, created_at,
-                                status, allocation_id, department_id
-                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                            """, (
-                                ref_number, ref_number, account_name, currency, period,
-                                amount, value_date.isoformat(), interest_rate, maturity_date.isoformat(),
-                                interest, withholding_tax, maturity_amount,
-                                st.session_state.role, datetime.datetime.now().isoformat(),
-                                'pending', allocation_id, st.session_state.department_id
-                            ))
-                            
-                            # Insert allocation with department_id NULL for pending allocation
-                            c.execute("""
-                            INSERT INTO allocations (
-                                id, treasury_ref, amount, created_by, created_at, transaction_type
-                            ) VALUES (?, ?, ?, ?, ?, ?)
-                            """, (
-                                allocation_id, ref_number, amount, st.session_state.role,
-                                datetime.datetime.now().isoformat(), 'Debit'
-                            ))
-                            
-                            # Deduct from main account and department
-                            c.execute("UPDATE main_account SET balance = balance - ?", (total_amount,))
-                            c.execute("UPDATE departments SET balance = balance - ? WHERE id = ?",
-                                     (amount, st.session_state.department_id))
-                            
-                            # Insert transaction for audit trail
-                            transaction_id = str(uuid.uuid4())[:8]
-                            c.execute("""
-                            INSERT INTO transactions (
-                                id, ref_number, transaction_date, value_date, narration,
-                                debit_amount, credit_amount, tax_percentage, tax_amount,
-                                type, debit_type, created_by, created_at, account_name
-                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                            """, (
-                                transaction_id, ref_number, value_date.isoformat(), value_date.isoformat(),
-                                f"Investment: {account_name}", amount, 0.0, tax_percentage, tax_amount,
-                                'Debit', 'Investment', st.session_state.role,
-                                datetime.datetime.now().isoformat(), account_name
-                            ))
-                            
-                            st.success("Investment submitted successfully! Awaiting allocation by admin.")
-                            
-                            deal_note = f"""
-                            Deal Note
-                            
-                            Account Name: {account_name}
-                            Reference Number: {ref_number}
-                            Date of Investment: {value_date}
-                            Currency: {currency}
-                            Period: {period} days
-                            Value Date: {value_date}
-                            Interest Rate: {interest_rate:.2f}%
-                            Maturity Date: {maturity_date}
-                            Investment Amount: ${amount:,.2f}
-                            Tax Percentage: ${tax_percentage:.2f}
-                            Tax Amount: ${tax_amount:,.2f}
-                            Interest: ${interest:,.2f}
-                            Withholding Tax: ${withholding_tax:,.2f}
-                            Maturity Amount: ${maturity_amount:,.2f}
-                            """
-                            
-                            st.download_button(
-                                label="Download Deal Note",
-                                data=deal_note,
-                                file_name=f"deal_note_{ref_number}.txt",
-                                mime="text/plain"
-                            )
-                    except Exception as e:
-                        st.error(f"Error processing investment: {str(e)}")
-                        conn.rollback()
+                    deal_note = f"""
+                    Deal Note
+                    
+                    Account Name: {account_name}
+                    Reference Number: {ref_number}
+                    Date of Investment: {terms.value_date}
+                    Currency: {currency}
+                    Period: {terms.period} days
+                    Value Date: {terms.value_date}
+                    Interest Rate: {terms.interest_rate:.2f}%
+                    Maturity Date: {terms.maturity_date}
+                    Investment Amount: {format_money(amount)}
+                    Tax Percentage: ${tax_percentage:.2f}
+                    Tax Amount: {format_money(tax_amount)}
+                    Interest: {format_money(terms.interest)}
+                    Withholding Tax: {format_money(terms.withholding_tax)}
+                    Maturity Amount: {format_money(terms.tax_maturity_value)}
+                    """
+                    
+                    st.download_button(
+                        label="Download Deal Note",
+                        data=deal_note,
+                        file_name=f"deal_note_{ref_number}.txt",
+                        mime="text/plain"
+                    )
         
-        st.markdown('<div class="section-header">View Active Investments</div>', unsafe_allow_html=True)
+        section_header("View Active Investments")
         if st.button("View Active Investments"):
             c.execute("""
             SELECT ref_number, account_name, currency, amount, value_date, period, maturity_date
@@ -1494,12 +1408,13 @@ def main():
             if investments:
                 df = pd.DataFrame(investments,
                                 columns=['Ref', 'Account', 'Currency', 'Amount', 'Value Date', 'Period', 'Maturity'])
+                df = dollar_columns(df, 'Amount')
                 st.markdown(f'<div class="card">Total: {len(investments)}</div>', unsafe_allow_html=True)
                 st.dataframe(df)
             else:
                 st.info("No active investments.")
         
-        st.markdown('<div class="section-header">Investment History</div>', unsafe_allow_html=True)
+        section_header("Investment History")
         c.execute("""
         SELECT ref_number, account_name, currency, amount, period, value_date, maturity_date
         FROM investments
@@ -1511,20 +1426,21 @@ def main():
         if history:
             df = pd.DataFrame(history,
                             columns=['Ref', 'Account', 'Currency', 'Amount', 'Period', 'Value Date', 'Maturity'])
+            df = dollar_columns(df, 'Amount')
             st.dataframe(df)
         else:
             st.info("No investment history.")
     
     elif selected == "Reconciliation" and st.session_state.role == "admin":
-        st.markdown('<div class="section-header">Reconciliation</div>', unsafe_allow_html=True)
+        section_header("Reconciliation")
         
         with st.form("reconciliation_form"):
             accounts = ['Main Account']
-            departments = pd.read_sql("SELECT name FROM departments", conn)
+            departments = cached_read_sql("SELECT name FROM departments", conn, ('departments',))
             accounts.extend(dept for dept in departments['name'])
             selected_account = st.selectbox("Select Account", accounts)
             
-            statements = pd.read_sql("SELECT id, filename, upload_date FROM statements ORDER BY upload_date DESC", conn)
+            statements = cached_read_sql("SELECT id, filename, upload_date FROM statements ORDER BY upload_date DESC", conn, ('statements',))
             statement_id = None
             
             if not statements.empty:
@@ -1534,71 +1450,12 @@ def main():
             
             if st.form_submit_button("Reconcile"):
                 if statement_id:
-                    transactions = pd.read_sql("""
-                    SELECT ref_number, transaction_date, narration, debit_amount, credit_amount,
-                           tax_percentage, tax_amount, account_name
-                    FROM transactions
-                    WHERE statement_id = ? AND account_name = ?
-                    ORDER BY transaction_date DESC
-                    """, conn, params=(statement_id, selected_account if selected_account != 'Main Account' else account_options[0]))
+                    discrepancies = reconcile_statement(
+                        conn, statement_id, selected_account if selected_account != 'Main Account' else account_options[0])
                     
-                    if not transactions.empty:
-                        tax_rates = pd.read_sql("SELECT description, rate FROM taxes_tariffs", conn)
-                        discrepancies = []
-                        
-                        for _, trans in transactions.iterrows():
-                            amount = trans['debit_amount'] if trans['debit_amount'] > 0 else trans['credit_amount']
-                            expected_tax = 0.0
-                            tax_applied = "Transaction Tax"
-                            
-                            # Check tax based on tax_percentage
-                            if trans['tax_percentage'] > 0:
-                                expected_tax = amount * (trans['tax_percentage'] / 100)
-                            
-                            # Override with taxes_tariffs if narration matches
-                            for _, tax in tax_rates.iterrows():
-                                if tax['description'].lower() in trans['narration'].lower():
-                                    expected_tax = amount * (tax['rate'] / 100)
-                                    tax_applied = tax['description']
-                                    break
-                            
-                            tax_diff = trans['tax_amount'] - expected_tax
-                            
-                            # Additional validations
-                            is_invalid = False
-                            error_reason = []
-                            
-                            if abs(tax_diff) > 0.01:
-                                error_reason.append("Tax mismatch")
-                            
-                            if trans['debit_amount'] > 0 and trans['credit_amount'] > 0:
-                                error_reason.append("Both debit and credit amounts")
-                                is_invalid = True
-                            
-                            if trans['debit_amount'] == 0 and trans['credit_amount'] == 0:
-                                error_reason.append("No debit or credit amount")
-                                is_invalid = True
-                            
-                            if not trans['narration'].strip():
-                                error_reason.append("Empty narration")
-                                is_invalid = True
-                            
-                            if is_invalid or abs(tax_diff) > 0.01:
-                                discrepancies.append({
-                                    'ref': trans['ref_number'],
-                                    'date': trans['transaction_date'],
-                                    'narration': trans['narration'],
-                                    'debit': trans['debit_amount'],
-                                    'credit': trans['credit_amount'],
-                                    'actual_tax': trans['tax_amount'],
-                                    'expected_tax': expected_tax,
-                                    'tax_diff': tax_diff,
-                                    'tax_applied': tax_applied,
-                                    'error_reason': '; '.join(error_reason)
-                                })
-                        
-                        if discrepancies:
-                            df = pd.DataFrame(discrepancies)
+                    if discrepancies is not None:
+                        if not discrepancies.empty:
+                            df = dollar_columns(discrepancies, *MONEY_REPORT_COLUMNS)
                             st.warning(f"Found {len(discrepancies)} discrepancies for {selected_account}")
                             st.dataframe(df)
                             
@@ -1615,11 +1472,50 @@ def main():
                         st.warning("No transactions found for the selected statement and account.")
                 else:
                     st.error("No statements available for reconciliation.")
+        
+        section_header("Batch Reconciliation")
+        with st.form("batch_reconciliation_form"):
+            limit_dates = st.checkbox("Limit to a transaction date range")
+            col1, col2 = st.columns(2)
+            with col1:
+                batch_start = st.date_input("From", key="batch_recon_start")
+            with col2:
+                batch_end = st.date_input("To", key="batch_recon_end")
+            
+            if st.form_submit_button("Reconcile All Statements and Accounts"):
+                if limit_dates and batch_start > batch_end:
+                    st.error("Start date must be before or equal to end date.")
+                else:
+                    with st.spinner("Reconciling..."):
+                        summary, report = reconcile_batch(
+                            conn, db_path=shared_database_path(),
+                            start_date=batch_start.isoformat() if limit_dates else None,
+                            end_date=batch_end.isoformat() if limit_dates else None)
+                    
+                    if summary.empty:
+                        st.warning("No statement transactions found to reconcile.")
+                    else:
+                        summary = dollar_columns(summary, *MONEY_SUMMARY_COLUMNS)
+                        report = dollar_columns(report, *MONEY_REPORT_COLUMNS)
+                        st.markdown(f"**{len(summary)} statement/account pairs, "
+                                    f"{int(summary['discrepancies'].sum()):,} discrepancies**")
+                        st.dataframe(summary)
+                        
+                        if not report.empty:
+                            st.dataframe(report)
+                            st.download_button(
+                                label="Download Consolidated Discrepancy Report",
+                                data=report.to_csv(index=False),
+                                file_name="reconciliation_discrepancies_batch.csv",
+                                mime="text/csv"
+                            )
+                        else:
+                            st.success("No discrepancies found in any statement.")
     
     elif selected == "Tariff & Tax" and st.session_state.role == "admin":
-        st.markdown('<div class="section-header">Tariff Management</div>', unsafe_allow_html=True)
+        section_header("Tariff Management")
         
-        st.markdown('<div class="section-header">Bank Tariffs</div>', unsafe_allow_html=True)
+        section_header("Bank Tariffs")
         with st.expander("Upload Tariff Guide"):
             with st.form("tariff_form"):
                 bank_name = st.text_input("Bank Name")
@@ -1628,88 +1524,80 @@ def main():
                 if st.form_submit_button("Upload"):
                     if bank_name and uploaded_file:
                         try:
-                            file_data = uploaded_file.read()
-                            c.execute("""
-                            INSERT INTO bank_tariff_guides (
-                                bank_name, document_name, document_data, upload_date, created_by, created_at
-                            ) VALUES (?, ?, ?, ?, ?, ?)
-                            """, (
-                                bank_name, uploaded_file.name, file_data,
-                                datetime.datetime.now().isoformat(), st.session_state.role,
-                                datetime.datetime.now().isoformat()
-                            ))
-                            conn.commit()
+                            upload_tariff(conn, bank_name, uploaded_file.name, uploaded_file.getvalue(),
+                                          st.session_state.role)
+                            audit_event("tariff.upload", "tariff", uploaded_file.name, bank_name=bank_name)
                             st.success("Tariff uploaded!")
                         except Exception as e:
                             st.error(f"Error uploading: {str(e)}")
                     else:
                         st.warning("Provide bank name and file.")
         
-        st.markdown('<div class="section-header">Available Tariffs</div>', unsafe_allow_html=True)
-        tariffs = pd.read_sql("""
-        SELECT id, bank_name, document_name, upload_date
+        section_header("Available Tariffs")
+        tariffs = cached_read_sql("""
+        SELECT id, bank_name, document_name, content_hash, size_bytes, upload_date
         FROM bank_tariff_guides
         ORDER BY upload_date DESC
-        """, conn)
+        """, conn, ('bank_tariff_guides',))
         
         if not tariffs.empty:
+            store = get_store()
             for _, row in tariffs.iterrows():
                 with st.container():
                     col1, col2 = st.columns([3,1])
                     with col1:
-                        st.markdown(f"**{row['bank_name']}** - {row['document_name']} ({row['upload_date']})")
+                        st.markdown(f"**{row['bank_name']}** - {row['document_name']} "
+                                    f"({row['upload_date']}, {row['size_bytes'] / 1024:,.0f} KB)")
                     with col2:
-                        doc_data = c.execute("SELECT document_data FROM bank_tariff_guides WHERE id = ?", (row['id'],)).fetchone()[0]
-                        st.download_button(
-                            label="Download",
-                            data=doc_data,
-                            file_name=row['document_name'],
-                            mime="application/pdf"
-                        )
+                        if store.exists(row['content_hash']):
+                            # Bytes are read from the store only when the button is clicked
+                            st.download_button(
+                                label="Download",
+                                data=lambda digest=row['content_hash']: store.read(digest),
+                                file_name=row['document_name'],
+                                mime="application/pdf",
+                                key=f"tariff_download_{row['id']}"
+                            )
+                        else:
+                            st.warning("File missing")
         else:
             st.info("No tariffs available.")
         
-        st.markdown('<div class="section-header">Manage Taxes</div>', unsafe_allow_html=True)
+        section_header("Manage Taxes")
         with st.form("tax_form"):
             desc = st.text_input("Description")
             rate = st.number_input("Rate (%)", min_value=0.0, max_value=100.0)
             
             if st.form_submit_button("Add"):
-                if not desc.strip():
-                    st.error("Description required.")
+                try:
+                    add_tax(conn, desc, rate, st.session_state.role)
+                except TreasuryError as e:
+                    st.error(str(e))
+                except Exception as e:
+                    st.error(f"Error adding: {str(e)}")
                 else:
-                    try:
-                        c.execute("""
-                        INSERT INTO taxes_tariffs (
-                            description, rate, created_by, created_at
-                        ) VALUES (?, ?, ?, ?)
-                        """, (
-                            desc, rate, st.session_state.role, datetime.datetime.now().isoformat()
-                        ))
-                        conn.commit()
-                        st.success("Tax added!")
-                    except Exception as e:
-                        st.error(f"Error adding: {str(e)}")
+                    audit_event("tax.add", "tax", desc, rate=rate)
+                    st.success("Tax added!")
         
-        st.markdown('<div class="section-header">Current Taxes</div>', unsafe_allow_html=True)
-        taxes = pd.read_sql("""
+        section_header("Current Taxes")
+        taxes = cached_read_sql("""
         SELECT description, rate, created_at
         FROM taxes_tariffs
         ORDER BY created_at DESC
-        """, conn)
+        """, conn, ('taxes_tariffs',))
         
         if not taxes.empty:
             st.dataframe(taxes)
         else:
             st.info("No taxes defined.")
         
-        st.markdown('<div class="section-header">Verify Taxes</div>', unsafe_allow_html=True)
-        statements = pd.read_sql("""
+        section_header("Verify Taxes")
+        statements = cached_read_sql("""
         SELECT id, filename, upload_date
         FROM statements
         ORDER BY upload_date DESC
         LIMIT 1
-        """, conn)
+        """, conn, ('statements',))
         
         if not statements.empty:
             statement_id = statements['id'].iloc[0]
@@ -1718,56 +1606,17 @@ def main():
             
             st.markdown(f"**Verifying Latest Statement: {filename} (Uploaded: {upload_date})**", unsafe_allow_html=True)
             
-            transactions = pd.read_sql("""
-            SELECT ref_number, transaction_date, narration,
-                   debit_amount, credit_amount, tax_percentage, tax_amount
-            FROM transactions
-            WHERE statement_id = ?
-            ORDER BY transaction_date DESC
-            """, conn, params=(statement_id,))
+            discrepancies = verify_statement_taxes(conn, statement_id)
+            if discrepancies is not None:
+                discrepancies = dollar_columns(discrepancies, 'debit_amount', 'credit_amount', 'tax_amount',
+                                               'expected_tax', 'tax_diff')
             
-            if not transactions.empty:
-                tax_rates = pd.read_sql("SELECT description, rate FROM taxes_tariffs", conn)
-                
-                transactions['expected_tax'] = 0.0
-                transactions['tax_diff'] = 0.0
-                transactions['tax_applied'] = ""
-                
-                for idx, row in transactions.iterrows():
-                    amount = row['debit_amount'] if row['debit_amount'] > 0 else row['credit_amount']
-                    matched = False
-                    
-                    for _, tax in tax_rates.iterrows():
-                        if tax['description'].lower() in row['narration'].lower():
-                            expected_tax = amount * (tax['rate'] / 100)
-                            transactions.at[idx, 'expected_tax'] = expected_tax
-                            transactions.at[idx, 'tax_diff'] = row['tax_amount'] - expected_tax
-                            transactions.at[idx, 'tax_applied'] = tax['description']
-                            matched = True
-                            break
-                    
-                    if not matched and row['tax_percentage'] > 0:
-                        expected_tax = amount * (row['tax_percentage'] / 100)
-                        transactions.at[idx, 'expected_tax'] = expected_tax
-                        transactions.at[idx, 'tax_diff'] = row['tax_amount'] - expected_tax
-                        transactions.at[idx, 'tax_applied'] = "Transaction Tax"
-                
-                tolerance = 0.01
-                discrepancies = transactions[abs(transactions['tax_diff']) > tolerance]
-                
+            if discrepancies is not None:
                 if not discrepancies.empty:
                     st.warning(f"Found {len(discrepancies)} tax discrepancies in '{filename}'")
-                    st.dataframe(discrepancies[[
-                        'ref_number', 'transaction_date', 'narration',
-                        'debit_amount', 'credit_amount', 'tax_amount',
-                        'expected_tax', 'tax_diff', 'tax_applied'
-                    ]])
+                    st.dataframe(discrepancies)
                     
-                    csv = discrepancies[[
-                        'ref_number', 'transaction_date', 'narration',
-                        'debit_amount', 'credit_amount', 'tax_amount',
-                        'expected_tax', 'tax_diff'
-                    ]].to_csv(index=False)
+                    csv = discrepancies.drop(columns='tax_applied').to_csv(index=False)
                     
                     st.download_button(
                         label="Download Discrepancy Report",
@@ -1783,58 +1632,151 @@ def main():
             st.info("No statements available.")
     
     elif selected == "User Management" and st.session_state.role == "admin":
-        st.markdown('<div class="section-header">User Management</div>', unsafe_allow_html=True)
+        section_header("User Management")
         
         with st.form("add_dept"):
             dept_name = st.text_input("Department Name")
             
             if st.form_submit_button("Add"):
-                if not dept_name.strip():
-                    st.error("Name required.")
+                try:
+                    add_department(conn, dept_name, st.session_state.role)
+                except TreasuryError as e:
+                    st.error(str(e))
                 else:
-                    try:
-                        c.execute("""
-                        INSERT INTO departments (
-                            id, name, balance, created_by, created_at
-                        ) VALUES (?, ?, ?, ?, ?)
-                        """, (
-                            str(uuid.uuid4())[:8], dept_name, '0.0',
-                            st.session_state.role, datetime.datetime.now().isoformat()
-                        ))
-                        conn.commit()
-                        st.success("Department added!")
-                    except sqlite3.IntegrityError as e:
-                        st.error(f"Error: {str(e)}")
+                    audit_event("department.add", "department", dept_name)
+                    st.success("Department added!")
         
         with st.form("add_user"):
             username = st.text_input("Username")
             password = st.text_input("Password", type="password")
             
-            depts = pd.read_sql("SELECT id, name FROM departments WHERE name IS NOT NULL ORDER BY name", conn)
+            depts = cached_read_sql("SELECT id, name FROM departments WHERE name IS NOT NULL ORDER BY name", conn, ('departments',))
             dept_id = st.selectbox("Department", depts.set_index('id')['name'])
             
             role = st.selectbox("Role", ["user", "admin"])
             
             if st.form_submit_button("Add"):
-                if not username.strip() or not password.strip():
-                    st.error("Username and password required.")
+                try:
+                    add_user(conn, username, password, role, dept_id, st.session_state.role)
+                except TreasuryError as e:
+                    st.error(str(e))
                 else:
-                    try:
-                        c.execute("""
-                        INSERT INTO users (
-                            username, password, role, department_id, created_by, created_at
-                        ) VALUES (?, ?, ?, ?, ?, ?)
-                        """, (
-                            username, hashlib.sha256(password.encode('utf-8')).hexdigest(),
-                            role, dept_id, st.session_state.role,
-                            datetime.datetime.now().isoformat()
-                        ))
-                        conn.commit()
-                        st.success("User added!")
-                    except sqlite3.IntegrityError as e:
-                        st.error(f"Error: {str(e)}")
+                    audit_event("user.add", "user", username, role=role, department_id=dept_id)
+                    st.success("User added!")
+    
+    elif selected == "Audit Log" and st.session_state.role == "admin":
+        section_header("Audit Log")
+        # Show events still waiting in the background writer's buffer
+        get_audit_writer().flush()
+        
+        audit_users, audit_actions = audit_filter_options(conn)
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            audit_user = st.selectbox("User", ["All"] + audit_users)
+        with col2:
+            audit_action = st.selectbox("Action", ["All"] + audit_actions)
+        with col3:
+            audit_start = st.date_input("From", value=None, key="audit_start")
+        with col4:
+            audit_end = st.date_input("To", value=None, key="audit_end")
+        
+        audit_filter = dict(
+            username=None if audit_user == "All" else audit_user,
+            action=None if audit_action == "All" else audit_action,
+            start=audit_start.isoformat() if audit_start else None,
+            end=audit_end.isoformat() if audit_end else None,
+        )
+        if st.session_state.get('audit_filter') != audit_filter:
+            st.session_state.audit_filter = audit_filter
+            st.session_state.audit_cursors = [None]
+        cursors = st.session_state.audit_cursors
+        
+        total_events = count_audit_events(conn, **audit_filter)
+        events, next_cursor = query_audit_events(conn, after=cursors[-1], **audit_filter)
+        if not events.empty:
+            st.dataframe(events, hide_index=True)
+        else:
+            st.info("No audit events match the filters.")
+        
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            if st.button("Previous", disabled=len(cursors) == 1):
+                cursors.pop()
+                st.rerun()
+        with col2:
+            st.caption(f"Page {len(cursors):,} of {max(1, -(-total_events // AUDIT_PAGE_SIZE)):,} "
+                       f"({total_events:,} events)")
+        with col3:
+            if st.button("Next", disabled=next_cursor is None):
+                cursors.append(next_cursor)
+                st.rerun()
     
-    conn.close()
+    elif selected == "Performance" and st.session_state.role == "admin":
+        section_header("Performance")
+        profiler = get_profiler()
+        if not profiler.enabled:
+            st.info("Profiling is switched off (TREASURY_PROFILE=0).")
+            return
+        
+        windows = {"Last 5 minutes": 300, "Last 15 minutes": 900, "Last hour": 3600, "Everything buffered": None}
+        col1, col2, col3 = st.columns([2, 2, 1])
+        with col1:
+            window = windows[st.selectbox("Window", list(windows), index=1)]
+        samples = profiler.samples(window)
+        with col2:
+            perf_page = st.selectbox("Page", ["All"] + sorted(samples['page'].unique()))
+        with col3:
+            if st.button("Clear Samples"):
+                profiler.clear()
+                st.rerun()
+        perf_page = None if perf_page == "All" else perf_page
+        
+        queries = samples[samples['kind'] == 'query']
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Samples Buffered", f"{len(profiler):,} / {profiler.capacity:,}")
+        col2.metric("Statements in Window", f"{len(queries):,}")
+        col3.metric("SQL Time in Window", f"{queries['duration'].sum():,.2f}s")
+        
+        section_header("Slowest Sections")
+        sections = profiler.summary('section', window, perf_page, limit=50)
+        if not sections.empty:
+            st.caption(f"Milliseconds per page section; {PAGE_TOTAL} is a whole script run of the page.")
+            st.dataframe(sections.drop(columns=['mean_rows']).round(2), hide_index=True)
+        else:
+            st.info("No page sections recorded in this window.")
+        
+        section_header("Slowest Queries")
+        slow_queries = profiler.summary('query', window, perf_page, limit=50)
+        if not slow_queries.empty:
+            st.dataframe(slow_queries.round(2), hide_index=True)
+        else:
+            st.info("No SQL statements recorded in this window.")
+        
+        with st.expander("Slowest Individual Statements"):
+            statements = profiler.samples(window, 'query', perf_page).nlargest(50, 'duration')
+            statements = statements.assign(
+                at=pd.to_datetime(statements['at'], unit='s').dt.strftime('%H:%M:%S'),
+                duration_ms=(statements['duration'] * 1000).round(2))
+            st.dataframe(statements[['at', 'page', 'duration_ms', 'rows', 'params', 'name']], hide_index=True)
+        
+        section_header("Slow Query Log")
+        slow_log = get_slow_query_log()
+        if slow_log.threshold_ms <= 0:
+            st.info("The slow query log is switched off (TREASURY_SLOW_QUERY_MS=0).")
+        else:
+            st.caption(f"Statements over {slow_log.threshold_ms:,.0f} ms are written to {slow_log.path} "
+                       f"with their query plan; the advisor's latest findings are shown per statement.")
+            since = None if window is None else datetime.datetime.now() - timedelta(seconds=window)
+            advice = advisor_report(read_log(since=since.isoformat(timespec='seconds') if since else None))
+            if not advice.empty:
+                st.dataframe(advice, hide_index=True)
+                suggestions = sorted({line for text in advice['suggestions'] for line in text.split('\n') if line})
+                if suggestions:
+                    st.markdown("**Suggested indexes**")
+                    st.code(";\n".join(suggestions) + ";", language="sql")
+            else:
+                st.info("No slow queries logged in this window.")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,187 @@
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+
+import pandas as pd
+
+AUDIT_PAGE_SIZE = 50
+
+# Events written per INSERT batch, and the longest an event waits in memory
+FLUSH_BATCH = int(os.environ.get('TREASURY_AUDIT_BATCH', 500))
+FLUSH_INTERVAL = float(os.environ.get('TREASURY_AUDIT_FLUSH_SECONDS', 1.0))
+
+SYSTEM_USER_ID = 0
+
+
+class AuditWriter:
+    """Buffers audit events in memory and writes them in batches from a thread.
+
+    ``record`` only enqueues, so write paths never wait on the audit table.
+    ``flush`` blocks until everything recorded so far is committed, and
+    ``close`` (registered at exit) flushes before the process ends.
+    """
+
+    def __init__(self, batch_size=FLUSH_BATCH, interval=FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.written = 0
+        self.failed = 0
+        self.last_error = None
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+                    self._thread.start()
+
+    def record(self, action, user_id=None, username=None, role=None,
+               entity_type=None, entity_id=None, **details):
+        if self._closed:
+            return
+        self._queue.put((
+            action, SYSTEM_USER_ID if user_id is None else int(user_id), username or 'system', role,
+            entity_type, None if entity_id is None else str(entity_id),
+            json.dumps(details, default=str) if details else None,
+            datetime.datetime.now().isoformat(),
+        ))
+        self._ensure_thread()
+
+    def _drain(self, first):
+        batch, markers = [], []
+        item = first
+        while True:
+            if isinstance(item, threading.Event):
+                markers.append(item)
+            elif item is not None:
+                batch.append(item)
+            if len(batch) >= self.batch_size:
+                break
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+        return batch, markers
+
+    def _write(self, batch):
+        from database import get_connection
+
+        try:
+            with get_connection() as conn:
+                with conn:
+                    conn.executemany("""
+                    INSERT INTO audit_logs (
+                        action, user_id, username, role, entity_type, entity_id, details, created_at
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """, batch)
+            self.written += len(batch)
+        except Exception as e:
+            # Auditing must never take down the app; keep count and move on
+            self.failed += len(batch)
+            self.last_error = e
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.interval)
+            except queue.Empty:
+                if self._closed:
+                    return
+                continue
+            batch, markers = self._drain(first)
+            if batch:
+                self._write(batch)
+            for marker in markers:
+                marker.set()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def flush(self, timeout=5.0):
+        """Wait until every event recorded before this call is written."""
+        if self._thread is None:
+            return True
+        marker = threading.Event()
+        self._queue.put(marker)
+        self._ensure_thread()
+        return marker.wait(timeout)
+
+    def close(self, timeout=5.0):
+        self.flush(timeout)
+        self._closed = True
+
+
+_writer = AuditWriter()
+atexit.register(_writer.close)
+
+
+def get_audit_writer():
+    return _writer
+
+
+def record_audit(action, **fields):
+    """Queue an audit event; see ``AuditWriter.record``."""
+    _writer.record(action, **fields)
+
+
+def _filters(username=None, action=None, start=None, end=None):
+    clauses, params = [], []
+    if username:
+        clauses.append("username = ?")
+        params.append(username)
+    if action:
+        clauses.append("action = ?")
+        params.append(action)
+    if start:
+        clauses.append("created_at >= ?")
+        params.append(str(start))
+    if end:
+        clauses.append("created_at < date(?, '+1 day')")
+        params.append(str(end))
+    return clauses, params
+
+
+def query_audit_events(conn, username=None, action=None, start=None, end=None, after=None,
+                       page_size=AUDIT_PAGE_SIZE):
+    """One page of audit events, newest first, with a ``(created_at, id)`` keyset cursor.
+
+    Returns ``(page, cursor)``; ``cursor`` is None on the last page.
+    """
+    clauses, params = _filters(username, action, start, end)
+    if after is not None:
+        clauses.append("(created_at, id) < (?, ?)")
+        params.extend(after)
+    where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+    page = pd.read_sql(f"""
+    SELECT id, created_at, username, role, action, entity_type, entity_id, details
+    FROM audit_logs
+    {where}
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+    """, conn, params=params + [page_size + 1])
+    cursor = None
+    if len(page) > page_size:
+        page = page.iloc[:page_size]
+        cursor = (page['created_at'].iloc[-1], int(page['id'].iloc[-1]))
+    return page, cursor
+
+
+def count_audit_events(conn, username=None, action=None, start=None, end=None):
+    clauses, params = _filters(username, action, start, end)
+    where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+    return conn.execute(f"SELECT COUNT(*) FROM audit_logs {where}", params).fetchone()[0]
+
+
+def audit_filter_options(conn):
+    """Distinct usernames and actions for the viewer's filters."""
+    users = [row[0] for row in conn.execute(
+        "SELECT DISTINCT username FROM audit_logs WHERE username IS NOT NULL ORDER BY username")]
+    actions = [row[0] for row in conn.execute("SELECT DISTINCT action FROM audit_logs ORDER BY action")]
+    return users, actions
@@ -0,0 +1,188 @@
+import datetime
+import functools
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from allocation import allocate_batch
+from query_cache import bump_generation, cached_read_sql
+from tax_rules import STRING_DTYPE
+
+# Pending allocations eligible for automatic assignment; investment legs are
+# allocated from the Investments page and never auto-allocated
+PENDING_SQL = """
+SELECT a.id, a.amount, a.transaction_type, t.narration, t.account_name
+FROM allocations a
+JOIN transactions t ON a.treasury_ref = t.ref_number
+WHERE a.department_id IS NULL
+AND (a.transaction_type = 'Credit' OR
+     (a.transaction_type = 'Debit' AND t.debit_type != 'Investment'))
+AND t.credit_type != 'Credit Investments'
+"""
+
+
+class AllocationRuleSet:
+    """Compiled allocation rules, matched over a whole statement at once.
+
+    Rules are tried in priority order (lowest first, then id) and the first
+    rule whose every condition holds wins. A condition left empty matches
+    anything. Narration patterns are case-insensitive substrings, scanned
+    once per distinct narration as in ``TaxRuleMatcher``.
+    """
+
+    def __init__(self, rules, splits):
+        # rules: (id, name, pattern, account_name, transaction_type, min_amount, max_amount) in priority order
+        self.rules = list(rules)
+        self.ids = [rule[0] for rule in self.rules]
+        self.names = [rule[1] for rule in self.rules]
+        self.splits = {rule_id: [] for rule_id in self.ids}
+        for rule_id, department_id, share in splits:
+            if rule_id in self.splits:
+                self.splits[rule_id].append((department_id, float(share)))
+
+    def match(self, pending):
+        """Return the index of the first matching rule per row (-1 if none)."""
+        first_rule = np.full(len(pending), -1, dtype=np.int64)
+        if not self.rules or pending.empty:
+            return first_rule
+        codes, uniques = pd.factorize(pending['narration'].fillna('').astype(str).str.lower())
+        uniques = pd.Series(uniques, dtype=STRING_DTYPE)
+        account = pending['account_name'].fillna('').to_numpy(dtype=object)
+        transaction_type = pending['transaction_type'].fillna('').to_numpy(dtype=object)
+        amount = pending['amount'].to_numpy(dtype=np.int64)
+
+        # Scan in reverse so higher-priority rules overwrite lower ones
+        for index in range(len(self.rules) - 1, -1, -1):
+            _, _, pattern, account_name, rule_type, min_amount, max_amount = self.rules[index]
+            if not self.splits[self.ids[index]]:
+                continue
+            hits = np.ones(len(pending), dtype=bool)
+            if pattern:
+                hits &= uniques.str.contains(pattern.lower(), regex=False).to_numpy(dtype=bool)[codes]
+            if account_name:
+                hits &= account == account_name
+            if rule_type:
+                hits &= transaction_type == rule_type
+            if min_amount is not None and not pd.isna(min_amount):
+                hits &= amount >= min_amount
+            if max_amount is not None and not pd.isna(max_amount):
+                hits &= amount <= max_amount
+            first_rule[hits] = index
+        return first_rule
+
+    def split_amount(self, index, amount):
+        """Department cents for ``amount`` cents under rule ``index``; the remainder goes to the last share."""
+        shares = self.splits[self.ids[index]]
+        total_share = sum(share for _, share in shares)
+        parts = {department_id: round(amount * share / total_share) for department_id, share in shares[:-1]}
+        parts[shares[-1][0]] = parts.get(shares[-1][0], 0) + amount - sum(parts.values())
+        return parts
+
+
+@functools.lru_cache(maxsize=8)
+def compile_rules(rules, splits):
+    return AllocationRuleSet(rules, splits)
+
+
+def load_rule_set(conn):
+    rules = cached_read_sql("""
+    SELECT id, name, narration_pattern, account_name, transaction_type, min_amount, max_amount
+    FROM allocation_rules
+    WHERE active = 1
+    ORDER BY priority, id
+    """, conn, ('allocation_rules',))
+    splits = cached_read_sql("""
+    SELECT rule_id, department_id, share FROM allocation_rule_splits ORDER BY rule_id, department_id
+    """, conn, ('allocation_rule_splits',))
+    rules = rules.astype(object).where(rules.notna(), None)
+    return compile_rules(tuple(map(tuple, rules.itertuples(index=False, name=None))),
+                         tuple(splits.itertuples(index=False, name=None)))
+
+
+def save_rule(conn, name, shares, created_by, narration_pattern=None, account_name=None,
+              transaction_type=None, min_amount=None, max_amount=None, priority=100):
+    """Add a rule; ``shares`` maps department_id to its percentage of the amount (summing to 100).
+
+    ``min_amount`` and ``max_amount`` are in cents.
+    """
+    shares = {department_id: float(share) for department_id, share in shares.items() if share}
+    if not shares or abs(sum(shares.values()) - 100) > 0.001:
+        raise ValueError("Department shares must add up to 100%")
+    c = conn.cursor()
+    with conn:
+        c.execute("""
+        INSERT INTO allocation_rules (
+            name, narration_pattern, account_name, transaction_type, min_amount, max_amount,
+            priority, created_by, created_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (name, narration_pattern or None, account_name or None, transaction_type or None,
+              min_amount, max_amount, priority, created_by, datetime.datetime.now().isoformat()))
+        rule_id = c.lastrowid
+        c.executemany("INSERT INTO allocation_rule_splits (rule_id, department_id, share) VALUES (?, ?, ?)",
+                      [(rule_id, department_id, share) for department_id, share in shares.items()])
+        bump_generation(c, 'allocation_rules', 'allocation_rule_splits')
+    return rule_id
+
+
+def delete_rule(conn, rule_id):
+    c = conn.cursor()
+    with conn:
+        c.execute("DELETE FROM allocation_rule_splits WHERE rule_id = ?", (rule_id,))
+        c.execute("DELETE FROM allocation_rules WHERE id = ?", (rule_id,))
+        bump_generation(c, 'allocation_rules', 'allocation_rule_splits')
+
+
+@dataclass
+class AutoAllocationResult:
+    pending: int = 0
+    matched: int = 0
+    allocated: int = 0
+    failures: dict = field(default_factory=dict)
+    by_rule: pd.DataFrame = None
+    dry_run: bool = False
+    elapsed: float = 0.0
+
+    @property
+    def match_rate(self):
+        return self.matched / self.pending if self.pending else 0.0
+
+
+def auto_allocate(conn, statement_id=None, dry_run=False, created_by='system'):
+    """Apply the active allocation rules to pending allocations.
+
+    Limited to one statement when ``statement_id`` is given. Matched rows are
+    allocated in bulk through ``allocate_batch``; unmatched rows stay pending.
+    With ``dry_run`` nothing is written and the result only reports what each
+    rule would match.
+    """
+    started = time.perf_counter()
+    rule_set = load_rule_set(conn)
+    sql, params = PENDING_SQL, ()
+    if statement_id is not None:
+        sql, params = sql + " AND t.statement_id = ?", (statement_id,)
+    pending = pd.read_sql(sql, conn, params=params)
+
+    rule = rule_set.match(pending)
+    matched = rule >= 0
+    names = np.array(rule_set.names + [''], dtype=object)
+    by_rule = (pending.loc[matched, ['amount']]
+               .assign(rule=names[rule[matched]])
+               .groupby('rule', sort=False)['amount'].agg(['count', 'sum'])
+               .rename(columns={'count': 'matched', 'sum': 'amount'})
+               .reset_index())
+    result = AutoAllocationResult(pending=len(pending), matched=int(matched.sum()),
+                                  by_rule=by_rule, dry_run=dry_run)
+
+    if not dry_run and result.matched:
+        ids = pending['id'].to_numpy()[matched]
+        amounts = pending['amount'].to_numpy(dtype=np.int64)[matched]
+        splits = {allocation_id: rule_set.split_amount(index, int(amount))
+                  for allocation_id, index, amount in zip(ids, rule[matched], amounts)}
+        batch = allocate_batch(conn, splits, created_by)
+        result.allocated = len(batch.allocated)
+        result.failures = batch.failures
+
+    result.elapsed = time.perf_counter() - started
+    return result
@@ -0,0 +1,285 @@
+import argparse
+import fnmatch
+import glob
+import multiprocessing
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from itertools import islice
+
+import pandas as pd
+
+from audit import record_audit
+from ingest import (DUPLICATE_MODES, TEXT_DTYPES, DuplicateRefsError, IngestError, file_digest, find_duplicates,
+                    post_statement, prepare_statement, refresh_details, resolve_duplicates, validate_statement)
+from money import dollar_columns
+from summary import DASHBOARD_ACCOUNTS
+
+# Files parsed ahead of the writer per worker process
+IN_FLIGHT_PER_WORKER = 2
+
+SUMMARY_COLUMNS = ['file', 'account_name', 'status', 'rows', 'total_debit', 'total_credit',
+                   'duplicates', 'updated', 'elapsed', 'statement_id', 'error']
+
+
+@dataclass
+class FileResult:
+    file: str
+    account_name: str = None
+    status: str = 'failed'
+    rows: int = 0
+    total_debit: int = 0
+    total_credit: int = 0
+    duplicates: int = 0
+    updated: int = 0
+    elapsed: float = 0.0
+    statement_id: str = None
+    error: str = None
+
+
+def expand_paths(patterns):
+    """Statement files for directories, globs and plain paths, in order and without repeats."""
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(pattern, '*.csv')))
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def _normalize(name):
+    return ' '.join(re.split(r'[^0-9a-z]+', name.lower())).strip()
+
+
+def load_account_map(path):
+    """``(pattern, account_name)`` pairs from a CSV with those two columns."""
+    mapping = pd.read_csv(path, dtype=str).fillna('')
+    missing = {'pattern', 'account_name'} - set(mapping.columns)
+    if missing:
+        raise IngestError(f"Account map is missing columns: {', '.join(sorted(missing))}")
+    return list(mapping[['pattern', 'account_name']].itertuples(index=False, name=None))
+
+
+def account_for(path, account_map=None, default_account=None, accounts=DASHBOARD_ACCOUNTS):
+    """Resolve the account a statement file belongs to.
+
+    ``account_map`` patterns are matched against the file name first (first
+    match wins), then ``default_account``; otherwise the name must start with
+    a known account, e.g. ``cbz_account_one_2024-06-30.csv``.
+    """
+    filename = os.path.basename(path)
+    for pattern, account_name in account_map or ():
+        if fnmatch.fnmatch(filename, pattern):
+            return account_name
+    if default_account:
+        return default_account
+    stem = _normalize(os.path.splitext(filename)[0])
+    # Longest name first so 'zb account one' never shadows a longer match
+    for account_name in sorted(accounts, key=len, reverse=True):
+        normalized = _normalize(account_name)
+        if stem == normalized or stem.startswith(normalized + ' '):
+            return account_name
+    return None
+
+
+def parse_statement_file(path):
+    """Read and validate one statement; runs in a worker process.
+
+    Returns the validated frame with the file's digest. Raises IngestError
+    for an invalid statement.
+    """
+    started = time.perf_counter()
+    df = pd.read_csv(path, encoding='utf-8-sig', dtype=TEXT_DTYPES)
+    if df.empty:
+        raise IngestError("CSV contains no transactions.")
+    validate_statement(df)
+    return {
+        'frame': df,
+        'file_hash': file_digest(path),
+        'elapsed': time.perf_counter() - started,
+    }
+
+
+def _already_imported(conn, file_hash, account_name):
+    return conn.execute("""
+    SELECT statement_id FROM statement_imports
+    WHERE file_hash = ? AND account_name = ? AND status = 'completed'
+    LIMIT 1
+    """, (file_hash, account_name)).fetchone()
+
+
+def write_parsed(conn, result, parsed, created_by='system', dry_run=False, duplicates='reject'):
+    """Post one parsed file from the single writer; fills in ``result``.
+
+    Ref numbers already posted or repeated in the file, and lines already
+    posted from an overlapping statement, are handled per ``duplicates`` (see ``ingest.resolve_duplicates``); ``result.rows`` is
+    the number of rows posted.
+    """
+    started = time.perf_counter()
+    frame = parsed['frame']
+    result.rows = len(frame)
+    try:
+        imported = _already_imported(conn, parsed['file_hash'], result.account_name)
+        if imported:
+            result.status, result.statement_id = 'skipped', imported[0]
+            result.error = "Already imported"
+            return result
+
+        report = find_duplicates(conn, frame, result.account_name)
+        result.duplicates = len(report)
+        try:
+            frame, updates = resolve_duplicates(frame, report, duplicates)
+        except DuplicateRefsError as e:
+            result.error = str(e)
+            return result
+        result.rows, result.updated = len(frame), len(updates)
+
+        if frame.empty:
+            if updates and not dry_run:
+                with conn:
+                    refresh_details(conn.cursor(), updates)
+            result.status, result.error = 'skipped', "Every line is already posted"
+            return result
+
+        columns = prepare_statement(frame)
+        result.total_debit = columns['total_debit']
+        result.total_credit = columns['total_credit']
+        if dry_run:
+            result.status = 'validated'
+        else:
+            result.statement_id, _ = post_statement(conn, columns, result.account_name,
+                                                    os.path.basename(result.file), created_by,
+                                                    file_hash=parsed['file_hash'], refresh=updates)
+            result.status = 'ingested'
+        return result
+    finally:
+        result.elapsed += time.perf_counter() - started
+
+
+def ingest_files(conn, paths, account_map=None, default_account=None, created_by='system',
+                 workers=None, dry_run=False, progress=None, duplicates='reject'):
+    """Ingest many statement files: parse in parallel, write one file at a time.
+
+    Files are parsed and validated in a process pool while this process, the
+    only writer, checks ref numbers and posts each finished file in path
+    order, one transaction per file. A failing file is reported and does not
+    stop the rest. At most ``IN_FLIGHT_PER_WORKER`` files per worker are
+    parsed ahead of the writer, so parsed frames waiting in this process stay
+    bounded however many files there are. Returns one FileResult per path;
+    ``progress`` is called with each as it completes.
+    """
+    results = [FileResult(file=path, account_name=account_for(path, account_map, default_account))
+               for path in paths]
+    todo = []
+    for result in results:
+        if result.account_name is None:
+            result.error = "No account mapping for file"
+            if progress:
+                progress(result)
+        else:
+            todo.append(result)
+
+    workers = min(workers or os.cpu_count() or 1, max(len(todo), 1))
+    if workers == 1:
+        parsed = (_call(parse_statement_file, result.file) for result in todo)
+        for result, outcome in zip(todo, parsed):
+            _finish(conn, result, outcome, created_by, dry_run, duplicates, progress)
+    else:
+        # spawn: the app process may be multi-threaded, which makes fork unsafe
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            pending = iter(todo)
+            in_flight = deque((result, pool.submit(parse_statement_file, result.file))
+                              for result in islice(pending, workers * IN_FLIGHT_PER_WORKER))
+            while in_flight:
+                result, future = in_flight.popleft()
+                _finish(conn, result, _call(future.result), created_by, dry_run, duplicates, progress)
+                # Each written file frees a slot for the next one
+                for following in islice(pending, 1):
+                    in_flight.append((following, pool.submit(parse_statement_file, following.file)))
+    return results
+
+
+def _call(function, *args):
+    try:
+        return function(*args)
+    except Exception as e:
+        return e
+
+
+def _finish(conn, result, outcome, created_by, dry_run, duplicates, progress):
+    if isinstance(outcome, Exception):
+        result.error = str(outcome) if isinstance(outcome, IngestError) else f"{type(outcome).__name__}: {outcome}"
+    else:
+        result.elapsed = outcome['elapsed']
+        try:
+            write_parsed(conn, result, outcome, created_by, dry_run, duplicates)
+        except Exception as e:
+            result.status, result.statement_id = 'failed', None
+            result.error = str(e)
+        if result.status == 'ingested':
+            record_audit('statement.upload', username=created_by, entity_type='statement',
+                         entity_id=result.statement_id, account_name=result.account_name,
+                         filename=os.path.basename(result.file), rows=result.rows, batch=True,
+                         duplicates=result.duplicates, updated=result.updated)
+    if progress:
+        progress(result)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest a directory or glob of bank statement CSVs.")
+    parser.add_argument('paths', nargs='+', help="Statement files, directories or glob patterns")
+    parser.add_argument('--account', help="Account for every file (default: inferred from the file name)")
+    parser.add_argument('--map', dest='account_map', help="CSV of pattern,account_name rules matched on file names")
+    parser.add_argument('--workers', type=int, default=None, help="Parser processes (default: CPU count)")
+    parser.add_argument('--created-by', default='system', help="Recorded as the creator of the rows")
+    parser.add_argument('--duplicates', choices=DUPLICATE_MODES, default='reject',
+                        help="Rows whose ref_number or line is already posted: fail the file (reject), leave them (skip), "
+                             "or refresh their narration and value date (upsert)")
+    parser.add_argument('--dry-run', action='store_true', help="Parse, validate and check duplicates without writing")
+    parser.add_argument('--summary', help="Also write the per-file summary to this CSV")
+    args = parser.parse_args(argv)
+
+    paths = expand_paths(args.paths)
+    if not paths:
+        print("No statement files found", file=sys.stderr)
+        return 2
+    account_map = load_account_map(args.account_map) if args.account_map else None
+
+    from database import ensure_schema, get_connection
+
+    ensure_schema()
+    started = time.perf_counter()
+    with get_connection() as conn:
+        results = ingest_files(
+            conn, paths, account_map=account_map, default_account=args.account,
+            created_by=args.created_by, workers=args.workers, dry_run=args.dry_run, duplicates=args.duplicates,
+            progress=lambda result: print(f"{result.status:>9}  {result.file}"
+                                          + (f"  ({result.error})" if result.error else ""), flush=True))
+
+    summary = dollar_columns(pd.DataFrame([asdict(result) for result in results], columns=SUMMARY_COLUMNS),
+                             'total_debit', 'total_credit')
+    if args.summary:
+        summary.to_csv(args.summary, index=False)
+    print()
+    print(summary.drop(columns=['statement_id', 'error']).to_string(
+        index=False, formatters={'total_debit': '{:,.2f}'.format, 'total_credit': '{:,.2f}'.format,
+                                 'elapsed': '{:.2f}s'.format}))
+    ok = summary['status'].isin(['ingested', 'validated'])
+    failed = int((summary['status'] == 'failed').sum())
+    print(f"{len(summary)} file(s): {int(ok.sum())} ok, {int((summary['status'] == 'skipped').sum())} skipped, "
+          f"{failed} failed; {int(summary.loc[ok, 'rows'].sum()):,} rows {'validated' if args.dry_run else 'posted'} "
+          f"in {time.perf_counter() - started:.2f}s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
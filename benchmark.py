@@ -0,0 +1,422 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from allocation import allocate_batch
+from auto_allocate import PENDING_SQL, auto_allocate
+from batch_ingest import ingest_files
+from explorer import TransactionFilter, fetch_page, filtered_totals
+from export import available_formats, export_statement
+from ingest import ingest_statement, ingest_statement_stream
+from ledger import MAIN_ACCOUNT, balance_at, balances_at, ledger_drift, refresh_checkpoints
+from maturity import process_maturities
+from portfolio import load_portfolio, maturity_ladder, portfolio_summary, value_portfolio
+from query_cache import query_cache
+from reconcile import reconcile_batch
+from services import main_balance, reconcile_statement, verify_statement_taxes
+from summary import load_dashboard_summary
+from synthetic_data import (SyntheticScale, add_scale_arguments, generate_statement, scale_from_args,
+                            seed_database)
+
+RESULTS_VERSION = 1
+
+# Median slowdown against a baseline that counts as a regression; benchmarks
+# faster than the floor in both runs are too noisy to flag
+REGRESSION_THRESHOLD = 1.25
+REGRESSION_FLOOR = 0.005
+
+
+@dataclass
+class BenchContext:
+    """What the benchmarks run against: the seeded database and a scratch directory."""
+    conn: sqlite3.Connection
+    db_path: str
+    scale: SyntheticScale
+    workdir: str
+    ingest_rows: int
+    start: datetime.date = None
+    end: datetime.date = None
+    total_rows: int = 0
+    statement_id: str = None
+    account_name: str = None
+    runs: int = 0
+
+
+@dataclass
+class BenchResult:
+    group: str
+    name: str
+    times: list = field(default_factory=list)
+    rows: int = 0
+
+    def to_dict(self):
+        median = statistics.median(self.times)
+        return {
+            'group': self.group, 'name': self.name, 'repeat': len(self.times),
+            'min': min(self.times), 'median': median, 'mean': statistics.fmean(self.times),
+            'max': max(self.times), 'rows': self.rows,
+            'rows_per_sec': self.rows / median if median > 0 else None,
+        }
+
+
+# (group, name, function, writes, setup) in run order; read-only benchmarks run first.
+# ``setup(ctx)`` runs untimed before each run and its result is passed to the function.
+BENCHMARKS = []
+
+
+def benchmark(group, name, writes=False, setup=None):
+    def register(function):
+        BENCHMARKS.append((group, name, function, writes, setup))
+        return function
+    return register
+
+
+# Pages: the queries each Streamlit page runs on load
+
+@benchmark('pages', 'dashboard')
+def _dashboard(ctx):
+    main_balance(ctx.conn.cursor())
+    summary = load_dashboard_summary(ctx.conn)
+    pd.read_sql("SELECT name, balance FROM departments WHERE balance IS NOT NULL", ctx.conn)
+    portfolio_summary(value_portfolio(load_portfolio(ctx.conn)))
+    return summary['transaction_count']
+
+
+@benchmark('pages', 'pending allocations')
+def _pending_allocations(ctx):
+    return len(pd.read_sql(PENDING_SQL + " ORDER BY t.transaction_date DESC", ctx.conn))
+
+
+@benchmark('pages', 'statements list')
+def _statements(ctx):
+    return len(pd.read_sql("SELECT id, filename, upload_date FROM statements ORDER BY upload_date DESC", ctx.conn))
+
+
+@benchmark('pages', 'explorer first page')
+def _explorer_first(ctx):
+    page, _ = fetch_page(ctx.conn, TransactionFilter())
+    return len(page)
+
+
+@benchmark('pages', 'explorer page 20 by account')
+def _explorer_deep(ctx):
+    flt, cursor, rows = TransactionFilter(accounts=(ctx.account_name,)), None, 0
+    for _ in range(20):
+        page, cursor = fetch_page(ctx.conn, flt, after=cursor)
+        rows += len(page)
+        if cursor is None:
+            break
+    return rows
+
+
+@benchmark('pages', 'explorer totals by account')
+def _explorer_totals(ctx):
+    return filtered_totals(ctx.conn, TransactionFilter(accounts=(ctx.account_name,)))['rows']
+
+
+@benchmark('pages', 'portfolio and ladder')
+def _portfolio(ctx):
+    valued = value_portfolio(load_portfolio(ctx.conn))
+    maturity_ladder(valued, 'M')
+    return len(valued)
+
+
+# Reconciliation and tax checks
+
+@benchmark('reconciliation', 'single statement')
+def _reconcile_one(ctx):
+    reconcile_statement(ctx.conn, ctx.statement_id, ctx.account_name)
+    return _statement_rows(ctx)
+
+
+@benchmark('reconciliation', 'verify taxes')
+def _verify_taxes(ctx):
+    verify_statement_taxes(ctx.conn, ctx.statement_id)
+    return _statement_rows(ctx)
+
+
+@benchmark('reconciliation', 'batch, one process')
+def _reconcile_serial(ctx):
+    summary, _ = reconcile_batch(ctx.conn, db_path=ctx.db_path, workers=1)
+    return int(summary['transactions'].sum())
+
+
+@benchmark('reconciliation', 'batch, process pool')
+def _reconcile_parallel(ctx):
+    summary, _ = reconcile_batch(ctx.conn, db_path=ctx.db_path)
+    return int(summary['transactions'].sum())
+
+
+# Exports of the whole history, one per available format
+
+def _export(fmt):
+    def run(ctx):
+        with export_statement(ctx.conn, ctx.start, ctx.end, fmt=fmt) as spool:
+            spool.seek(0, os.SEEK_END)
+        return ctx.total_rows
+    return run
+
+
+for _fmt in available_formats():
+    benchmark('export', _fmt)(_export(_fmt))
+
+
+# Balances and the ledger
+
+@benchmark('balances', 'balances at mid-history')
+def _balances_mid(ctx):
+    return len(balances_at(ctx.conn, ctx.start + (ctx.end - ctx.start) / 2))
+
+
+@benchmark('balances', 'main balance at end')
+def _balance_end(ctx):
+    balance_at(ctx.conn, MAIN_ACCOUNT, ctx.end)
+    return 1
+
+
+@benchmark('balances', 'ledger drift check')
+def _drift(ctx):
+    ledger_drift(ctx.conn)
+    return ctx.conn.execute("SELECT COUNT(*) FROM ledger_postings").fetchone()[0]
+
+
+@benchmark('balances', 'maturities due (dry run)')
+def _maturities(ctx):
+    return process_maturities(ctx.conn, dry_run=True).matured
+
+
+@benchmark('balances', 'auto-allocation (dry run)')
+def _auto_allocate(ctx):
+    return auto_allocate(ctx.conn, dry_run=True).pending
+
+
+# Writes: each repeat posts new rows, so these run last
+
+@benchmark('writes', 'refresh checkpoints', writes=True)
+def _checkpoints(ctx):
+    with ctx.conn:
+        return refresh_checkpoints(ctx.conn.cursor())
+
+
+def _fresh_statement(ctx, rows=None):
+    # Own ref prefix, and a new ref range per call, so refs never collide
+    ctx.runs += 1
+    rng = np.random.default_rng(ctx.scale.seed + 1000 + ctx.runs)
+    return generate_statement(rng, rows or ctx.ingest_rows, ctx.start, ctx.end, ctx.runs * 10_000_000,
+                              f"{ctx.scale.seed}B", ctx.scale.discrepancy_rate)
+
+
+def _statement_files(count):
+    def write(ctx):
+        paths = []
+        for _ in range(count):
+            frame = _fresh_statement(ctx, rows=ctx.ingest_rows // count)
+            paths.append(os.path.join(ctx.workdir, f'statement_{ctx.runs}.csv'))
+            frame.to_csv(paths[-1], index=False)
+        return paths
+    return write
+
+
+@benchmark('writes', 'ingest statement', writes=True, setup=_fresh_statement)
+def _ingest(ctx, frame):
+    ingest_statement(ctx.conn, frame, ctx.account_name, 'bench.csv', 'benchmark')
+    return len(frame)
+
+
+def _overlapping_statement(ctx):
+    # Post 99% of a statement untimed; the benchmark re-uploads all of it
+    frame = _fresh_statement(ctx)
+    known = len(frame) * 99 // 100
+    ingest_statement(ctx.conn, frame.iloc[:known], ctx.account_name, 'bench_known.csv', 'benchmark')
+    return frame
+
+
+@benchmark('writes', 're-upload, 99% known refs skipped', writes=True, setup=_overlapping_statement)
+def _reupload(ctx, frame):
+    ingest_statement(ctx.conn, frame, ctx.account_name, 'bench_overlap.csv', 'benchmark', duplicates='skip')
+    return len(frame)
+
+
+@benchmark('writes', 'ingest statement, chunked', writes=True, setup=_statement_files(1))
+def _ingest_stream(ctx, paths):
+    return ingest_statement_stream(ctx.conn, paths[0], ctx.account_name, 'bench_stream.csv', 'benchmark').rows
+
+
+@benchmark('writes', 'batch ingest, 4 files', writes=True, setup=_statement_files(4))
+def _batch_ingest(ctx, paths):
+    results = ingest_files(ctx.conn, paths, default_account=ctx.account_name, created_by='benchmark')
+    return sum(result.rows for result in results if result.status == 'ingested')
+
+
+def _pending_credits(ctx):
+    pending = pd.read_sql("""
+    SELECT id, amount FROM allocations
+    WHERE department_id IS NULL AND transaction_type = 'Credit'
+    LIMIT 5000
+    """, ctx.conn)
+    department_id = ctx.conn.execute("SELECT id FROM departments ORDER BY id LIMIT 1").fetchone()[0]
+    return {allocation_id: {department_id: amount} for allocation_id, amount in zip(pending['id'], pending['amount'])}
+
+
+@benchmark('writes', 'allocate batch of 5,000', writes=True, setup=_pending_credits)
+def _allocate(ctx, splits):
+    return len(allocate_batch(ctx.conn, splits, 'benchmark').allocated)
+
+
+def _statement_rows(ctx):
+    return ctx.conn.execute("SELECT COUNT(*) FROM transactions WHERE statement_id = ? AND account_name = ?",
+                            (ctx.statement_id, ctx.account_name)).fetchone()[0]
+
+
+def run_benchmarks(ctx, repeat=3, groups=None, include_writes=True, progress=None):
+    """Time every registered benchmark ``repeat`` times; returns BenchResults.
+
+    The query result cache is cleared before each run, so page benchmarks
+    measure SQLite and pandas rather than cache hits.
+    """
+    results = []
+    for group, name, function, writes, setup in BENCHMARKS:
+        if (groups and group not in groups) or (writes and not include_writes):
+            continue
+        result = BenchResult(group, name)
+        for _ in range(repeat):
+            args = (setup(ctx),) if setup else ()
+            query_cache.clear()
+            started = time.perf_counter()
+            result.rows = function(ctx, *args)
+            result.times.append(time.perf_counter() - started)
+        results.append(result)
+        if progress:
+            progress(result)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Median ratios against a baseline results file; returns ``(table, regressions)``."""
+    previous = {(row['group'], row['name']): row['median'] for row in baseline['results']}
+    rows = []
+    for row in results:
+        before = previous.get((row['group'], row['name']))
+        ratio = row['median'] / before if before else None
+        rows.append({'group': row['group'], 'name': row['name'], 'baseline': before,
+                     'median': row['median'], 'ratio': ratio})
+    table = pd.DataFrame(rows)
+    noisy = (table['median'] < REGRESSION_FLOOR) & (table['baseline'].fillna(0) < REGRESSION_FLOOR)
+    return table, table[(table['ratio'] > threshold) & ~noisy]
+
+
+def _print_result(result):
+    row = result.to_dict()
+    rate = f"{row['rows_per_sec']:>14,.0f} rows/s" if row['rows_per_sec'] else ""
+    print(f"{row['group']:<15} {row['name']:<32} median {row['median'] * 1000:>10.1f} ms  "
+          f"min {row['min'] * 1000:>10.1f} ms  {rate}", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time ingest, page queries, reconciliation, export and "
+                                                 "balance operations on a seeded synthetic database.")
+    parser.add_argument('--db', help="Benchmark a copy of this already seeded database instead of seeding one")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per benchmark")
+    parser.add_argument('--group', action='append', dest='groups',
+                        help="Only run this group (repeatable): pages, reconciliation, export, balances, writes")
+    parser.add_argument('--no-writes', action='store_true', help="Skip benchmarks that write to the database")
+    parser.add_argument('--ingest-rows', type=int, default=None,
+                        help="Rows per ingest benchmark run (default: 10%% of --transactions, at most 100,000)")
+    parser.add_argument('--output', default='benchmark_results.json', help="Results file (JSON)")
+    parser.add_argument('--baseline', help="Earlier results file to compare medians against")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="Median ratio above which a benchmark counts as a regression")
+    add_scale_arguments(parser)
+    args = parser.parse_args(argv)
+    scale = scale_from_args(args)
+
+    from database import configure, ensure_schema, get_connection
+
+    workdir = tempfile.mkdtemp(prefix='treasury-bench-')
+    try:
+        db_path = os.path.join(workdir, 'bench.db')
+        seeded = None
+        if args.db:
+            shutil.copyfile(args.db, db_path)
+        configure(path=db_path)
+        ensure_schema()
+        with get_connection() as conn:
+            if not args.db:
+                print(f"Seeding {scale.transactions:,} transactions (seed {scale.seed})...", flush=True)
+                seeded = seed_database(conn, scale)
+                print(f"Seeded in {seeded['elapsed']:.1f}s", flush=True)
+            statement_id, account_name = conn.execute("""
+            SELECT statement_id, account_name FROM transactions
+            WHERE statement_id IS NOT NULL
+            GROUP BY statement_id, account_name
+            ORDER BY COUNT(*) DESC LIMIT 1
+            """).fetchone()
+            total_rows, first, last = conn.execute(
+                "SELECT COUNT(*), MIN(transaction_date), MAX(transaction_date) FROM transactions").fetchone()
+            ctx = BenchContext(conn, db_path, scale, workdir,
+                               ingest_rows=args.ingest_rows or max(min(total_rows // 10, 100_000), 100),
+                               start=datetime.date.fromisoformat(first[:10]),
+                               end=datetime.date.fromisoformat(last[:10]), total_rows=total_rows,
+                               statement_id=statement_id, account_name=account_name)
+            results = run_benchmarks(ctx, repeat=args.repeat, groups=args.groups,
+                                     include_writes=not args.no_writes, progress=_print_result)
+    finally:
+        configure(path=':memory:')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {
+        'version': RESULTS_VERSION,
+        'created_at': datetime.datetime.now().isoformat(),
+        'environment': environment(),
+        'scale': asdict(scale) if not args.db else {'source': os.path.abspath(args.db), 'transactions': total_rows},
+        'seed_elapsed': seeded['elapsed'] if seeded else None,
+        'ingest_rows': ctx.ingest_rows,
+        'repeat': args.repeat,
+        'results': [result.to_dict() for result in results],
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, default=str)
+    print(f"\n{len(results)} benchmark(s) -> {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            table, regressions = compare(output['results'], json.load(f), args.threshold)
+        print(table.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
+        if not regressions.empty:
+            print(f"{len(regressions)} regression(s) over {args.threshold:.2f}x the baseline median")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
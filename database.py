@@ -0,0 +1,189 @@
+import atexit
+import itertools
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+
+from migrations import migrate
+from profiler import connection_factory
+from query_cache import query_cache
+
+
+@dataclass(frozen=True)
+class DatabaseConfig:
+    """Connection settings shared by every part of the app.
+
+    ``path`` may be ``':memory:'`` for a private in-memory database that all
+    pooled connections in the process share (used by tests and benchmarks).
+    """
+    path: str = 'treasury.db'
+    journal_mode: str = 'WAL'
+    synchronous: str = 'NORMAL'
+    busy_timeout_ms: int = 5000
+    cache_size_kib: int = 64 * 1024
+    mmap_size: int = 256 * 1024 * 1024
+    max_idle: int = 8
+
+    @property
+    def in_memory(self):
+        return self.path == ':memory:'
+
+    @classmethod
+    def from_env(cls):
+        defaults = cls()
+        return cls(
+            path=os.environ.get('TREASURY_DB_PATH', defaults.path),
+            journal_mode=os.environ.get('TREASURY_DB_JOURNAL_MODE', defaults.journal_mode),
+            synchronous=os.environ.get('TREASURY_DB_SYNCHRONOUS', defaults.synchronous),
+            busy_timeout_ms=int(os.environ.get('TREASURY_DB_BUSY_TIMEOUT_MS', defaults.busy_timeout_ms)),
+            cache_size_kib=int(os.environ.get('TREASURY_DB_CACHE_SIZE_KIB', defaults.cache_size_kib)),
+            mmap_size=int(os.environ.get('TREASURY_DB_MMAP_SIZE', defaults.mmap_size)),
+            max_idle=int(os.environ.get('TREASURY_DB_MAX_IDLE', defaults.max_idle)),
+        )
+
+
+_memory_ids = itertools.count(1)
+
+
+class ConnectionPool:
+    """A pool of tuned SQLite connections.
+
+    Each thread checks out at most one connection at a time; nested
+    ``connection()`` blocks on the same thread reuse it. Released connections
+    go back to a shared idle list, so they survive Streamlit starting a new
+    script thread for every rerun.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.schema_ready = False
+        self._lock = threading.Lock()
+        self._idle = []
+        self._local = threading.local()
+        self._closed = False
+        self._anchor = None
+        if config.in_memory:
+            self._uri = f"file:treasury_memdb_{next(_memory_ids)}?mode=memory&cache=shared"
+            # Keeps the shared in-memory database alive while the pool exists
+            self._anchor = self._open()
+
+    def _open(self):
+        config = self.config
+        if config.in_memory:
+            conn = sqlite3.connect(self._uri, uri=True, check_same_thread=False,
+                                   timeout=config.busy_timeout_ms / 1000, factory=connection_factory())
+        else:
+            conn = sqlite3.connect(config.path, check_same_thread=False,
+                                   timeout=config.busy_timeout_ms / 1000, factory=connection_factory())
+            conn.execute(f"PRAGMA journal_mode = {config.journal_mode}")
+            conn.execute(f"PRAGMA mmap_size = {int(config.mmap_size)}")
+        conn.execute(f"PRAGMA busy_timeout = {int(config.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA synchronous = {config.synchronous}")
+        conn.execute(f"PRAGMA cache_size = -{int(config.cache_size_kib)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def acquire(self):
+        held = getattr(self._local, 'held', None)
+        if held is not None:
+            self._local.depth += 1
+            return held
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._open()
+        self._local.held = conn
+        self._local.depth = 1
+        return conn
+
+    def release(self, conn):
+        if getattr(self._local, 'held', None) is not conn:
+            raise RuntimeError("Connection released by a thread that does not hold it")
+        self._local.depth -= 1
+        if self._local.depth:
+            return
+        self._local.held = None
+        # Never hand out a connection with a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if not self._closed and len(self._idle) < self.config.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+        if self._anchor is not None:
+            self._anchor.close()
+            self._anchor = None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DatabaseConfig.from_env())
+    return _pool
+
+
+def configure(**settings):
+    """Replace the active configuration (e.g. ``configure(path=':memory:')``).
+
+    Idle connections of the previous pool are closed.
+    """
+    global _pool
+    with _pool_lock:
+        base = _pool.config if _pool is not None else DatabaseConfig.from_env()
+        old, _pool = _pool, ConnectionPool(replace(base, **settings))
+    if old is not None:
+        old.close()
+    # Cached results belong to the previous database
+    query_cache.clear()
+    return _pool
+
+
+def get_connection():
+    """Context manager yielding a pooled connection that is always released."""
+    return get_pool().connection()
+
+
+def shared_database_path():
+    """Absolute path other processes can open, or None for an in-memory database."""
+    config = get_pool().config
+    return None if config.in_memory else os.path.abspath(config.path)
+
+
+def ensure_schema():
+    """Run pending migrations once per pool; later calls return immediately."""
+    pool = get_pool()
+    if pool.schema_ready:
+        return
+    with pool.connection() as conn:
+        migrate(conn)
+    pool.schema_ready = True
+
+
+@atexit.register
+def _close_pool():
+    if _pool is not None:
+        _pool.close()
@@ -0,0 +1,101 @@
+from dataclasses import dataclass
+
+from query_cache import cached_read_sql
+
+PAGE_SIZE = 50
+
+EXPLORER_COLUMNS = """
+t.ref_number, t.transaction_date, t.account_name, t.narration, t.type,
+t.debit_amount, t.credit_amount, t.tax_percentage, t.tax_amount, t.statement_id
+"""
+
+# Amount of a line regardless of side; statements carry one or the other
+_AMOUNT = "(COALESCE(t.debit_amount, 0) + COALESCE(t.credit_amount, 0))"
+
+
+@dataclass(frozen=True)
+class TransactionFilter:
+    """Explorer filters; ``None`` or empty values are not applied. Amounts are in cents."""
+    accounts: tuple = ()
+    start_date: str = None
+    end_date: str = None
+    min_amount: int = None
+    max_amount: int = None
+    transaction_type: str = None
+    statement_id: str = None
+    narration: str = None
+
+    def where(self):
+        """Return ``(clauses, params)`` for the filtered set."""
+        clauses, params = [], []
+        if self.accounts:
+            clauses.append(f"t.account_name IN ({', '.join('?' for _ in self.accounts)})")
+            params.extend(self.accounts)
+        if self.start_date:
+            clauses.append("t.transaction_date >= ?")
+            params.append(str(self.start_date))
+        if self.end_date:
+            # Covers both bare dates and full timestamps on the end date
+            clauses.append("t.transaction_date < date(?, '+1 day')")
+            params.append(str(self.end_date))
+        if self.min_amount is not None:
+            clauses.append(f"{_AMOUNT} >= ?")
+            params.append(self.min_amount)
+        if self.max_amount is not None:
+            clauses.append(f"{_AMOUNT} <= ?")
+            params.append(self.max_amount)
+        if self.transaction_type:
+            clauses.append("t.type = ?")
+            params.append(self.transaction_type)
+        if self.statement_id:
+            clauses.append("t.statement_id = ?")
+            params.append(self.statement_id)
+        if self.narration:
+            clauses.append("t.narration LIKE ? ESCAPE '\\'")
+            escaped = self.narration.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params.append(f"%{escaped}%")
+        return clauses, params
+
+
+def fetch_page(conn, flt, after=None, page_size=PAGE_SIZE):
+    """One page of filtered transactions, newest first.
+
+    ``after`` is the ``(transaction_date, rowid)`` cursor returned for the
+    previous page; the next page seeks past it on the date index instead of
+    skipping rows, so every page costs the same. Returns ``(page, cursor)``
+    where ``cursor`` is None on the last page.
+    """
+    clauses, params = flt.where()
+    if after is not None:
+        clauses.append("(t.transaction_date, t.rowid) < (?, ?)")
+        params.extend(after)
+    where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+    page = cached_read_sql(f"""
+    SELECT t.rowid AS row_key, {EXPLORER_COLUMNS}
+    FROM transactions t
+    {where}
+    ORDER BY t.transaction_date DESC, t.rowid DESC
+    LIMIT ?
+    """, conn, ('transactions',), params=params + [page_size + 1])
+
+    cursor = None
+    if len(page) > page_size:
+        page = page.iloc[:page_size]
+        last = page.iloc[-1]
+        cursor = (last['transaction_date'], int(last['row_key']))
+    return page.drop(columns='row_key'), cursor
+
+
+def filtered_totals(conn, flt):
+    """Row count and amount totals (cents) over the whole filtered set, computed in SQLite."""
+    clauses, params = flt.where()
+    where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+    totals = cached_read_sql(f"""
+    SELECT COUNT(*) AS rows,
+           COALESCE(SUM(t.debit_amount), 0) AS total_debit,
+           COALESCE(SUM(t.credit_amount), 0) AS total_credit,
+           COALESCE(SUM(t.tax_amount), 0) AS total_tax
+    FROM transactions t
+    {where}
+    """, conn, ('transactions',), params=params)
+    return {name: int(value) for name, value in totals.iloc[0].items()}
@@ -0,0 +1,130 @@
+import csv
+import gzip
+import io
+import tempfile
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+EXPORT_COLUMNS = [
+    'transaction_date', 'value_date', 'narration', 'ref_number',
+    'debit_amount', 'credit_amount', 'tax_percentage', 'tax_amount', 'account_name',
+]
+
+# Exports use the upload layout, so stored cents go out as dollars
+MONEY_COLUMNS = ('debit_amount', 'credit_amount', 'tax_amount')
+
+PAGE_SIZE = 10_000
+
+# Exports larger than this spill from memory to a temp file on disk
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+EXPORT_FORMATS = {
+    'csv': ('csv', 'text/csv'),
+    'csv.gz': ('csv.gz', 'application/gzip'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+
+
+def available_formats():
+    return [fmt for fmt in EXPORT_FORMATS if fmt != 'parquet' or pq is not None]
+
+
+def iter_statement_pages(conn, start_date, end_date, accounts=None, page_size=PAGE_SIZE):
+    """Yield lists of transaction rows in date order, ``page_size`` rows at a time.
+
+    Pages are fetched with a keyset on ``(transaction_date, rowid)`` so each
+    query resumes from an index seek instead of re-scanning an OFFSET.
+    """
+    columns = ', '.join(f"{column} / 100.0 AS {column}" if column in MONEY_COLUMNS else column
+                        for column in EXPORT_COLUMNS)
+    clauses = ["transaction_date BETWEEN ? AND ?"]
+    params = [str(start_date), str(end_date)]
+    if accounts:
+        clauses.append(f"account_name IN ({', '.join('?' for _ in accounts)})")
+        params.extend(accounts)
+    where = " AND ".join(clauses)
+
+    c = conn.cursor()
+    last = None
+    while True:
+        if last is None:
+            c.execute(f"""
+            SELECT rowid, {columns} FROM transactions
+            WHERE {where}
+            ORDER BY transaction_date, rowid
+            LIMIT ?
+            """, params + [page_size])
+        else:
+            c.execute(f"""
+            SELECT rowid, {columns} FROM transactions
+            WHERE {where} AND (transaction_date, rowid) > (?, ?)
+            ORDER BY transaction_date, rowid
+            LIMIT ?
+            """, params + [last[0], last[1], page_size])
+        rows = c.fetchall()
+        if not rows:
+            return
+        last = (rows[-1][1], rows[-1][0])
+        yield [row[1:] for row in rows]
+        if len(rows) < page_size:
+            return
+
+
+def _write_csv(pages, out, compress):
+    raw = gzip.GzipFile(fileobj=out, mode='wb') if compress else out
+    text = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in pages:
+        writer.writerows(rows)
+    text.flush()
+    # Detach so closing the wrappers does not close the spooled file
+    text.detach()
+    if compress:
+        raw.close()
+
+
+def _write_parquet(pages, out):
+    if pq is None:
+        raise RuntimeError("Parquet export requires pyarrow")
+    schema = pa.schema([
+        ('transaction_date', pa.string()), ('value_date', pa.string()),
+        ('narration', pa.string()), ('ref_number', pa.string()),
+        ('debit_amount', pa.float64()), ('credit_amount', pa.float64()),
+        ('tax_percentage', pa.float64()), ('tax_amount', pa.float64()),
+        ('account_name', pa.string()),
+    ])
+    with pq.ParquetWriter(out, schema, compression='zstd') as writer:
+        for rows in pages:
+            columns = list(zip(*rows))
+            arrays = [pa.array([None if v is None else str(v) for v in col], type=field.type)
+                      if pa.types.is_string(field.type) else pa.array(col, type=field.type)
+                      for col, field in zip(columns, schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+
+def export_statement(conn, start_date, end_date, accounts=None, fmt='csv', page_size=PAGE_SIZE):
+    """Write a statement export page by page into a spooled temp file.
+
+    ``fmt`` is one of ``EXPORT_FORMATS``. Only one page of rows is held in
+    memory at a time. Returns the file positioned at the start; the caller
+    closes it.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    pages = iter_statement_pages(conn, start_date, end_date, accounts, page_size)
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES, mode='w+b')
+    try:
+        if fmt == 'parquet':
+            _write_parquet(pages, out)
+        else:
+            _write_csv(pages, out, compress=(fmt == 'csv.gz'))
+    except Exception:
+        out.close()
+        raise
+    out.seek(0)
+    return out
@@ -0,0 +1,776 @@
+import datetime
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from ledger import post_daily_main
+from money import cents_array, format_money
+from query_cache import bump_generation
+from summary import record_transactions
+
+REQUIRED_COLUMNS = ['transaction_date', 'value_date', 'narration', 'ref_number',
+                    'debit_amount', 'credit_amount', 'tax_percentage', 'tax_amount']
+
+AMOUNT_COLUMNS = ['debit_amount', 'credit_amount', 'tax_percentage', 'tax_amount']
+
+# Rows per executemany() call; keeps the parameter lists bounded on large statements
+BATCH_SIZE = 10_000
+
+# Rows parsed, validated and committed at a time by the streaming ingest
+CHUNK_SIZE = 50_000
+
+# Text columns are read as strings so every chunk gets the same dtypes
+TEXT_DTYPES = {'transaction_date': str, 'value_date': str, 'narration': str, 'ref_number': str}
+
+# How rows whose ref_number is already posted are handled: fail the upload,
+# leave the posted row as it is, or refresh its narration and value date
+DUPLICATE_MODES = ('reject', 'skip', 'upsert')
+
+# Digest bytes of a statement line fingerprint (64 bits, 16 hex digits)
+FINGERPRINT_BYTES = 8
+
+
+class IngestError(ValueError):
+    """Raised when a statement fails validation or cannot be posted."""
+
+
+class DuplicateRefsError(IngestError):
+    """Raised in 'reject' mode when an upload contains posted, overlapping or repeated rows."""
+
+    def __init__(self, report):
+        super().__init__(f"{report.describe()} Skip or update them, or remove them from the file.")
+        self.report = report
+
+
+@dataclass
+class IngestResult:
+    """Outcome of an ingest; totals and the new balance are in cents."""
+    statement_id: str
+    rows: int
+    total_debit: int
+    total_credit: int
+    new_balance: int
+    elapsed: float
+    resumed_rows: int = 0
+    skipped: int = 0
+    updated: int = 0
+
+    @property
+    def rows_per_sec(self):
+        processed = self.rows - self.resumed_rows
+        return processed / self.elapsed if self.elapsed > 0 else float(processed)
+
+
+@dataclass
+class DuplicateReport:
+    """Rows of an upload that are already posted or repeat in the file.
+
+    ``duplicates`` is indexed like the uploaded frame and has the CSV row
+    number, ref_number, the matching posted ref and its statement and
+    account, and a status: 'repeated' (an earlier row has the ref),
+    'unchanged', 'changed' (narration or value date differ), 'conflict'
+    (amounts differ) or 'overlap' (a new ref for a line already posted from
+    an overlapping statement, matched by fingerprint).
+    """
+    rows: int
+    duplicates: pd.DataFrame
+
+    def __len__(self):
+        return len(self.duplicates)
+
+    def count(self, *statuses):
+        return int(self.duplicates['status'].isin(statuses).sum())
+
+    def updates(self):
+        """``(narration, value_date, ref_number)`` for posted rows whose details changed."""
+        changed = self.duplicates[self.duplicates['status'] == 'changed']
+        return list(zip(changed['narration'], changed['value_date'], changed['ref_number']))
+
+    def describe(self):
+        if self.duplicates.empty:
+            return "No duplicate ref_numbers."
+        parts = []
+        posted = self.count('unchanged', 'changed', 'conflict')
+        if posted:
+            parts.append(f"{posted:,} of {self.rows:,} ref_number(s) are already posted "
+                         f"({self.count('unchanged'):,} unchanged, {self.count('changed'):,} with a new narration "
+                         f"or value date, {self.count('conflict'):,} with different amounts)")
+        if self.count('overlap'):
+            parts.append(f"{self.count('overlap'):,} row(s) match lines already posted from an overlapping "
+                         f"statement under other ref_numbers")
+        if self.count('repeated'):
+            parts.append(f"{self.count('repeated'):,} row(s) repeat an earlier ref_number of the file")
+        examples = ', '.join(self.duplicates['ref_number'].head(3))
+        return f"{' and '.join(parts)}, e.g. {examples}."
+
+
+def new_ids(count):
+    """Generate ``count`` row ids.
+
+    Bulk paths use 16 hex characters instead of the 8-character uuid prefix
+    used for single rows, so ids stay collision-free across millions of lines.
+    """
+    return [uuid.uuid4().hex[:16] for _ in range(count)]
+
+
+def _valid_dates(column):
+    parsed = pd.to_datetime(column.astype('string'), format='%Y-%m-%d', errors='coerce')
+    return parsed.notna()
+
+
+def validate_statement(df):
+    """Validate a statement frame column-wise.
+
+    Raises IngestError describing the first offending row, in the same order
+    of checks the row-by-row validation used.
+    """
+    missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+    if missing_columns:
+        raise IngestError(f"CSV is missing required columns: {', '.join(missing_columns)}")
+
+    amounts = {col: pd.to_numeric(df[col], errors='coerce') for col in AMOUNT_COLUMNS}
+    checks = [
+        (~(_valid_dates(df['transaction_date']) & _valid_dates(df['value_date'])),
+         "Invalid date format in row {row} with ref_number {ref}. Use YYYY-MM-DD."),
+        ((amounts['debit_amount'] < 0) | (amounts['credit_amount'] < 0),
+         "Negative amounts not allowed in row {row} with ref_number {ref}."),
+        ((amounts['debit_amount'] > 0) & (amounts['credit_amount'] > 0),
+         "Cannot have both debit and credit amounts in row {row} with ref_number {ref}."),
+        ((amounts['tax_percentage'] < 0) | (amounts['tax_percentage'] > 100),
+         "Invalid tax percentage in row {row} with ref_number {ref}."),
+    ]
+    for col in REQUIRED_COLUMNS:
+        values = amounts[col] if col in amounts else df[col]
+        checks.append((values.isna(),
+                       "Missing or invalid value for " + col + " in row {row} with ref_number {ref}."))
+
+    failed = np.zeros(len(df), dtype=bool)
+    for mask, _ in checks:
+        failed |= mask.to_numpy()
+    if not failed.any():
+        return
+
+    # Report the first failing row and the first check it fails, as before
+    position = int(np.argmax(failed))
+    row_label = df.index[position] + 2
+    ref_number = df['ref_number'].iloc[position]
+    for mask, message in checks:
+        if mask.iloc[position]:
+            raise IngestError(message.format(row=row_label, ref=ref_number))
+
+
+def prepare_statement(df):
+    """Build the derived transaction/allocation columns for a validated frame.
+
+    Statement amounts are dollars; every derived amount and total is int64 cents.
+    """
+    debit = cents_array(df['debit_amount'])
+    credit = cents_array(df['credit_amount'])
+    tax_percentage = pd.to_numeric(df['tax_percentage']).to_numpy(dtype=float)
+    tax = cents_array(df['tax_amount'])
+
+    is_debit = debit > 0
+    balance_delta = np.where(is_debit, -(debit + tax), credit - tax)
+
+    return {
+        'ref_number': df['ref_number'].astype(str).tolist(),
+        'transaction_date': df['transaction_date'].tolist(),
+        'value_date': df['value_date'].tolist(),
+        'narration': df['narration'].astype(str).tolist(),
+        'debit_amount': debit.tolist(),
+        'credit_amount': credit.tolist(),
+        'tax_percentage': tax_percentage.tolist(),
+        'tax_amount': tax.tolist(),
+        'type': np.where(is_debit, 'Debit', 'Credit').tolist(),
+        'debit_type': np.where(is_debit, 'Other', None).tolist(),
+        'credit_type': np.where(is_debit, None, 'Other').tolist(),
+        'allocation_amount': np.where(is_debit, debit, credit - tax).tolist(),
+        'total_debit': int((debit + tax)[is_debit].sum()),
+        'total_credit': int((credit - tax)[credit > 0].sum()),
+        'balance_delta': int(balance_delta.sum()),
+        # Net main account change per transaction date, for the ledger
+        'daily_deltas': {date: int(delta) for date, delta in pd.Series(balance_delta).groupby(
+            df['transaction_date'].astype(str).str[:10].to_numpy()).sum().items()},
+    }
+
+
+def line_fingerprints(account_name, lines):
+    """Fingerprint statement lines independently of their ref_number.
+
+    Hashes the account, transaction date, signed amount in cents and the
+    narration lowercased with punctuation and spacing folded, so a line
+    exported in two overlapping statements gets one fingerprint whatever ref
+    format each export used. ``lines`` is a frame or a dict of columns with
+    transaction_date, narration, and debit_amount and credit_amount in cents.
+    """
+    def column(name):
+        return pd.Series(np.asarray(lines[name], dtype=object))
+
+    debit = pd.to_numeric(column('debit_amount'), errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+    credit = pd.to_numeric(column('credit_amount'), errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+    cents = pd.Series(credit - debit).astype(str)
+    date = column('transaction_date').fillna('').astype(str).str[:10]
+    narration = (column('narration').fillna('').astype(str).str.lower()
+                 .str.replace(r'[\W_]+', ' ', regex=True).str.strip())
+    account = str(account_name or '').strip().lower()
+    keys = account + '|' + date + '|' + cents + '|' + narration
+    return [hashlib.blake2b(key.encode(), digest_size=FINGERPRINT_BYTES).hexdigest() for key in keys]
+
+
+@contextmanager
+def _upload_keys(conn, keys):
+    """Load ``keys`` (a Series indexed by upload position) into ``temp.upload_keys``.
+
+    Probes join the temp table against an index in one statement instead of
+    a lookup per row; the table is emptied again on exit.
+    """
+    c = conn.cursor()
+    c.execute("""
+    CREATE TEMP TABLE IF NOT EXISTS upload_keys (
+        position INTEGER PRIMARY KEY,
+        key TEXT NOT NULL
+    )
+    """)
+    rows = list(zip(keys.index.tolist(), keys.tolist()))
+    # Only the connection's temp database is written; the main database stays unlocked
+    with conn:
+        c.execute("DELETE FROM temp.upload_keys")
+        for start in range(0, len(rows), BATCH_SIZE):
+            c.executemany("INSERT INTO temp.upload_keys VALUES (?, ?)", rows[start:start + BATCH_SIZE])
+    try:
+        yield
+    finally:
+        with conn:
+            c.execute("DELETE FROM temp.upload_keys")
+
+
+@contextmanager
+def _scan_keys(conn):
+    """Stage the refs and line fingerprints of a streamed file on disk.
+
+    ``scan.refs`` and ``scan.lines`` (with a count per fingerprint) let each
+    chunk be checked against the earlier ones in SQL. They live in a scratch
+    file attached as ``scan`` rather than in the temp schema, which is kept
+    in memory, so the scan holds one chunk at a time; the file is removed on
+    exit.
+    """
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    c = conn.cursor()
+    c.execute("ATTACH DATABASE ? AS scan", (path,))
+    try:
+        # Scratch data: nothing to recover after a crash
+        c.execute("PRAGMA scan.journal_mode = OFF")
+        c.execute("PRAGMA scan.synchronous = OFF")
+        c.execute("CREATE TABLE scan.refs (ref TEXT PRIMARY KEY) WITHOUT ROWID")
+        c.execute("""
+        CREATE TABLE scan.lines (
+            fingerprint TEXT PRIMARY KEY,
+            seen INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """)
+        yield
+    finally:
+        c.execute("DETACH DATABASE scan")
+        os.remove(path)
+
+
+def _stage_refs(conn, refs):
+    """Upload positions of ``refs`` already staged by earlier chunks; stages the rest."""
+    with _upload_keys(conn, refs):
+        staged = pd.read_sql("""
+        SELECT u.position FROM temp.upload_keys u
+        JOIN scan.refs s ON s.ref = u.key
+        """, conn)['position']
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO scan.refs SELECT key FROM temp.upload_keys")
+    return staged
+
+
+def _stage_lines(conn, fingerprints):
+    """Counts of ``fingerprints`` staged by earlier chunks; then adds these ones."""
+    with _upload_keys(conn, pd.Series(fingerprints, dtype=object)):
+        earlier = pd.read_sql("""
+        SELECT s.fingerprint, s.seen
+        FROM (SELECT DISTINCT key FROM temp.upload_keys) u
+        JOIN scan.lines s ON s.fingerprint = u.key
+        """, conn, index_col='fingerprint')['seen']
+        with conn:
+            conn.execute("""
+            INSERT INTO scan.lines (fingerprint, seen)
+            SELECT key, COUNT(*) FROM temp.upload_keys WHERE true GROUP BY key
+            ON CONFLICT (fingerprint) DO UPDATE SET seen = seen + excluded.seen
+            """)
+    return earlier
+
+
+def _probe_posted(conn, refs, exclude_statement=None):
+    """Posted transactions for ``refs`` (a Series indexed by upload position)."""
+    with _upload_keys(conn, refs):
+        return pd.read_sql("""
+        SELECT u.position, t.statement_id, t.account_name, t.narration, t.value_date,
+               t.debit_amount, t.credit_amount, t.tax_amount, t.fingerprint
+        FROM temp.upload_keys u
+        JOIN transactions t ON t.ref_number = u.key
+        WHERE :statement IS NULL OR t.statement_id IS NOT :statement
+        """, conn, params={'statement': exclude_statement}, index_col='position')
+
+
+def _probe_fingerprints(conn, fingerprints, exclude_statement=None):
+    """Posted statement lines per fingerprint: how many, and an example ref and statement."""
+    with _upload_keys(conn, pd.Series(fingerprints)):
+        return pd.read_sql("""
+        SELECT u.key AS fingerprint, COUNT(*) AS posted,
+               MIN(t.ref_number) AS posted_ref, MIN(t.statement_id) AS statement_id
+        FROM temp.upload_keys u
+        JOIN transactions t ON t.fingerprint = u.key
+        WHERE :statement IS NULL OR t.statement_id IS NOT :statement
+        GROUP BY u.position
+        """, conn, params={'statement': exclude_statement}, index_col='fingerprint')
+
+
+def _find_overlaps(conn, df, refs, claimed, account_name, exclude_statement=None, staged=False):
+    """Rows with new refs whose line is already posted, as rows of a DuplicateReport.
+
+    Identical lines (two equal charges on one day) are matched one for one:
+    the k-th new occurrence of a fingerprint overlaps only if at least k such
+    lines are posted, counting the posted lines already matched by ref
+    (``claimed``, their fingerprints by upload position) and, when
+    ``staged``, the lines of earlier chunks in ``scan.lines``.
+    """
+    fresh = df[~df.index.isin(claimed.index)]
+    lines = fresh.assign(debit_amount=cents_array(fresh['debit_amount']),
+                         credit_amount=cents_array(fresh['credit_amount']))
+    fresh = pd.Series(line_fingerprints(account_name, lines), index=fresh.index, dtype=object)
+    claimed = claimed.dropna()
+    rank = fresh.groupby(fresh).cumcount() + 1 + fresh.map(claimed.value_counts()).fillna(0)
+    if staged:
+        rank += fresh.map(_stage_lines(conn, claimed.tolist() + fresh.tolist())).fillna(0)
+    if fresh.empty:
+        return None
+    posted = _probe_fingerprints(conn, fresh.unique().tolist(), exclude_statement)
+    if posted.empty:
+        return None
+
+    hits = fresh[rank <= fresh.map(posted['posted']).fillna(0)]
+    matched = posted.loc[hits.to_numpy()]
+    return pd.DataFrame({
+        'ref_number': refs[hits.index],
+        'status': 'overlap',
+        'posted_ref': matched['posted_ref'].to_numpy(),
+        'statement_id': matched['statement_id'].to_numpy(),
+        'account_name': account_name,
+        'narration': df.loc[hits.index, 'narration'].astype(str),
+        'value_date': df.loc[hits.index, 'value_date'].astype(str),
+    }, index=hits.index)
+
+
+def find_duplicates(conn, df, account_name=None, exclude_statement=None, staged=False):
+    """Check a statement frame's ref_numbers before anything is written.
+
+    Rows repeating an earlier ref of the file are 'repeated'; the rest are
+    probed against posted transactions in one set-based join. With
+    ``account_name`` rows with new refs are also matched by fingerprint
+    against lines posted from earlier statements of that account. With
+    ``staged`` (inside ``_scan_keys``) the frame is one chunk of a file: its
+    refs and lines are also matched against those of earlier chunks, then
+    staged. Rows posted by ``exclude_statement``, an import being resumed, do
+    not count. Returns a DuplicateReport.
+    """
+    refs = df['ref_number'].astype(str)
+    repeated = refs.duplicated().to_numpy()
+    if staged:
+        repeated = repeated | refs.index.isin(_stage_refs(conn, refs))
+    posted = _probe_posted(conn, refs[~repeated], exclude_statement)
+    claimed = posted['fingerprint']
+
+    uploaded = df.loc[posted.index]
+    # Both sides are whole cents, so amounts compare exactly
+    amounts_differ = np.zeros(len(posted), dtype=bool)
+    for col in ('debit_amount', 'credit_amount', 'tax_amount'):
+        amounts_differ |= cents_array(uploaded[col]) != posted[col].fillna(0).to_numpy(dtype=np.int64)
+    narration = uploaded['narration'].astype(str)
+    value_date = uploaded['value_date'].astype(str)
+    details_differ = ((narration != posted['narration']) | (value_date != posted['value_date'])).to_numpy()
+    posted = pd.DataFrame({
+        'ref_number': refs[posted.index],
+        'status': np.where(amounts_differ, 'conflict', np.where(details_differ, 'changed', 'unchanged')),
+        'posted_ref': refs[posted.index],
+        'statement_id': posted['statement_id'],
+        'account_name': posted['account_name'],
+        'narration': narration,
+        'value_date': value_date,
+    }, index=posted.index)
+
+    found = [posted, pd.DataFrame({'ref_number': refs[repeated], 'status': 'repeated'})]
+    if account_name is not None:
+        found.append(_find_overlaps(conn, df[~repeated], refs, claimed, account_name,
+                                    exclude_statement, staged))
+    duplicates = pd.concat([frame for frame in found if frame is not None]).sort_index()
+    duplicates.insert(0, 'row', duplicates.index + 2)
+    return DuplicateReport(rows=len(df), duplicates=duplicates)
+
+
+def resolve_duplicates(df, report, mode='reject'):
+    """Apply a duplicate mode; returns ``(rows to post, detail updates)``.
+
+    'reject' raises DuplicateRefsError if there is any duplicate. 'skip' and
+    'upsert' post only new lines (the first row of a repeated ref); 'upsert'
+    also returns narration/value date updates for posted rows. Rows whose
+    amounts differ are never changed: their amounts are already in balances,
+    the ledger and department allocations.
+    """
+    if mode not in DUPLICATE_MODES:
+        raise ValueError(f"Unknown duplicate mode {mode!r}; expected one of {', '.join(DUPLICATE_MODES)}")
+    if not len(report):
+        return df, []
+    if mode == 'reject':
+        raise DuplicateRefsError(report)
+    remaining = df[~df.index.isin(report.duplicates.index)]
+    return remaining, report.updates() if mode == 'upsert' else []
+
+
+def refresh_details(c, updates):
+    """Write upsert updates of narration and value date; runs in the caller's transaction.
+
+    Statement lines get their fingerprint recomputed, as it covers the narration.
+    """
+    for start in range(0, len(updates), BATCH_SIZE):
+        batch = updates[start:start + BATCH_SIZE]
+        c.executemany("UPDATE transactions SET narration = ?, value_date = ? WHERE ref_number = ?", batch)
+        refs = [ref_number for _, _, ref_number in batch]
+        lines = pd.DataFrame(c.execute(f"""
+        SELECT rowid, account_name, transaction_date, narration, debit_amount, credit_amount
+        FROM transactions
+        WHERE ref_number IN ({', '.join('?' * len(refs))}) AND statement_id IS NOT NULL
+        """, refs).fetchall(), columns=['rowid', 'account_name', 'transaction_date', 'narration',
+                                        'debit_amount', 'credit_amount'])
+        for account_name, group in lines.groupby(lines['account_name'].fillna(''), sort=False):
+            c.executemany("UPDATE transactions SET fingerprint = ? WHERE rowid = ?",
+                          zip(line_fingerprints(account_name, group), group['rowid'].tolist()))
+    if updates:
+        bump_generation(c, 'transactions')
+
+
+def write_statement_rows(c, columns, account_name, statement_id, created_by, created_at):
+    """Insert the transaction and pending allocation rows for prepared columns."""
+    rows = len(columns['ref_number'])
+    transaction_ids = new_ids(rows)
+    allocation_ids = new_ids(rows)
+    fingerprints = line_fingerprints(account_name, columns)
+
+    for start in range(0, rows, BATCH_SIZE):
+        stop = min(start + BATCH_SIZE, rows)
+        batch = range(start, stop)
+
+        c.executemany("""
+        INSERT INTO transactions (
+            id, ref_number, transaction_date, value_date, narration,
+            debit_amount, credit_amount, tax_percentage, tax_amount,
+            type, debit_type, credit_type, created_by, created_at,
+            account_name, statement_id, fingerprint
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(
+            transaction_ids[i], columns['ref_number'][i], columns['transaction_date'][i],
+            columns['value_date'][i], columns['narration'][i], columns['debit_amount'][i],
+            columns['credit_amount'][i], columns['tax_percentage'][i], columns['tax_amount'][i],
+            columns['type'][i], columns['debit_type'][i], columns['credit_type'][i],
+            created_by, created_at, account_name, statement_id, fingerprints[i]
+        ) for i in batch])
+
+        # Allocations start with department_id NULL until assigned
+        c.executemany("""
+        INSERT INTO allocations (
+            id, treasury_ref, department_id, amount, created_by, created_at, transaction_type, statement_id
+        ) VALUES (?, ?, NULL, ?, ?, ?, ?, ?)
+        """, [(
+            allocation_ids[i], columns['ref_number'][i], columns['allocation_amount'][i],
+            created_by, created_at, columns['type'][i], statement_id
+        ) for i in batch])
+
+
+def post_statement(conn, columns, account_name, filename, created_by, file_hash=None, refresh=()):
+    """Write a validated, prepared statement in one database transaction.
+
+    Inserts the statement, its transactions and pending allocations with
+    batched inserts and applies a single combined main account balance change.
+    With ``file_hash`` the import is also recorded as completed in
+    ``statement_imports``; ``refresh`` holds upsert updates for posted rows
+    (see ``resolve_duplicates``). Returns ``(statement_id, new_balance)``.
+    """
+    rows = len(columns['ref_number'])
+    c = conn.cursor()
+    now = datetime.datetime.now().isoformat()
+    statement_id = str(uuid.uuid4())[:8]
+
+    with conn:
+        # Take the write lock before the balance check so concurrent debits cannot both pass it
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT balance FROM main_account LIMIT 1")
+        main_balance = c.fetchone()[0] or 0
+        if main_balance + columns['balance_delta'] < 0:
+            raise IngestError(f"Insufficient Main Account balance for debit transactions "
+                              f"({format_money(columns['total_debit'])} required).")
+
+        c.execute("""
+        INSERT INTO statements (
+            id, filename, upload_date, created_by, created_at
+        ) VALUES (?, ?, ?, ?, ?)
+        """, (statement_id, filename, now, created_by, now))
+        if file_hash:
+            c.execute("""
+            INSERT INTO statement_imports (
+                statement_id, file_hash, filename, account_name, total_rows,
+                rows_committed, status, created_by, created_at, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, 'completed', ?, ?, ?)
+            """, (statement_id, file_hash, filename, account_name, rows, rows, created_by, now, now))
+
+        write_statement_rows(c, columns, account_name, statement_id, created_by, now)
+        refresh_details(c, list(refresh))
+        record_transactions(c, {account_name: rows})
+        bump_generation(c, 'statements', 'transactions', 'allocations', 'main_account')
+
+        c.execute("UPDATE main_account SET balance = balance + ?", (columns['balance_delta'],))
+        post_daily_main(c, columns['daily_deltas'], 'statement', statement_id)
+        c.execute("SELECT balance FROM main_account LIMIT 1")
+        new_balance = c.fetchone()[0]
+
+    return statement_id, new_balance
+
+
+def _refresh_only(conn, updates):
+    """Apply upsert updates when no row of the upload is new; returns the main balance."""
+    c = conn.cursor()
+    with conn:
+        refresh_details(c, updates)
+        c.execute("SELECT balance FROM main_account LIMIT 1")
+        return c.fetchone()[0]
+
+
+def ingest_statement(conn, df, account_name, filename, created_by, duplicates='reject'):
+    """Validate a statement frame, resolve duplicate refs and post it with ``post_statement``.
+
+    When every ref is already posted nothing is created and the result's
+    ``statement_id`` is None.
+    """
+    started = time.perf_counter()
+    validate_statement(df)
+    report = find_duplicates(conn, df, account_name)
+    df, updates = resolve_duplicates(df, report, duplicates)
+    if df.empty:
+        new_balance = _refresh_only(conn, updates)
+        statement_id, columns = None, {'total_debit': 0, 'total_credit': 0}
+    else:
+        columns = prepare_statement(df)
+        statement_id, new_balance = post_statement(conn, columns, account_name, filename, created_by,
+                                                   refresh=updates)
+
+    return IngestResult(
+        statement_id=statement_id,
+        rows=len(df),
+        total_debit=columns['total_debit'],
+        total_credit=columns['total_credit'],
+        new_balance=new_balance,
+        elapsed=time.perf_counter() - started,
+        skipped=len(report) - len(updates),
+        updated=len(updates),
+    )
+
+
+def spool_upload(uploaded_file, directory=None):
+    """Copy an uploaded file to disk in blocks.
+
+    Returns ``(path, sha256)``; the digest identifies the file when resuming.
+    """
+    digest = hashlib.sha256()
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile('wb', suffix='.csv', dir=directory, delete=False) as spool:
+        while True:
+            block = uploaded_file.read(1024 * 1024)
+            if not block:
+                break
+            digest.update(block)
+            spool.write(block)
+    return spool.name, digest.hexdigest()
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_chunks(path, chunksize):
+    return pd.read_csv(path, encoding='utf-8-sig', dtype=TEXT_DTYPES, chunksize=chunksize)
+
+
+def _scan_statement(conn, path, account_name, chunksize, skip_rows, duplicates='reject', statement_id=None):
+    """First pass: validate every chunk, check its ref numbers and total the file.
+
+    The file's refs and line fingerprints are staged on disk (see
+    ``_scan_keys``) rather than held in memory; only totals, the positions of
+    duplicate rows and any upsert updates are kept, so memory grows with the
+    number of duplicates, not the file. Duplicates are resolved before
+    anything is written; in 'reject' mode the scan stops at the first chunk
+    that has any and reports that chunk's.
+    """
+    totals = {'rows': 0, 'posted': 0, 'total_debit': 0, 'total_credit': 0, 'remaining_delta': 0,
+              'drop': set(), 'updates': []}
+    with _scan_keys(conn):
+        for chunk in _read_chunks(path, chunksize):
+            validate_statement(chunk)
+            report = find_duplicates(conn, chunk, account_name, exclude_statement=statement_id, staged=True)
+            totals['rows'] += len(chunk)
+            # The write pass drops rows chunk by chunk; only their positions are needed
+            report.rows = totals['rows']
+            _, updates = resolve_duplicates(pd.DataFrame(), report, duplicates)
+            totals['updates'].extend(updates)
+            totals['drop'].update(report.duplicates.index)
+            chunk = chunk[~chunk.index.isin(report.duplicates.index)]
+            if chunk.empty:
+                continue
+            columns = prepare_statement(chunk)
+            totals['posted'] += len(chunk)
+            totals['total_debit'] += columns['total_debit']
+            totals['total_credit'] += columns['total_credit']
+            if chunk.index[-1] >= skip_rows:
+                pending = prepare_statement(chunk[chunk.index >= skip_rows])
+                totals['remaining_delta'] += pending['balance_delta']
+    if totals['rows'] == 0:
+        raise IngestError("CSV contains no transactions.")
+    return totals
+
+
+def ingest_statement_stream(conn, path, account_name, filename, created_by,
+                            chunksize=CHUNK_SIZE, file_hash=None, progress=None, duplicates='reject'):
+    """Post a statement CSV from disk in fixed-size chunks.
+
+    The file is read twice: once to validate it, resolve duplicate refs and
+    keep running debit/credit totals, then again to write it, committing each
+    chunk in its own transaction. Progress is recorded in
+    ``statement_imports``, so re-running the same file for the same account
+    resumes after the last committed chunk. The main account balance is
+    checked again under the write lock before each chunk; a chunk that would
+    overdraw it stops the import, which stays resumable. ``progress`` is
+    called with ``(rows_committed, total_rows)``.
+    """
+    started = time.perf_counter()
+    file_hash = file_hash or file_digest(path)
+    c = conn.cursor()
+
+    c.execute("""
+    SELECT statement_id, rows_committed FROM statement_imports
+    WHERE file_hash = ? AND account_name = ? AND status = 'in_progress'
+    ORDER BY created_at DESC LIMIT 1
+    """, (file_hash, account_name))
+    existing = c.fetchone()
+    statement_id, resumed_rows = existing if existing else (str(uuid.uuid4())[:8], 0)
+
+    totals = _scan_statement(conn, path, account_name, chunksize, resumed_rows, duplicates,
+                             statement_id if existing else None)
+    skipped = len(totals['drop']) - len(totals['updates'])
+
+    if not existing and not totals['posted']:
+        # Every line is already posted; there is no statement to create
+        return IngestResult(
+            statement_id=None, rows=0, total_debit=0, total_credit=0,
+            new_balance=_refresh_only(conn, totals['updates']), elapsed=time.perf_counter() - started,
+            skipped=skipped, updated=len(totals['updates']))
+
+    c.execute("SELECT balance FROM main_account LIMIT 1")
+    main_balance = c.fetchone()[0] or 0
+    if main_balance + totals['remaining_delta'] < 0:
+        raise IngestError(f"Insufficient Main Account balance for debit transactions "
+                          f"({format_money(totals['total_debit'])} required).")
+
+    now = datetime.datetime.now().isoformat()
+    if not existing:
+        with conn:
+            c.execute("""
+            INSERT INTO statements (
+                id, filename, upload_date, created_by, created_at
+            ) VALUES (?, ?, ?, ?, ?)
+            """, (statement_id, filename, now, created_by, now))
+            c.execute("""
+            INSERT INTO statement_imports (
+                statement_id, file_hash, filename, account_name, total_rows,
+                rows_committed, status, created_by, created_at, updated_at
+            ) VALUES (?, ?, ?, ?, ?, 0, 'in_progress', ?, ?, ?)
+            """, (statement_id, file_hash, filename, account_name, totals['rows'],
+                  created_by, now, now))
+
+    rows_committed = resumed_rows
+    for chunk in _read_chunks(path, chunksize):
+        if chunk.index[-1] < rows_committed:
+            continue
+        chunk = chunk[chunk.index >= rows_committed]
+        new_rows = chunk[~chunk.index.isin(totals['drop'])]
+        chunk_time = datetime.datetime.now().isoformat()
+
+        with conn:
+            # Other debits may have posted since the scan; check this chunk under the write lock
+            c.execute("BEGIN IMMEDIATE")
+            if not new_rows.empty:
+                columns = prepare_statement(new_rows)
+                c.execute("SELECT balance FROM main_account LIMIT 1")
+                if (c.fetchone()[0] or 0) + columns['balance_delta'] < 0:
+                    raise IngestError(f"Insufficient Main Account balance for debit transactions after "
+                                      f"{rows_committed:,} of {totals['rows']:,} rows "
+                                      f"({format_money(columns['total_debit'])} required by the next chunk). "
+                                      f"Upload the file again to resume once funds are available.")
+                write_statement_rows(c, columns, account_name, statement_id, created_by, chunk_time)
+                record_transactions(c, {account_name: len(new_rows)})
+                bump_generation(c, 'statements', 'transactions', 'allocations', 'main_account')
+                c.execute("UPDATE main_account SET balance = balance + ?", (columns['balance_delta'],))
+                post_daily_main(c, columns['daily_deltas'], 'statement', statement_id)
+            # rows_committed counts file rows, skipped duplicates included, so resuming stays positional
+            rows_committed += len(chunk)
+            c.execute("""
+            UPDATE statement_imports SET rows_committed = ?, updated_at = ?
+            WHERE statement_id = ?
+            """, (rows_committed, chunk_time, statement_id))
+
+        if progress:
+            progress(rows_committed, totals['rows'])
+
+    with conn:
+        refresh_details(c, totals['updates'])
+        c.execute("""
+        UPDATE statement_imports SET status = 'completed', updated_at = ?
+        WHERE statement_id = ?
+        """, (datetime.datetime.now().isoformat(), statement_id))
+        c.execute("SELECT balance FROM main_account LIMIT 1")
+        new_balance = c.fetchone()[0]
+
+    return IngestResult(
+        statement_id=statement_id,
+        rows=totals['posted'],
+        total_debit=totals['total_debit'],
+        total_credit=totals['total_credit'],
+        new_balance=new_balance,
+        elapsed=time.perf_counter() - started,
+        resumed_rows=resumed_rows,
+        skipped=skipped,
+        updated=len(totals['updates']),
+    )
+
+
+def ingest_upload_stream(conn, uploaded_file, account_name, created_by,
+                         chunksize=CHUNK_SIZE, progress=None, duplicates='reject'):
+    """Spool an uploaded file to disk and stream it through ingest_statement_stream()."""
+    path, file_hash = spool_upload(uploaded_file)
+    try:
+        return ingest_statement_stream(conn, path, account_name, uploaded_file.name, created_by,
+                                       chunksize=chunksize, file_hash=file_hash, progress=progress,
+                                       duplicates=duplicates)
+    finally:
+        os.remove(path)
@@ -0,0 +1,264 @@
+import argparse
+import datetime
+import sys
+import uuid
+
+import pandas as pd
+
+from money import dollar_columns
+
+MAIN = 'main'
+DEPARTMENT = 'department'
+EXTERNAL = 'external'
+
+MAIN_ACCOUNT = (MAIN, 'main')
+# Contra accounts that balance each entry: money entering or leaving through
+# the bank, money moved between the unallocated pool and departments, and the
+# opening balances written when the ledger was introduced
+BANK = (EXTERNAL, 'bank')
+UNALLOCATED = (EXTERNAL, 'unallocated')
+OPENING = (EXTERNAL, 'opening')
+
+# Amounts are integer cents, so entries and balances must agree exactly
+BALANCE_TOLERANCE = 0
+
+
+def _date(value):
+    return str(value)[:10]
+
+
+def post_entry(c, effective_date, source, source_ref, legs):
+    """Append one balanced entry; ``legs`` is a list of ``(account, amount)``.
+
+    Checkpoints at or after a back-dated ``effective_date`` are moved by the
+    same amounts so they stay correct without a rebuild.
+    """
+    if abs(sum(amount for _, amount in legs)) > BALANCE_TOLERANCE:
+        raise ValueError(f"Unbalanced ledger entry for {source} {source_ref}")
+    entry_id = uuid.uuid4().hex[:16]
+    effective_date = _date(effective_date)
+    now = datetime.datetime.now().isoformat()
+    c.executemany("""
+    INSERT INTO ledger_postings (
+        entry_id, account_type, account_id, amount, effective_date, source, source_ref, created_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(entry_id, account[0], account[1], amount, effective_date, source, source_ref, now)
+          for account, amount in legs])
+    c.executemany("""
+    UPDATE ledger_checkpoints SET balance = balance + ?
+    WHERE account_type = ? AND account_id = ? AND as_of >= ?
+    """, [(amount, account[0], account[1], effective_date) for account, amount in legs])
+    return entry_id
+
+
+def post_main(c, amount, effective_date, source, source_ref):
+    """Main account change against the bank, e.g. a statement line."""
+    return post_entry(c, effective_date, source, source_ref, [(MAIN_ACCOUNT, amount), (BANK, -amount)])
+
+
+def post_department(c, department_id, amount, effective_date, source, source_ref):
+    """Department balance change against the unallocated pool, e.g. an allocation."""
+    return post_entry(c, effective_date, source, source_ref,
+                      [((DEPARTMENT, str(department_id)), amount), (UNALLOCATED, -amount)])
+
+
+def post_daily_main(c, daily_deltas, source, source_ref):
+    """One main account entry per effective date for a bulk write.
+
+    ``daily_deltas`` maps date to the net balance change of that day's rows;
+    individual lines stay in ``transactions``.
+    """
+    for effective_date, amount in sorted(daily_deltas.items()):
+        if amount:
+            post_main(c, amount, effective_date, source, source_ref)
+
+
+def refresh_checkpoints(c, through=None):
+    """Write month-end checkpoints for every closed month up to ``through``.
+
+    Each checkpoint is the previous one plus the postings since, so a refresh
+    only scans postings that are not yet covered.
+    """
+    if through is None:
+        through = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+    through = _date(through)
+
+    c.execute("SELECT MAX(as_of) FROM ledger_checkpoints")
+    previous = c.fetchone()[0]
+    if previous is None:
+        c.execute("SELECT MIN(effective_date) FROM ledger_postings")
+        first = c.fetchone()[0]
+        if first is None:
+            return 0
+        month = datetime.date.fromisoformat(first).replace(day=1)
+        previous = ''
+    else:
+        month = datetime.date.fromisoformat(previous) + datetime.timedelta(days=1)
+
+    written = 0
+    while True:
+        next_month = (month.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        as_of = (next_month - datetime.timedelta(days=1)).isoformat()
+        if as_of > through:
+            return written
+        c.execute("""
+        INSERT INTO ledger_checkpoints (account_type, account_id, as_of, balance)
+        SELECT account_type, account_id, ?, SUM(amount) FROM (
+            SELECT account_type, account_id, balance AS amount
+            FROM ledger_checkpoints WHERE as_of = ?
+            UNION ALL
+            SELECT account_type, account_id, amount
+            FROM ledger_postings WHERE effective_date > ? AND effective_date <= ?
+        )
+        GROUP BY account_type, account_id
+        """, (as_of, previous, previous, as_of))
+        written += 1
+        previous, month = as_of, next_month
+
+
+def balance_at(conn, account, as_of):
+    """Balance of ``account`` at the end of ``as_of``: latest checkpoint plus later postings."""
+    account_type, account_id = account
+    as_of = _date(as_of)
+    c = conn.cursor()
+    c.execute("""
+    SELECT as_of, balance FROM ledger_checkpoints
+    WHERE account_type = ? AND account_id = ? AND as_of <= ?
+    ORDER BY as_of DESC LIMIT 1
+    """, (account_type, account_id, as_of))
+    checkpoint_date, balance = c.fetchone() or ('', 0)
+    c.execute("""
+    SELECT COALESCE(SUM(amount), 0) FROM ledger_postings
+    WHERE account_type = ? AND account_id = ? AND effective_date > ? AND effective_date <= ?
+    """, (account_type, account_id, checkpoint_date, as_of))
+    return balance + c.fetchone()[0]
+
+
+def balances_at(conn, as_of):
+    """Main account and department balances at the end of ``as_of``."""
+    as_of = _date(as_of)
+    c = conn.cursor()
+    c.execute("SELECT COALESCE(MAX(as_of), '') FROM ledger_checkpoints WHERE as_of <= ?", (as_of,))
+    checkpoint_date = c.fetchone()[0]
+    return pd.read_sql("""
+    SELECT CASE WHEN b.account_type = 'main' THEN 'Main Account' ELSE COALESCE(d.name, b.account_id) END AS account,
+           b.account_type, b.balance
+    FROM (
+        SELECT account_type, account_id, SUM(amount) AS balance FROM (
+            SELECT account_type, account_id, balance AS amount
+            FROM ledger_checkpoints WHERE as_of = ?
+            UNION ALL
+            SELECT account_type, account_id, amount
+            FROM ledger_postings WHERE effective_date > ? AND effective_date <= ?
+        )
+        WHERE account_type != 'external'
+        GROUP BY account_type, account_id
+    ) b
+    LEFT JOIN departments d ON b.account_type = 'department' AND d.id = b.account_id
+    ORDER BY b.account_type DESC, account
+    """, conn, params=(checkpoint_date, checkpoint_date, as_of))
+
+
+def ledger_drift(conn):
+    """Accounts whose ledger total disagrees with the stored current balance."""
+    return pd.read_sql("""
+    SELECT l.account_type, l.account_id, l.total AS ledger_balance, b.balance AS stored_balance
+    FROM (
+        SELECT account_type, account_id, SUM(amount) AS total FROM ledger_postings
+        WHERE account_type != 'external' GROUP BY account_type, account_id
+    ) l
+    JOIN (
+        SELECT 'main' AS account_type, 'main' AS account_id, balance FROM main_account
+        UNION ALL
+        SELECT 'department', id, balance FROM departments
+    ) b ON b.account_type = l.account_type AND b.account_id = l.account_id
+    WHERE ABS(l.total - b.balance) > ?
+    """, conn, params=(BALANCE_TOLERANCE,))
+
+
+def _backfill(c):
+    """Post the existing history, then open each account at its stored balance.
+
+    Runs in migration 7, while amounts were still REAL dollars.
+    """
+    now = datetime.datetime.now().isoformat()
+    # One two-leg entry per transaction, using the same balance effect as ingest
+    c.execute("""
+    INSERT INTO ledger_postings (entry_id, account_type, account_id, amount, effective_date,
+                                 source, source_ref, created_at)
+    SELECT 'tx-' || t.rowid, leg.account_type, leg.account_id, leg.sign * (
+               CASE WHEN COALESCE(t.debit_amount, 0) > 0
+                    THEN -(t.debit_amount + COALESCE(t.tax_amount, 0))
+                    ELSE COALESCE(t.credit_amount, 0) - COALESCE(t.tax_amount, 0) END),
+           substr(t.transaction_date, 1, 10), 'transaction', t.ref_number, ?
+    FROM transactions t
+    CROSS JOIN (SELECT 'main' AS account_type, 'main' AS account_id, 1 AS sign
+                UNION ALL SELECT 'external', 'bank', -1) leg
+    WHERE t.transaction_date IS NOT NULL
+    """, (now,))
+    c.execute("""
+    INSERT INTO ledger_postings (entry_id, account_type, account_id, amount, effective_date,
+                                 source, source_ref, created_at)
+    SELECT 'alloc-' || a.rowid, COALESCE(leg.account_type, 'department'),
+           COALESCE(leg.account_id, a.department_id),
+           leg.sign * CASE WHEN a.transaction_type = 'Debit' THEN -a.amount ELSE a.amount END,
+           substr(a.created_at, 1, 10), 'allocation', a.treasury_ref, ?
+    FROM allocations a
+    CROSS JOIN (SELECT NULL AS account_type, NULL AS account_id, 1 AS sign
+                UNION ALL SELECT 'external', 'unallocated', -1) leg
+    WHERE a.department_id IS NOT NULL
+    """, (now,))
+
+    # Whatever the history does not explain (seeded or hand-edited balances)
+    # becomes an opening entry dated before the first posting
+    c.execute("SELECT COALESCE(MIN(effective_date), date('now')) FROM ledger_postings")
+    opening_date = (datetime.date.fromisoformat(c.fetchone()[0]) - datetime.timedelta(days=1)).isoformat()
+    c.execute("""
+    SELECT b.account_type, b.account_id, b.balance - COALESCE(SUM(p.amount), 0)
+    FROM (
+        SELECT 'main' AS account_type, 'main' AS account_id, COALESCE(balance, 0) AS balance FROM main_account
+        UNION ALL
+        SELECT 'department', id, COALESCE(balance, 0) FROM departments
+    ) b
+    LEFT JOIN ledger_postings p ON p.account_type = b.account_type AND p.account_id = b.account_id
+    GROUP BY b.account_type, b.account_id
+    """)
+    for account_type, account_id, difference in c.fetchall():
+        # Half a cent: anything smaller is float noise in the dollar amounts
+        if abs(difference) > 0.005:
+            post_entry(c, opening_date, 'opening', None,
+                       [((account_type, account_id), difference), (OPENING, -difference)])
+    refresh_checkpoints(c)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ledger checkpoints and balance queries.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('checkpoint', help="Write month-end checkpoints for closed months")
+    balance = sub.add_parser('balance', help="Balances at the end of a date")
+    balance.add_argument('as_of', help="Date (YYYY-MM-DD)")
+    sub.add_parser('verify', help="Compare ledger totals with stored balances")
+    args = parser.parse_args(argv)
+
+    from database import ensure_schema, get_connection
+
+    ensure_schema()
+    with get_connection() as conn:
+        if args.command == 'checkpoint':
+            with conn:
+                written = refresh_checkpoints(conn.cursor())
+            print(f"{written} checkpoint(s) written")
+        elif args.command == 'balance':
+            print(dollar_columns(balances_at(conn, args.as_of), 'balance').to_string(index=False))
+        else:
+            drift = ledger_drift(conn)
+            if drift.empty:
+                print("Ledger agrees with stored balances")
+            else:
+                print(dollar_columns(drift, 'ledger_balance', 'stored_balance').to_string(index=False))
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+import argparse
+import datetime
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+
+from audit import record_audit
+from ingest import new_ids
+from ledger import BANK, DEPARTMENT, MAIN_ACCOUNT, UNALLOCATED, post_entry, refresh_checkpoints
+from money import format_money, to_dollars
+from query_cache import bump_generation
+from summary import record_investment_matured, record_transactions
+
+# Seconds between background runs; 0 disables the in-app scheduler
+DEFAULT_INTERVAL = int(os.environ.get('TREASURY_MATURITY_INTERVAL', 3600))
+
+
+@dataclass
+class MaturityResult:
+    """Deals settled by a run; ``principal`` and ``credited`` are in cents."""
+    matured: int = 0
+    principal: int = 0
+    credited: int = 0
+    elapsed: float = 0.0
+
+
+def due_investments(c, as_of):
+    """Confirmed investments maturing on or before ``as_of`` (served by idx_investments_status_maturity)."""
+    c.execute("""
+    SELECT id, ref_number, department_id, account_name, amount, maturity_amount, maturity_date
+    FROM investments
+    WHERE status = 'confirmed' AND maturity_date < date(?, '+1 day')
+    ORDER BY maturity_date
+    """, (str(as_of)[:10],))
+    return c.fetchall()
+
+
+def _tally(result, due):
+    result.matured = len(due)
+    result.principal = sum(row[4] or 0 for row in due)
+    result.credited = sum(row[5] or 0 for row in due)
+
+
+def process_maturities(conn, as_of=None, created_by='system', dry_run=False):
+    """Settle every confirmed investment that has reached maturity.
+
+    All due deals are credited in one transaction: a credit transaction and a
+    department allocation per deal, one main account update, one update per
+    department and one ledger entry per maturity date. Deals are marked
+    ``matured`` with a status guard, so re-running (or running from two
+    processes at once) never credits a deal twice. A ``dry_run`` only reads
+    and never takes the write lock.
+    """
+    started = time.perf_counter()
+    as_of = as_of or datetime.date.today()
+    result = MaturityResult()
+    c = conn.cursor()
+
+    if dry_run:
+        _tally(result, due_investments(c, as_of))
+        result.elapsed = time.perf_counter() - started
+        return result
+
+    with conn:
+        c.execute("BEGIN IMMEDIATE")
+        due = due_investments(c, as_of)
+        if not due:
+            result.elapsed = time.perf_counter() - started
+            return result
+        _tally(result, due)
+
+        now = datetime.datetime.now().isoformat()
+        transaction_ids = new_ids(len(due))
+        allocation_ids = new_ids(len(due))
+        department_totals = defaultdict(int)
+        by_date = defaultdict(lambda: defaultdict(int))
+        account_counts = defaultdict(int)
+        transactions, allocations = [], []
+
+        for i, (_, ref_number, department_id, account_name, _, maturity_amount, maturity_date) in enumerate(due):
+            amount = maturity_amount or 0
+            settle_date = str(maturity_date)[:10]
+            settle_ref = f"MAT-{ref_number}"
+            transactions.append((
+                transaction_ids[i], settle_ref, settle_date, settle_date,
+                f"Investment maturity: {ref_number}", 0, amount, 0.0, 0,
+                'Credit', 'Investment Maturity', created_by, now, account_name
+            ))
+            account_counts[account_name] += 1
+            by_date[settle_date][MAIN_ACCOUNT] += amount
+            by_date[settle_date][BANK] -= amount
+            if department_id:
+                allocations.append((allocation_ids[i], settle_ref, department_id, amount, created_by, now))
+                department_totals[department_id] += amount
+                by_date[settle_date][(DEPARTMENT, str(department_id))] += amount
+                by_date[settle_date][UNALLOCATED] -= amount
+
+        c.executemany("""
+        INSERT INTO transactions (
+            id, ref_number, transaction_date, value_date, narration,
+            debit_amount, credit_amount, tax_percentage, tax_amount,
+            type, credit_type, created_by, created_at, account_name
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, transactions)
+        # Maturities go straight back to the investing department
+        c.executemany("""
+        INSERT INTO allocations (
+            id, treasury_ref, department_id, amount, created_by, created_at, transaction_type
+        ) VALUES (?, ?, ?, ?, ?, ?, 'Credit')
+        """, allocations)
+        c.execute("UPDATE main_account SET balance = balance + ?", (result.credited,))
+        c.executemany("UPDATE departments SET balance = COALESCE(balance, 0) + ? WHERE id = ?",
+                      [(total, department_id) for department_id, total in department_totals.items()])
+        c.executemany("UPDATE investments SET status = 'matured' WHERE id = ? AND status = 'confirmed'",
+                      [(row[0],) for row in due])
+
+        for settle_date, legs in sorted(by_date.items()):
+            post_entry(c, settle_date, 'maturity', f"{len(due)} maturities", list(legs.items()))
+        record_transactions(c, account_counts)
+        for row in due:
+            record_investment_matured(c, row[2], row[6])
+        bump_generation(c, 'investments', 'transactions', 'allocations', 'main_account', 'departments')
+
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+class MaturityScheduler(threading.Thread):
+    """Daemon thread that settles maturities every ``interval`` seconds.
+
+    Each run also closes ledger checkpoints for months that have ended, so
+    balance queries on the read path never write.
+    """
+
+    def __init__(self, interval):
+        super().__init__(name='maturity-scheduler', daemon=True)
+        self.interval = interval
+        self.last_result = None
+        self.last_error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        from database import get_connection
+
+        while not self._stop_event.is_set():
+            try:
+                with get_connection() as conn:
+                    self.last_result = process_maturities(conn)
+                    with conn:
+                        refresh_checkpoints(conn.cursor())
+                if self.last_result.matured:
+                    record_audit('investment.mature', matured=self.last_result.matured,
+                                 credited=to_dollars(self.last_result.credited))
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def start_scheduler(interval=DEFAULT_INTERVAL):
+    """Start the background scheduler once per process; returns it (or None when disabled)."""
+    global _scheduler
+    if interval <= 0:
+        return None
+    with _scheduler_lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = MaturityScheduler(interval)
+            _scheduler.start()
+    return _scheduler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Settle confirmed investments that have reached maturity.")
+    parser.add_argument('--as-of', help="Settle deals maturing on or before this date (default: today)")
+    parser.add_argument('--dry-run', action='store_true', help="Report what would mature without writing")
+    args = parser.parse_args(argv)
+
+    from database import ensure_schema, get_connection
+
+    ensure_schema()
+    with get_connection() as conn:
+        result = process_maturities(conn, as_of=args.as_of, dry_run=args.dry_run)
+    if result.matured and not args.dry_run:
+        record_audit('investment.mature', matured=result.matured, credited=to_dollars(result.credited))
+    verb = "would mature" if args.dry_run else "matured"
+    print(f"{result.matured} investment(s) {verb}: principal {format_money(result.principal)}, "
+          f"credited {format_money(result.credited)} in {result.elapsed:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
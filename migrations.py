@@ -0,0 +1,473 @@
+import datetime
+import hashlib
+import re
+import uuid
+
+import pandas as pd
+
+import ledger
+import summary
+import tariff_store
+from ingest import BATCH_SIZE, line_fingerprints
+from money import MONEY_COLUMNS, cents_array
+from query_cache import ALL_TABLES, bump_generation
+
+
+def _baseline_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS main_account (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT DEFAULT 'Main Account',
+        balance REAL NOT NULL DEFAULT 0.0,
+        created_at TEXT NOT NULL
+    )''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        role TEXT NOT NULL,
+        department_id TEXT,
+        created_by TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS departments (
+        id TEXT PRIMARY KEY NOT NULL UNIQUE,
+        name TEXT NOT NULL UNIQUE,
+        balance REAL DEFAULT 0,
+        created_by TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS transactions (
+        id TEXT PRIMARY KEY NOT NULL,
+        ref_number TEXT UNIQUE NOT NULL,
+        transaction_date TEXT NOT NULL,
+        value_date TEXT,
+        narration TEXT,
+        debit_amount REAL,
+        credit_amount REAL,
+        tax_percentage REAL,
+        tax_amount REAL,
+        statement_id TEXT,
+        created_by TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        type TEXT,
+        credit_type TEXT,
+        debit_type TEXT,
+        account_name TEXT
+    )''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS statements (
+        id TEXT PRIMARY KEY,
+        filename TEXT NOT NULL,
+        upload_date TEXT NOT NULL,
+        created_by TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS investments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ref_number TEXT UNIQUE NOT NULL,
+        amount REAL,
+        created_by TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        transaction_ref TEXT,
+        department_id TEXT,
+        account_name TEXT,
+        period INTEGER,
+        value_date TEXT,
+        interest_rate REAL,
+        maturity_date TEXT,
+        interest REAL,
+        withholding_tax REAL,
+        maturity_amount REAL,
+        allocation_id TEXT
+    )''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS allocations (
+        id TEXT PRIMARY KEY,
+        treasury_ref TEXT NOT NULL,
+        department_id TEXT,
+        amount REAL NOT NULL,
+        statement_id TEXT,
+        created_by TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        transaction_type TEXT
+    )''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS taxes_tariffs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        description TEXT NOT NULL,
+        rate REAL NOT NULL,
+        created_by TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS audit_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        action TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        created_at TEXT NOT NULL
+    )''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS bank_tariff_guides (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bank_name TEXT NOT NULL,
+        document_name TEXT NOT NULL,
+        document_data BLOB NOT NULL,
+        upload_date TEXT NOT NULL,
+        created_by TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )''')
+
+    # Initialize main account if not exists
+    c.execute("SELECT COUNT(*) FROM main_account")
+    if c.fetchone()[0] == 0:
+        c.execute("INSERT INTO main_account (name, balance, created_at) VALUES (?, ?, ?)",
+                  ('Main Account', 0, datetime.datetime.now().isoformat()))
+
+    # Create default admin user if not exists
+    c.execute("SELECT COUNT(*) FROM users WHERE username = 'admin'")
+    if c.fetchone()[0] == 0:
+        c.execute("INSERT INTO users (username, password, role, department_id, created_by, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                  ('admin', hashlib.sha256('admin123'.encode('utf-8')).hexdigest(), 'admin', None, 'system', datetime.datetime.now().isoformat()))
+
+    # Create Treasury Department if not exists
+    c.execute("SELECT COUNT(*) FROM departments WHERE name = 'Treasury'")
+    if c.fetchone()[0] == 0:
+        c.execute("INSERT INTO departments (id, name, balance, created_by, created_at) VALUES (?, ?, ?, ?, ?)",
+                  (str(uuid.uuid4())[:8], 'Treasury', 0, 'system', datetime.datetime.now().isoformat()))
+
+
+def _statement_imports(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS statement_imports (
+        statement_id TEXT PRIMARY KEY,
+        file_hash TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        account_name TEXT NOT NULL,
+        total_rows INTEGER NOT NULL,
+        rows_committed INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'in_progress',
+        created_by TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )''')
+    
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_statement_imports_file
+                 ON statement_imports (file_hash, account_name, status)""")
+
+
+def _hot_path_indexes(c):
+    # Pending allocations join on treasury_ref; (department_id, created_at) serves both
+    # the department_id IS NULL filter and its ORDER BY created_at
+    c.execute("CREATE INDEX IF NOT EXISTS idx_allocations_treasury_ref ON allocations (treasury_ref)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_allocations_department ON allocations (department_id, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_allocations_created_at ON allocations (created_at)")
+
+    # Reconciliation, statement verification, exports and the dashboard
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_transactions_statement_account
+                 ON transactions (statement_id, account_name)""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions (transaction_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_account ON transactions (account_name)")
+
+    # Active investment listings and maturity processing
+    c.execute("CREATE INDEX IF NOT EXISTS idx_investments_status_maturity ON investments (status, maturity_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_investments_department ON investments (department_id, status)")
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_statements_upload_date ON statements (upload_date)")
+
+    c.execute("ANALYZE")
+
+
+def _summary_state(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS summary_state (
+        metric TEXT NOT NULL,
+        dimension TEXT NOT NULL DEFAULT '',
+        bucket TEXT NOT NULL DEFAULT '',
+        value INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (metric, dimension, bucket)
+    ) WITHOUT ROWID""")
+    summary._rebuild(c)
+
+
+def _write_generations(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS write_generations (
+        table_name TEXT PRIMARY KEY,
+        generation INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID""")
+
+
+def _tariff_document_store(c):
+    c.execute("""CREATE TABLE bank_tariff_guides_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bank_name TEXT NOT NULL,
+        document_name TEXT NOT NULL,
+        content_hash TEXT NOT NULL,
+        size_bytes INTEGER NOT NULL,
+        upload_date TEXT NOT NULL,
+        created_by TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )""")
+    store = tariff_store.get_store()
+    # Move one BLOB at a time out to the file store
+    ids = [row[0] for row in c.execute("SELECT id FROM bank_tariff_guides ORDER BY id").fetchall()]
+    for tariff_id in ids:
+        c.execute("""
+        SELECT bank_name, document_name, document_data, upload_date, created_by, created_at
+        FROM bank_tariff_guides WHERE id = ?
+        """, (tariff_id,))
+        bank_name, document_name, data, upload_date, created_by, created_at = c.fetchone()
+        digest, size = store.put(bytes(data))
+        c.execute("""
+        INSERT INTO bank_tariff_guides_new (
+            id, bank_name, document_name, content_hash, size_bytes, upload_date, created_by, created_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (tariff_id, bank_name, document_name, digest, size, upload_date, created_by, created_at))
+    c.execute("DROP TABLE bank_tariff_guides")
+    c.execute("ALTER TABLE bank_tariff_guides_new RENAME TO bank_tariff_guides")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bank_tariff_guides_upload_date ON bank_tariff_guides (upload_date)")
+
+
+def _ledger(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS ledger_postings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        entry_id TEXT NOT NULL,
+        account_type TEXT NOT NULL,
+        account_id TEXT NOT NULL,
+        amount REAL NOT NULL,
+        effective_date TEXT NOT NULL,
+        source TEXT NOT NULL,
+        source_ref TEXT,
+        created_at TEXT NOT NULL
+    )""")
+    # Point-in-time delta scans per account, and checkpoint refreshes by date
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_ledger_postings_account
+                 ON ledger_postings (account_type, account_id, effective_date)""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ledger_postings_date ON ledger_postings (effective_date)")
+    c.execute("""CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+        account_type TEXT NOT NULL,
+        account_id TEXT NOT NULL,
+        as_of TEXT NOT NULL,
+        balance REAL NOT NULL,
+        PRIMARY KEY (account_type, account_id, as_of)
+    ) WITHOUT ROWID""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ledger_checkpoints_as_of ON ledger_checkpoints (as_of)")
+    ledger._backfill(c)
+
+
+def _allocation_rules(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS allocation_rules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        narration_pattern TEXT,
+        account_name TEXT,
+        transaction_type TEXT,
+        min_amount REAL,
+        max_amount REAL,
+        priority INTEGER NOT NULL DEFAULT 100,
+        active INTEGER NOT NULL DEFAULT 1,
+        created_by TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )""")
+    # Percentage of the matched amount each department receives
+    c.execute("""CREATE TABLE IF NOT EXISTS allocation_rule_splits (
+        rule_id INTEGER NOT NULL REFERENCES allocation_rules (id) ON DELETE CASCADE,
+        department_id TEXT NOT NULL,
+        share REAL NOT NULL,
+        PRIMARY KEY (rule_id, department_id)
+    ) WITHOUT ROWID""")
+
+
+def _explorer_indexes(c):
+    # Account-filtered explorer pages seek on (account_name, transaction_date);
+    # the single-column account index is a prefix of it
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_transactions_account_date
+                 ON transactions (account_name, transaction_date)""")
+    c.execute("DROP INDEX IF EXISTS idx_transactions_account")
+    c.execute("ANALYZE transactions")
+
+
+def _audit_log_columns(c):
+    add_column(c, 'audit_logs', 'username', 'TEXT')
+    add_column(c, 'audit_logs', 'role', 'TEXT')
+    add_column(c, 'audit_logs', 'entity_type', 'TEXT')
+    add_column(c, 'audit_logs', 'entity_id', 'TEXT')
+    add_column(c, 'audit_logs', 'details', 'TEXT')
+    # The viewer filters by user, action and time range, newest first
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_logs_username ON audit_logs (username, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_logs_action ON audit_logs (action, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_logs_created_at ON audit_logs (created_at)")
+
+
+def _investment_currency(c):
+    # Department investments record their currency; older rows are USD
+    add_column(c, 'investments', 'currency', "TEXT DEFAULT 'USD'")
+
+
+def _statement_fingerprints(c):
+    add_column(c, 'transactions', 'fingerprint', 'TEXT')
+    # Backfill statement lines in rowid order; manual and investment rows have no fingerprint
+    last = 0
+    while True:
+        c.execute("""
+        SELECT rowid, account_name, transaction_date, narration, debit_amount, credit_amount
+        FROM transactions
+        WHERE rowid > ? AND statement_id IS NOT NULL
+        ORDER BY rowid LIMIT ?
+        """, (last, BATCH_SIZE))
+        batch = pd.DataFrame(c.fetchall(), columns=['rowid', 'account_name', 'transaction_date', 'narration',
+                                                    'debit_amount', 'credit_amount'])
+        if batch.empty:
+            break
+        # Amounts are still dollars at this version; they become cents in migration 13
+        batch['debit_amount'] = cents_array(batch['debit_amount'])
+        batch['credit_amount'] = cents_array(batch['credit_amount'])
+        for account_name, lines in batch.groupby(batch['account_name'].fillna(''), sort=False):
+            c.executemany("UPDATE transactions SET fingerprint = ? WHERE rowid = ?",
+                          zip(line_fingerprints(account_name, lines), lines['rowid'].tolist()))
+        last = int(batch['rowid'].iloc[-1])
+    # Overlap checks look lines up by fingerprint; only statement lines have one
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_transactions_fingerprint
+                 ON transactions (fingerprint) WHERE fingerprint IS NOT NULL""")
+
+
+def _rebuild_with_integer_money(c, table, columns):
+    """Recreate ``table`` with ``columns`` declared INTEGER, converting dollars to cents.
+
+    SQLite cannot change a column's type and a REAL column would store the
+    cents as floats, so the table is copied into a new one, keeping rowids,
+    then swapped in and its indexes recreated.
+    """
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    ddl = c.fetchone()[0]
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))
+    indexes = [row[0] for row in c.fetchall()]
+    names = [row[1] for row in c.execute(f"PRAGMA table_info({table})").fetchall()]
+
+    ddl = re.sub(r'^CREATE TABLE (IF NOT EXISTS )?"?\w+"?', f'CREATE TABLE {table}_cents', ddl)
+    for column in columns:
+        ddl = re.sub(rf'\b{column}\s+REAL\b([^,)]*?)\bDEFAULT\s+0(\.0)?\b', rf'{column} INTEGER\1DEFAULT 0', ddl)
+        ddl = re.sub(rf'\b{column}\s+REAL\b', f'{column} INTEGER', ddl)
+    c.execute(ddl)
+
+    # Tables with an INTEGER PRIMARY KEY copy it as a column; other rowid tables copy the rowid
+    keep_rowid = 'WITHOUT ROWID' not in ddl.upper() and 'INTEGER PRIMARY KEY' not in ddl.upper()
+    targets = (['rowid'] if keep_rowid else []) + names
+    # ROUND(x * 100, 6) first, as in money.to_cents, so 0.285 becomes 29 cents
+    values = (['rowid'] if keep_rowid else []) + [
+        f"CAST(ROUND(ROUND({name} * 100, 6)) AS INTEGER)" if name in columns else name for name in names]
+    c.execute(f"INSERT INTO {table}_cents ({', '.join(targets)}) SELECT {', '.join(values)} FROM {table}")
+    c.execute(f"DROP TABLE {table}")
+    c.execute(f"ALTER TABLE {table}_cents RENAME TO {table}")
+    for sql in indexes:
+        c.execute(sql)
+
+
+def _integer_money(c):
+    # Percentage splits left sub-cent postings, and rounding each of them can
+    # move an account's ledger total off its rounded stored balance; carry that
+    # difference into the balance so the ledger still verifies exactly
+    c.execute("""
+    SELECT account_type, account_id,
+           SUM(CAST(ROUND(ROUND(amount * 100, 6)) AS INTEGER))
+           - CAST(ROUND(ROUND(SUM(amount) * 100, 6)) AS INTEGER) AS drift
+    FROM ledger_postings
+    WHERE account_type IN ('main', 'department')
+    GROUP BY account_type, account_id
+    HAVING drift != 0
+    """)
+    drifts = c.fetchall()
+    c.execute("SELECT MAX(as_of) FROM ledger_checkpoints")
+    checkpointed = c.fetchone()[0]
+
+    for table, columns in MONEY_COLUMNS.items():
+        _rebuild_with_integer_money(c, table, columns)
+
+    for account_type, account_id, drift in drifts:
+        if account_type == 'main':
+            c.execute("UPDATE main_account SET balance = balance + ?", (drift,))
+        else:
+            c.execute("UPDATE departments SET balance = balance + ? WHERE id = ?", (drift, account_id))
+    # Checkpoints are running sums of postings; rebuild them from the cent amounts
+    c.execute("DELETE FROM ledger_checkpoints")
+    if checkpointed:
+        ledger.refresh_checkpoints(c, through=checkpointed)
+    c.execute("ANALYZE")
+
+
+# Ordered (version, description, function) entries. Each runs exactly once per
+# database; append new entries rather than editing applied ones.
+MIGRATIONS = [
+    (1, "Baseline schema and seed data", _baseline_schema),
+    (2, "Statement import progress for chunked ingest", _statement_imports),
+    (3, "Indexes for allocation, transaction and investment access paths", _hot_path_indexes),
+    (4, "Incrementally maintained dashboard summary", _summary_state),
+    (5, "Per-table write generations for the query result cache", _write_generations),
+    (6, "Tariff guide documents moved to the content-addressed file store", _tariff_document_store),
+    (7, "Append-only ledger postings with month-end balance checkpoints", _ledger),
+    (8, "Rule-based auto-allocation", _allocation_rules),
+    (9, "Transaction explorer index on account and date", _explorer_indexes),
+    (10, "Structured audit log columns and indexes", _audit_log_columns),
+    (11, "Currency on investments", _investment_currency),
+    (12, "Statement line fingerprints for overlap detection", _statement_fingerprints),
+    (13, "Money stored as integer cents", _integer_money),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _ensure_version_table(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    )""")
+    conn.commit()
+
+
+def current_version(conn):
+    _ensure_version_table(conn)
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations").fetchone()[0]
+
+
+def add_column(c, table, column, definition):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists."""
+    existing = {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+    if column not in existing:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def migrate(conn):
+    """Apply every pending migration, each in its own write transaction.
+
+    Returns the list of versions applied. Safe to call concurrently from
+    several processes: the version is re-checked under the write lock.
+    """
+    applied = []
+    if current_version(conn) >= LATEST_VERSION:
+        return applied
+
+    for version, description, migration in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            c = conn.cursor()
+            c.execute("SELECT 1 FROM schema_migrations WHERE version = ?", (version,))
+            if c.fetchone():
+                conn.rollback()
+                continue
+            migration(c)
+            if version >= 5:
+                # Migrations may rewrite data in any table (write_generations exists
+                # from version 5), so invalidate every cached query
+                bump_generation(c, ALL_TABLES)
+            c.execute("INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)",
+                      (version, description, datetime.datetime.now().isoformat()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+# Money is stored and computed as integer cents. Dollars appear only at the
+# edges: form inputs, what the UI displays, uploaded statements and exports.
+CENTS = 100
+
+# Percentages are scaled to integers with four decimals before multiplying,
+# so tax and interest amounts come from exact integer arithmetic
+RATE_SCALE = 10_000
+
+# Columns holding cents, per table
+MONEY_COLUMNS = {
+    'main_account': ('balance',),
+    'departments': ('balance',),
+    'transactions': ('debit_amount', 'credit_amount', 'tax_amount'),
+    'investments': ('amount', 'interest', 'withholding_tax', 'maturity_amount'),
+    'allocations': ('amount',),
+    'ledger_postings': ('amount',),
+    'ledger_checkpoints': ('balance',),
+    'allocation_rules': ('min_amount', 'max_amount'),
+}
+
+
+def round_div(numerator, denominator):
+    """Integer division rounding half away from zero, for ints or int64 arrays."""
+    if np.ndim(numerator) == 0:
+        numerator = int(numerator)
+        quotient = (abs(numerator) + denominator // 2) // denominator
+        return quotient if numerator >= 0 else -quotient
+    numerator = np.asarray(numerator, dtype=np.int64)
+    return np.sign(numerator) * ((np.abs(numerator) + denominator // 2) // denominator)
+
+
+def to_cents(dollars):
+    """A dollar amount as integer cents, rounded half away from zero; None stays None."""
+    if dollars is None or pd.isna(dollars):
+        return None
+    # Rounding the product first absorbs binary noise such as 0.285 * 100 = 28.4999...
+    scaled = round(float(dollars) * CENTS, 6)
+    return int(np.sign(scaled) * np.floor(abs(scaled) + 0.5))
+
+
+def cents_array(dollars):
+    """Vectorized ``to_cents`` for a column of dollar amounts; missing values become 0."""
+    values = pd.to_numeric(pd.Series(np.asarray(dollars, dtype=object)), errors='coerce').fillna(0.0)
+    scaled = np.round(values.to_numpy(dtype=float) * CENTS, 6)
+    return (np.sign(scaled) * np.floor(np.abs(scaled) + 0.5)).astype(np.int64)
+
+
+def to_dollars(cents):
+    """Cents as a float dollar amount for display; None stays None."""
+    if cents is None or pd.isna(cents):
+        return None
+    return cents / CENTS
+
+
+def format_money(cents):
+    return f"${(cents or 0) / CENTS:,.2f}"
+
+
+def percent_of(cents, percentage):
+    """``percentage`` percent of ``cents`` in whole cents; scalars or arrays."""
+    rate = np.rint(np.asarray(percentage, dtype=float) * RATE_SCALE).astype(np.int64)
+    if np.ndim(cents) == 0 and rate.ndim == 0:
+        return round_div(int(cents) * int(rate), 100 * RATE_SCALE)
+    return round_div(np.asarray(cents, dtype=np.int64) * rate, 100 * RATE_SCALE)
+
+
+def dollar_columns(frame, *columns):
+    """Copy of ``frame`` with the named cent columns converted to dollars for display."""
+    frame = frame.copy()
+    for column in columns:
+        if column in frame.columns:
+            frame[column] = pd.to_numeric(frame[column], errors='coerce') / CENTS
+    return frame
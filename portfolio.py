@@ -0,0 +1,103 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from query_cache import cached_read_sql
+
+LADDER_FREQUENCIES = {'Weekly': 'W', 'Monthly': 'M'}
+
+
+def _dates(column):
+    # Dates are stored as 'YYYY-MM-DD' or full ISO timestamps
+    return pd.to_datetime(column.astype(str).str[:10], format='%Y-%m-%d', errors='coerce')
+
+
+def load_portfolio(conn, department_id=None):
+    """Confirmed investments with typed amount (int64 cents) and date columns."""
+    sql = """
+    SELECT i.ref_number, i.department_id, d.name AS department, i.account_name,
+           i.amount, i.interest_rate, i.period, i.value_date, i.maturity_date,
+           i.interest, i.withholding_tax, i.maturity_amount
+    FROM investments i
+    LEFT JOIN departments d ON i.department_id = d.id
+    WHERE i.status = 'confirmed'
+    """
+    params = ()
+    if department_id is not None:
+        sql += " AND i.department_id = ?"
+        params = (department_id,)
+    portfolio = cached_read_sql(sql, conn, ('investments', 'departments'), params=params)
+
+    for column in ('amount', 'interest', 'withholding_tax', 'maturity_amount'):
+        portfolio[column] = pd.to_numeric(portfolio[column], errors='coerce').fillna(0).astype(np.int64)
+    portfolio['interest_rate'] = pd.to_numeric(portfolio['interest_rate'], errors='coerce').fillna(0.0).astype(float)
+    portfolio['period'] = pd.to_numeric(portfolio['period'], errors='coerce').fillna(0).astype(int)
+    portfolio['value_date'] = _dates(portfolio['value_date'])
+    portfolio['maturity_date'] = _dates(portfolio['maturity_date'])
+    portfolio['department'] = portfolio['department'].fillna('Unallocated')
+    portfolio['account_name'] = portfolio['account_name'].fillna('')
+    return portfolio
+
+
+def value_portfolio(portfolio, as_of=None):
+    """Add accrued interest, days to maturity and after-tax yield as of ``as_of``.
+
+    Interest accrues on a simple actual/365 basis from the value date and
+    stops at maturity; withholding tax accrues at the deal's own rate.
+    Accrued amounts are rounded to whole cents.
+    """
+    as_of = pd.Timestamp(as_of or datetime.date.today())
+    amount = portfolio['amount'].to_numpy()
+    rate = portfolio['interest_rate'].to_numpy()
+    period = portfolio['period'].to_numpy()
+    interest = portfolio['interest'].to_numpy()
+    withholding = portfolio['withholding_tax'].to_numpy()
+
+    elapsed = (as_of - portfolio['value_date']).dt.days.fillna(0).to_numpy()
+    days_accrued = np.clip(elapsed, 0, period)
+    to_maturity = (portfolio['maturity_date'] - as_of).dt.days.to_numpy(dtype=float, na_value=np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        withholding_rate = np.where(interest > 0, withholding / interest, 0.0)
+        after_tax_yield = np.where((amount > 0) & (period > 0),
+                                   (interest - withholding) / amount * 365 / period * 100, 0.0)
+
+    accrued = amount * rate / 100 * days_accrued / 365
+    valued = portfolio.copy()
+    valued['days_to_maturity'] = to_maturity
+    valued['accrued_interest'] = np.rint(accrued).astype(np.int64)
+    valued['accrued_net_interest'] = np.rint(accrued * (1 - withholding_rate)).astype(np.int64)
+    valued['carrying_value'] = amount + valued['accrued_net_interest'].to_numpy()
+    valued['after_tax_yield'] = after_tax_yield
+    return valued
+
+
+def portfolio_summary(valued, horizon_days=7):
+    """Headline figures for a valued portfolio; amounts in cents."""
+    amount = valued['amount'].to_numpy()
+    live = valued['days_to_maturity'].to_numpy() >= 0
+    total = amount[live].sum()
+    due_soon = live & (valued['days_to_maturity'].to_numpy() <= horizon_days)
+    return {
+        'count': int(live.sum()),
+        'principal': int(total),
+        'accrued_net_interest': int(valued['accrued_net_interest'].to_numpy()[live].sum()),
+        # Yield weighted by principal, so large placements dominate
+        'weighted_yield': float((valued['after_tax_yield'].to_numpy()[live] * amount[live]).sum() / total)
+        if total else 0.0,
+        'maturing_soon': int(valued['maturity_amount'].to_numpy()[due_soon].sum()),
+    }
+
+
+def maturity_ladder(valued, frequency='M', by=('department', 'account_name')):
+    """Principal and maturity amounts grouped by maturity week (``'W'``) or month (``'M'``)."""
+    live = valued[valued['days_to_maturity'] >= 0]
+    if live.empty:
+        return pd.DataFrame(columns=['bucket', *by, 'deals', 'principal', 'maturity_amount'])
+    bucket = live['maturity_date'].dt.to_period(frequency).dt.start_time
+    return (live.assign(bucket=bucket)
+            .groupby(['bucket', *by], sort=True)
+            .agg(deals=('amount', 'size'), principal=('amount', 'sum'),
+                 maturity_amount=('maturity_amount', 'sum'))
+            .reset_index())
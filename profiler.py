@@ -0,0 +1,272 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+
+import pandas as pd
+
+from slow_query import get_slow_query_log
+
+# Set TREASURY_PROFILE=0 to open plain connections and skip all timing
+ENABLED = os.environ.get('TREASURY_PROFILE', '1').lower() not in ('0', 'false', 'no', 'off')
+
+# Samples kept in memory; the oldest are dropped first
+BUFFER_SIZE = int(os.environ.get('TREASURY_PROFILE_BUFFER', 20_000))
+
+SQL_TEXT_LIMIT = 400
+
+PAGE_TOTAL = '(page total)'
+BACKGROUND = '(background)'
+
+_whitespace = re.compile(r'\s+')
+_placeholder_runs = re.compile(r'\?(\s*,\s*\?)+')
+
+
+# The app runs a few hundred distinct statements, so normalizing once each is enough
+@lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """Statement text as one line, with IN lists of any length folded to ``?, ...``."""
+    text = _placeholder_runs.sub('?, ...', _whitespace.sub(' ', sql).strip())
+    return text if len(text) <= SQL_TEXT_LIMIT else text[:SQL_TEXT_LIMIT] + '...'
+
+
+def params_shape(parameters, many=False):
+    """Describe bound parameters without their values, e.g. ``3 positional``."""
+    if many:
+        rows = parameters if isinstance(parameters, (list, tuple)) else None
+        if rows is None:
+            return 'many rows (iterator)'
+        return f"{len(rows):,} rows x {params_shape(rows[0]) if rows else 'none'}"
+    if not parameters:
+        return 'none'
+    if isinstance(parameters, dict):
+        return f"{len(parameters)} named"
+    return f"{len(parameters)} positional"
+
+
+@dataclass(slots=True)
+class Sample:
+    kind: str
+    page: str
+    name: str
+    duration: float
+    at: float
+    rows: int = None
+    params: str = None
+
+
+class Profiler:
+    """Bounded in-memory record of SQL statements and page sections.
+
+    Each script run sets the page its samples are filed under; statements
+    run outside a page (background writers, the scheduler) are filed under
+    ``(background)``. Aggregation works on a snapshot, so the buffer can keep
+    filling while the Performance page reads it.
+    """
+
+    def __init__(self, size=BUFFER_SIZE, enabled=ENABLED):
+        self.enabled = enabled
+        self._samples = deque(maxlen=size)
+        self._local = threading.local()
+
+    def __len__(self):
+        return len(self._samples)
+
+    @property
+    def capacity(self):
+        return self._samples.maxlen
+
+    def current_page(self):
+        return getattr(self._local, 'page', None) or BACKGROUND
+
+    def add(self, kind, name, duration, rows=None, params=None):
+        sample = Sample(kind, self.current_page(), name, duration, time.time(), rows, params)
+        # deque.append is atomic, so writers on other threads need no lock
+        self._samples.append(sample)
+        return sample
+
+    def set_page(self, name):
+        self._local.page = name
+
+    @contextmanager
+    def page(self, name):
+        """Time one script run; sections and statements inside are filed under its page."""
+        if not self.enabled:
+            yield
+            return
+        self._local.page = name
+        self._local.marked = None
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._end_mark()
+            self.add('section', PAGE_TOTAL, time.perf_counter() - started)
+            self._local.page = None
+
+    @contextmanager
+    def section(self, name):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add('section', name, time.perf_counter() - started)
+
+    def mark(self, name):
+        """Start a section that runs until the next mark or the end of the page."""
+        if not self.enabled:
+            return
+        self._end_mark()
+        self._local.marked = (name, time.perf_counter())
+
+    def _end_mark(self):
+        marked = getattr(self._local, 'marked', None)
+        if marked is not None:
+            self._local.marked = None
+            self.add('section', marked[0], time.perf_counter() - marked[1])
+
+    def samples(self, window=None, kind=None, page=None):
+        """Buffered samples as a frame, optionally only the last ``window`` seconds."""
+        snapshot = list(self._samples)
+        frame = pd.DataFrame([(s.kind, s.page, s.name, s.duration, s.at, s.rows, s.params) for s in snapshot],
+                             columns=['kind', 'page', 'name', 'duration', 'at', 'rows', 'params'])
+        if window is not None:
+            frame = frame[frame['at'] >= time.time() - window]
+        if kind is not None:
+            frame = frame[frame['kind'] == kind]
+        if page is not None:
+            frame = frame[frame['page'] == page]
+        return frame
+
+    def summary(self, kind, window=None, page=None, limit=None):
+        """Per page and name: count, total, mean and p50/p95/p99/max in milliseconds, slowest p95 first."""
+        frame = self.samples(window, kind, page)
+        columns = ['page', 'name', 'count', 'total_ms', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'mean_rows']
+        if frame.empty:
+            return pd.DataFrame(columns=columns)
+        frame = frame.assign(ms=frame['duration'] * 1000)
+        grouped = frame.groupby(['page', 'name'], sort=False)
+        result = grouped['ms'].agg(count='count', total_ms='sum', mean_ms='mean', max_ms='max')
+        quantiles = grouped['ms'].quantile([0.5, 0.95, 0.99]).unstack()
+        quantiles.columns = ['p50_ms', 'p95_ms', 'p99_ms']
+        result = result.join(quantiles)
+        result['mean_rows'] = grouped['rows'].mean()
+        result = result.reset_index()[columns].sort_values(['p95_ms', 'total_ms'], ascending=False)
+        return result.head(limit) if limit else result
+
+    def clear(self):
+        self._samples.clear()
+
+
+_profiler = Profiler()
+
+
+def get_profiler():
+    return _profiler
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor that records each statement with its duration and row count.
+
+    Time spent fetching is added to the statement's sample, so a SELECT's
+    duration covers stepping through the rows it returned. A statement over
+    the slow query threshold is logged once, when it finishes executing or
+    when its last row has been fetched.
+    """
+    _sample = None
+    _pending = None
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters, params_shape(parameters))
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters, params_shape(seq_of_parameters, many=True))
+
+    def executescript(self, sql_script):
+        return self._timed(super().executescript, sql_script, None, 'script')
+
+    def _timed(self, method, sql, parameters, shape):
+        started = time.perf_counter()
+        try:
+            result = method(sql) if parameters is None else method(sql, parameters)
+        finally:
+            self._sample = _profiler.add('query', normalize_sql(sql), time.perf_counter() - started,
+                                         rows=self.rowcount if self.rowcount >= 0 else 0, params=shape)
+        self._pending = (sql, parameters, method.__name__ == 'executemany')
+        # Log now if there is nothing to fetch or it is already slow, else once fully fetched
+        if self.description is None or get_slow_query_log().is_slow(self._sample.duration):
+            self._log_if_slow()
+        return result
+
+    def _fetched(self, started, rows, done=False):
+        if self._sample is not None:
+            self._sample.duration += time.perf_counter() - started
+            self._sample.rows += rows
+            if done:
+                self._log_if_slow()
+
+    def _log_if_slow(self):
+        pending, sample, self._pending = self._pending, self._sample, None
+        log = get_slow_query_log()
+        if pending is not None and log.is_slow(sample.duration):
+            sql, parameters, many = pending
+            log.capture(self.connection, sql, parameters, sample.duration, rows=sample.rows,
+                        params=sample.params, page=sample.page, many=many)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None, done=row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(started, len(rows), done=len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows), done=True)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, 0, done=True)
+            raise
+        self._fetched(started, 1)
+        return row
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection whose cursors, including those behind ``execute``, are profiled."""
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+def connection_factory():
+    """The ``factory`` for ``sqlite3.connect``: profiled unless profiling is off."""
+    return ProfiledConnection if _profiler.enabled else sqlite3.Connection
@@ -0,0 +1,87 @@
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+# Generation bumped for changes that can touch any table (e.g. migrations)
+ALL_TABLES = '*'
+
+
+def bump_generation(c, *tables):
+    """Mark ``tables`` as written; call with the cursor of the writing transaction."""
+    c.executemany("""
+    INSERT INTO write_generations (table_name, generation) VALUES (?, 1)
+    ON CONFLICT (table_name) DO UPDATE SET generation = generation + 1
+    """, [(table,) for table in tables])
+
+
+def table_generations(conn, tables):
+    names = (ALL_TABLES,) + tuple(sorted(tables))
+    placeholders = ', '.join('?' for _ in names)
+    rows = dict(conn.execute(
+        f"SELECT table_name, generation FROM write_generations WHERE table_name IN ({placeholders})",
+        names).fetchall())
+    return tuple(rows.get(name, 0) for name in names)
+
+
+class QueryCache:
+    """LRU cache of ``pd.read_sql`` results shared by every session in the process.
+
+    Entries are keyed on the SQL text, its parameters and the current write
+    generation of every table the query reads, so a write to any of those
+    tables makes older entries unreachable; they then age out of the LRU.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read_sql(self, sql, conn, tables, params=()):
+        params = tuple(params)
+        key = (sql, params, tuple(sorted(tables)), table_generations(conn, tables))
+        with self._lock:
+            df = self._entries.get(key)
+            if df is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                # Callers may add columns to the result, so never hand out the cached frame
+                return df.copy()
+            self.misses += 1
+
+        df = pd.read_sql(sql, conn, params=params)
+        with self._lock:
+            self._entries[key] = df
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return df.copy()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+query_cache = QueryCache(int(os.environ.get('TREASURY_QUERY_CACHE_SIZE', 256)))
+
+
+def cached_read_sql(sql, conn, tables, params=()):
+    """``pd.read_sql`` through the shared cache; ``tables`` lists every table the query reads."""
+    return query_cache.read_sql(sql, conn, tables, params)
@@ -0,0 +1,156 @@
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from money import dollar_columns
+from tax_rules import load_rules, matcher_for_rules, reconcile_transactions
+
+PAIR_COLUMNS = ['statement_id', 'filename', 'upload_date', 'account_name']
+
+SUMMARY_COLUMNS = PAIR_COLUMNS + [
+    'transactions', 'discrepancies', 'tax_mismatches', 'invalid_rows',
+    'total_debit', 'total_credit', 'total_tax', 'total_tax_diff', 'elapsed',
+]
+
+# Cent columns, converted to dollars where results leave the app
+MONEY_SUMMARY_COLUMNS = ['total_debit', 'total_credit', 'total_tax', 'total_tax_diff']
+MONEY_REPORT_COLUMNS = ['debit', 'credit', 'actual_tax', 'expected_tax', 'tax_diff']
+
+
+def _date_filter(start_date, end_date, column='t.transaction_date'):
+    clauses, params = [], []
+    if start_date:
+        clauses.append(f"{column} >= ?")
+        params.append(str(start_date))
+    if end_date:
+        clauses.append(f"{column} <= ?")
+        params.append(str(end_date))
+    return clauses, params
+
+
+def list_pairs(conn, start_date=None, end_date=None, statement_ids=None):
+    """Every statement/account pair with transactions, optionally within a date range."""
+    clauses, params = _date_filter(start_date, end_date)
+    if statement_ids:
+        clauses.append(f"t.statement_id IN ({', '.join('?' for _ in statement_ids)})")
+        params.extend(statement_ids)
+    where = ("AND " + " AND ".join(clauses)) if clauses else ""
+    return pd.read_sql(f"""
+    SELECT DISTINCT t.statement_id, s.filename, s.upload_date, t.account_name
+    FROM transactions t
+    JOIN statements s ON s.id = t.statement_id
+    WHERE t.account_name IS NOT NULL {where}
+    ORDER BY s.upload_date, t.account_name
+    """, conn, params=params)
+
+
+def reconcile_pair(conn, statement_id, account_name, rules, start_date=None, end_date=None):
+    """Reconcile one statement/account; returns ``(stats, discrepancies)``."""
+    started = time.perf_counter()
+    clauses, params = _date_filter(start_date, end_date, column='transaction_date')
+    where = ("AND " + " AND ".join(clauses)) if clauses else ""
+    transactions = pd.read_sql(f"""
+    SELECT ref_number, transaction_date, narration, debit_amount, credit_amount,
+           tax_percentage, tax_amount, account_name
+    FROM transactions
+    WHERE statement_id = ? AND account_name = ? {where}
+    ORDER BY transaction_date DESC
+    """, conn, params=[statement_id, account_name] + params)
+
+    discrepancies = reconcile_transactions(transactions, matcher_for_rules(rules))
+    reasons = discrepancies['error_reason']
+    stats = {
+        'transactions': len(transactions),
+        'discrepancies': len(discrepancies),
+        'tax_mismatches': int(reasons.str.contains("Tax mismatch", regex=False).sum()),
+        # Anything beyond a lone tax mismatch is a structurally invalid row
+        'invalid_rows': int((reasons != "Tax mismatch").sum()),
+        'total_debit': int(transactions['debit_amount'].fillna(0).sum()),
+        'total_credit': int(transactions['credit_amount'].fillna(0).sum()),
+        'total_tax': int(transactions['tax_amount'].fillna(0).sum()),
+        'total_tax_diff': int(discrepancies['tax_diff'].sum()),
+        'elapsed': time.perf_counter() - started,
+    }
+    return stats, discrepancies
+
+
+def _reconcile_worker(db_path, statement_id, account_name, rules, start_date, end_date):
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return reconcile_pair(conn, statement_id, account_name, rules, start_date, end_date)
+    finally:
+        conn.close()
+
+
+def reconcile_batch(conn, db_path=None, start_date=None, end_date=None, statement_ids=None,
+                    workers=None):
+    """Reconcile every statement/account pair at once.
+
+    Pairs are spread over a process pool, each worker reading through its own
+    read-only connection to ``db_path``. With no ``db_path`` (e.g. an in-memory
+    database) or ``workers=1`` the pairs run in this process on ``conn``.
+    Returns ``(summary, report)``: one stats row per pair and the consolidated
+    discrepancy report, with amounts in cents.
+    """
+    pairs = list_pairs(conn, start_date, end_date, statement_ids)
+    rules = load_rules(conn)
+    keys = list(pairs.itertuples(index=False, name=None))
+
+    workers = workers or os.cpu_count() or 1
+    if db_path is None or workers == 1 or len(keys) <= 1:
+        results = [reconcile_pair(conn, key[0], key[3], rules, start_date, end_date) for key in keys]
+    else:
+        # spawn: the app process is multi-threaded, which makes fork unsafe
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(workers, len(keys)), mp_context=context) as pool:
+            futures = [pool.submit(_reconcile_worker, db_path, key[0], key[3], rules, start_date, end_date)
+                       for key in keys]
+            results = [future.result() for future in futures]
+
+    summary_rows, reports = [], []
+    for key, (stats, discrepancies) in zip(keys, results):
+        pair = dict(zip(PAIR_COLUMNS, key))
+        summary_rows.append({**pair, **stats})
+        if not discrepancies.empty:
+            reports.append(discrepancies.assign(**pair)[PAIR_COLUMNS + list(discrepancies.columns)])
+
+    summary = pd.DataFrame(summary_rows, columns=SUMMARY_COLUMNS)
+    report = pd.concat(reports, ignore_index=True) if reports else pd.DataFrame(columns=PAIR_COLUMNS)
+    return summary, report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile every statement/account pair in one run.")
+    parser.add_argument('--start', help="First transaction date (YYYY-MM-DD)")
+    parser.add_argument('--end', help="Last transaction date (YYYY-MM-DD)")
+    parser.add_argument('--statement', action='append', dest='statements', help="Limit to a statement id (repeatable)")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--report', default='reconciliation_report.csv', help="Consolidated discrepancy report")
+    parser.add_argument('--summary', default='reconciliation_summary.csv', help="Per-pair summary stats")
+    args = parser.parse_args(argv)
+
+    from database import ensure_schema, get_connection, shared_database_path
+
+    ensure_schema()
+    with get_connection() as conn:
+        summary, report = reconcile_batch(
+            conn, db_path=shared_database_path(),
+            start_date=args.start, end_date=args.end, statement_ids=args.statements,
+            workers=args.workers)
+
+    dollar_columns(summary, *MONEY_SUMMARY_COLUMNS).to_csv(args.summary, index=False)
+    dollar_columns(report, *MONEY_REPORT_COLUMNS).to_csv(args.report, index=False)
+    print(summary[['filename', 'account_name', 'transactions', 'discrepancies']].to_string(index=False))
+    print(f"{len(summary)} pairs, {int(summary['discrepancies'].sum())} discrepancies "
+          f"-> {args.report}, {args.summary}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
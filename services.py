@@ -0,0 +1,401 @@
+import datetime
+import hashlib
+import sqlite3
+import uuid
+from dataclasses import dataclass
+from datetime import timedelta
+
+from allocation import SPLIT_TOLERANCE, apply_allocations
+from ledger import BANK, DEPARTMENT, MAIN_ACCOUNT, UNALLOCATED, post_entry, post_main
+from money import RATE_SCALE, format_money, percent_of, round_div
+from query_cache import bump_generation, cached_read_sql
+from summary import record_department, record_investment_confirmed, record_transactions
+from tariff_store import save_tariff_guide
+from tax_rules import TAX_TOLERANCE, apply_tax_rules, load_matcher, reconcile_transactions
+
+# Withholding tax charged on investment interest, in percent
+WITHHOLDING_TAX_RATE = 20.0
+
+TAX_REPORT_COLUMNS = ['ref_number', 'transaction_date', 'narration', 'debit_amount', 'credit_amount',
+                      'tax_amount', 'expected_tax', 'tax_diff', 'tax_applied']
+
+
+class TreasuryError(ValueError):
+    """Raised when a treasury operation is rejected; the message is fit to show the user."""
+
+
+# Amounts taken and returned by this module are integer cents (see money.py)
+
+
+def _short_id():
+    return str(uuid.uuid4())[:8]
+
+
+def _now():
+    return datetime.datetime.now().isoformat()
+
+
+def hash_password(password):
+    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+
+def main_balance(c):
+    c.execute("SELECT balance FROM main_account LIMIT 1")
+    return c.fetchone()[0] or 0
+
+
+def _department(c, department_id):
+    c.execute("SELECT name, COALESCE(balance, 0) FROM departments WHERE id = ?", (department_id,))
+    row = c.fetchone()
+    if row is None:
+        raise TreasuryError(f"Unknown department: {department_id}")
+    return row[0], int(row[1])
+
+
+# Transactions
+
+@dataclass
+class PostedTransaction:
+    ref_number: str
+    transaction_type: str
+    amount: int
+    tax_amount: int
+    net_amount: int
+    new_balance: int
+
+
+def transaction_amounts(debit_amount, credit_amount, tax_percentage):
+    """Return ``(tax_amount, net_amount)``; tax is added to debits and withheld from credits."""
+    if debit_amount > 0:
+        return percent_of(debit_amount, tax_percentage), debit_amount
+    if credit_amount > 0:
+        tax_amount = percent_of(credit_amount, tax_percentage)
+        return tax_amount, credit_amount - tax_amount
+    return 0, 0
+
+
+def add_transaction(conn, transaction_date, narration, account_name, debit_amount=0, credit_amount=0,
+                    tax_percentage=0.0, investment=False, created_by='system'):
+    """Post a manual transaction against the main account and queue it for allocation.
+
+    Debits take the amount plus tax from the main account, credits add the
+    amount net of tax. Investment transactions also open a pending investment,
+    allocated later from the Investments page.
+    """
+    if debit_amount > 0 and credit_amount > 0:
+        raise TreasuryError("Cannot have both debit and credit amounts")
+    if debit_amount == 0 and credit_amount == 0:
+        raise TreasuryError("Must enter either debit or credit amount")
+
+    transaction_type = "Debit" if debit_amount > 0 else "Credit"
+    amount = debit_amount if debit_amount > 0 else credit_amount
+    tax_amount, net_amount = transaction_amounts(debit_amount, credit_amount, tax_percentage)
+    debit_type = ("Investment" if investment else "Other") if transaction_type == "Debit" else None
+    credit_type = ("Credit Investments" if investment else "Other") if transaction_type == "Credit" else None
+    # Debits leave the main account with their tax; credits arrive net of it
+    main_delta = -(debit_amount + tax_amount) if transaction_type == "Debit" else net_amount
+    allocation_amount = net_amount if transaction_type == "Credit" else debit_amount
+    ref_number = _short_id()
+    allocation_id = _short_id()
+
+    c = conn.cursor()
+    with conn:
+        c.execute("BEGIN IMMEDIATE")
+        if transaction_type == "Debit" and main_balance(c) < -main_delta:
+            raise TreasuryError(f"Insufficient Main Account balance for debit transaction "
+                                f"({format_money(-main_delta)} required).")
+        c.execute("""
+        INSERT INTO transactions (
+            id, ref_number, transaction_date, value_date, narration,
+            debit_amount, credit_amount, tax_percentage, tax_amount,
+            type, debit_type, credit_type, created_by, created_at, account_name
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            _short_id(), ref_number, str(transaction_date), str(transaction_date), narration,
+            debit_amount, credit_amount, tax_percentage, tax_amount,
+            transaction_type, debit_type, credit_type, created_by, _now(), account_name
+        ))
+        record_transactions(c, {account_name: 1})
+        c.execute("UPDATE main_account SET balance = balance + ?", (main_delta,))
+        post_main(c, main_delta, transaction_date, 'transaction', ref_number)
+
+        c.execute("""
+        INSERT INTO allocations (
+            id, treasury_ref, amount, created_by, created_at, transaction_type
+        ) VALUES (?, ?, ?, ?, ?, ?)
+        """, (allocation_id, ref_number, allocation_amount, created_by, _now(), transaction_type))
+        if investment:
+            c.execute("""
+            INSERT INTO investments (
+                ref_number, amount, created_by, created_at, status, transaction_ref, allocation_id
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (ref_number, allocation_amount, created_by, _now(), 'pending', ref_number, allocation_id))
+        bump_generation(c, 'transactions', 'allocations', 'investments', 'main_account')
+        new_balance = main_balance(c)
+
+    return PostedTransaction(ref_number, transaction_type, amount, tax_amount, net_amount, new_balance)
+
+
+# Allocations
+
+def _allocate_one(c, allocation_id, splits, created_by, source, source_ref):
+    result = apply_allocations(c, {allocation_id: splits}, created_by, SPLIT_TOLERANCE,
+                               source=source, source_ref=source_ref)
+    if allocation_id in result.failures:
+        raise TreasuryError(result.failures[allocation_id])
+    return result
+
+
+def allocate_pending(conn, allocation_id, splits, created_by='system', source_ref=None):
+    """Split one pending allocation across departments; ``splits`` maps department_id to amount."""
+    c = conn.cursor()
+    with conn:
+        c.execute("BEGIN IMMEDIATE")
+        return _allocate_one(c, allocation_id, splits, created_by, 'allocation', source_ref or allocation_id)
+
+
+def allocate_investment(conn, allocation_id, ref_number, splits, created_by='system'):
+    """Allocate a pending investment leg and assign the investment to its first department."""
+    department_id = next((department_id for department_id, value in splits.items() if value > 0), None)
+    c = conn.cursor()
+    with conn:
+        c.execute("BEGIN IMMEDIATE")
+        result = _allocate_one(c, allocation_id, splits, created_by, 'investment_allocation', ref_number)
+        c.execute("UPDATE investments SET department_id = ? WHERE ref_number = ?", (department_id, ref_number))
+        bump_generation(c, 'investments')
+    return result
+
+
+# Investments
+
+@dataclass
+class DealTerms:
+    amount: int
+    period: int
+    interest_rate: float
+    value_date: datetime.date
+    maturity_date: datetime.date
+    interest: int
+    withholding_tax: int
+
+    @property
+    def maturity_value(self):
+        return self.amount + self.interest
+
+    @property
+    def net_interest(self):
+        return self.interest - self.withholding_tax
+
+    @property
+    def tax_maturity_value(self):
+        return self.amount + self.net_interest
+
+    @property
+    def after_tax_yield(self):
+        if self.period > 0 and self.amount > 0:
+            return (self.net_interest / self.amount) * (365 / self.period) * 100
+        return 0.0
+
+
+def deal_terms(amount, interest_rate, period, value_date):
+    """Simple actual/365 interest and withholding tax for a fixed-term deal, in whole cents."""
+    if not isinstance(value_date, datetime.date):
+        value_date = datetime.date.fromisoformat(str(value_date)[:10])
+    rate = round(interest_rate * RATE_SCALE)
+    interest = round_div(amount * rate * period, 100 * RATE_SCALE * 365)
+    return DealTerms(amount, period, interest_rate, value_date, value_date + timedelta(days=period),
+                     interest, percent_of(interest, WITHHOLDING_TAX_RATE))
+
+
+def confirm_investment(conn, ref_number, account_name, period, interest_rate):
+    """Fix the terms of an allocated pending investment and mark it confirmed."""
+    c = conn.cursor()
+    with conn:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("""
+        SELECT i.amount, t.transaction_date, i.department_id
+        FROM investments i
+        JOIN transactions t ON i.ref_number = t.ref_number
+        WHERE i.ref_number = ? AND i.status = 'pending' AND i.department_id IS NOT NULL
+        """, (ref_number,))
+        row = c.fetchone()
+        if row is None:
+            raise TreasuryError(f"{ref_number} is not an allocated pending investment")
+        amount, value_date, department_id = row
+        terms = deal_terms(amount or 0, interest_rate, period, value_date)
+        c.execute("""
+        UPDATE investments
+        SET account_name = ?, period = ?, value_date = ?,
+            interest_rate = ?, maturity_date = ?, interest = ?,
+            withholding_tax = ?, maturity_amount = ?, status = 'confirmed'
+        WHERE ref_number = ?
+        """, (
+            account_name, period, terms.value_date.isoformat(),
+            interest_rate, terms.maturity_date.isoformat(), terms.interest,
+            terms.withholding_tax, terms.tax_maturity_value, ref_number
+        ))
+        record_investment_confirmed(c, department_id, terms.maturity_date)
+        bump_generation(c, 'investments')
+    return terms
+
+
+def submit_investment(conn, department_id, account_name, amount, period, value_date, interest_rate,
+                      tax_percentage=0.0, currency='USD', created_by='system'):
+    """Place a department investment: debit the main account and department, awaiting admin allocation.
+
+    Returns ``(ref_number, terms, tax_amount)``.
+    """
+    tax_amount = percent_of(amount, tax_percentage)
+    total_amount = amount + tax_amount
+    terms = deal_terms(amount, interest_rate, period, value_date)
+    ref_number = _short_id()
+    allocation_id = _short_id()
+
+    c = conn.cursor()
+    with conn:
+        c.execute("BEGIN IMMEDIATE")
+        if main_balance(c) < total_amount:
+            raise TreasuryError(f"Insufficient Main Account balance for investment "
+                                f"({format_money(total_amount)} required).")
+        department_name, department_balance = _department(c, department_id)
+        if department_balance < amount:
+            raise TreasuryError(f"Insufficient balance in {department_name} for investment "
+                                f"({format_money(amount)} required).")
+
+        c.execute("""
+        INSERT INTO investments (
+            ref_number, transaction_ref, account_name, currency, period,
+            amount, value_date, interest_rate, maturity_date, interest,
+            withholding_tax, maturity_amount, created_by, created_at,
+            status, allocation_id, department_id
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            ref_number, ref_number, account_name, currency, period,
+            amount, terms.value_date.isoformat(), interest_rate, terms.maturity_date.isoformat(),
+            terms.interest, terms.withholding_tax, terms.tax_maturity_value,
+            created_by, _now(), 'pending', allocation_id, department_id
+        ))
+        # Pending allocation with no department until an admin allocates it
+        c.execute("""
+        INSERT INTO allocations (
+            id, treasury_ref, amount, created_by, created_at, transaction_type
+        ) VALUES (?, ?, ?, ?, ?, ?)
+        """, (allocation_id, ref_number, amount, created_by, _now(), 'Debit'))
+
+        c.execute("UPDATE main_account SET balance = balance - ?", (total_amount,))
+        c.execute("UPDATE departments SET balance = balance - ? WHERE id = ?", (amount, department_id))
+        post_entry(c, terms.value_date, 'investment', ref_number, [
+            (MAIN_ACCOUNT, -total_amount), (BANK, total_amount),
+            ((DEPARTMENT, str(department_id)), -amount), (UNALLOCATED, amount),
+        ])
+
+        # Transaction row for the audit trail
+        c.execute("""
+        INSERT INTO transactions (
+            id, ref_number, transaction_date, value_date, narration,
+            debit_amount, credit_amount, tax_percentage, tax_amount,
+            type, debit_type, created_by, created_at, account_name
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            _short_id(), ref_number, terms.value_date.isoformat(), terms.value_date.isoformat(),
+            f"Investment: {account_name}", amount, 0, tax_percentage, tax_amount,
+            'Debit', 'Investment', created_by, _now(), account_name
+        ))
+        record_transactions(c, {account_name: 1})
+        bump_generation(c, 'investments', 'allocations', 'transactions', 'main_account', 'departments')
+    return ref_number, terms, tax_amount
+
+
+# Reconciliation and tax
+
+def reconcile_statement(conn, statement_id, account_name):
+    """Discrepancy report for one statement and account (empty when it reconciles)."""
+    transactions = cached_read_sql("""
+    SELECT ref_number, transaction_date, narration, debit_amount, credit_amount,
+           tax_percentage, tax_amount, account_name
+    FROM transactions
+    WHERE statement_id = ? AND account_name = ?
+    ORDER BY transaction_date DESC
+    """, conn, ('transactions',), params=(statement_id, account_name))
+    if transactions.empty:
+        return None
+    return reconcile_transactions(transactions, load_matcher(conn))
+
+
+def verify_statement_taxes(conn, statement_id, tolerance=TAX_TOLERANCE):
+    """Rows of a statement whose tax differs from the matching tax rule.
+
+    Rows with no matching rule and no tax percentage are not checked. Returns
+    None when the statement has no transactions.
+    """
+    transactions = cached_read_sql("""
+    SELECT ref_number, transaction_date, narration,
+           debit_amount, credit_amount, tax_percentage, tax_amount
+    FROM transactions
+    WHERE statement_id = ?
+    ORDER BY transaction_date DESC
+    """, conn, ('transactions',), params=(statement_id,))
+    if transactions.empty:
+        return None
+    apply_tax_rules(transactions, load_matcher(conn))
+    transactions.loc[transactions['tax_applied'] == '', 'tax_diff'] = 0
+    return transactions.loc[abs(transactions['tax_diff']) > tolerance, TAX_REPORT_COLUMNS]
+
+
+def add_tax(conn, description, rate, created_by='system'):
+    if not description.strip():
+        raise TreasuryError("Description required.")
+    c = conn.cursor()
+    with conn:
+        c.execute("""
+        INSERT INTO taxes_tariffs (
+            description, rate, created_by, created_at
+        ) VALUES (?, ?, ?, ?)
+        """, (description, rate, created_by, _now()))
+        bump_generation(c, 'taxes_tariffs')
+
+
+def upload_tariff(conn, bank_name, document_name, data, created_by='system'):
+    if not bank_name or not data:
+        raise TreasuryError("Provide bank name and file.")
+    c = conn.cursor()
+    with conn:
+        save_tariff_guide(c, bank_name, document_name, data, created_by, _now())
+        bump_generation(c, 'bank_tariff_guides')
+
+
+# Departments and users
+
+def add_department(conn, name, created_by='system'):
+    if not name.strip():
+        raise TreasuryError("Name required.")
+    department_id = _short_id()
+    c = conn.cursor()
+    try:
+        with conn:
+            c.execute("""
+            INSERT INTO departments (
+                id, name, balance, created_by, created_at
+            ) VALUES (?, ?, ?, ?, ?)
+            """, (department_id, name, 0, created_by, _now()))
+            record_department(c)
+            bump_generation(c, 'departments')
+    except sqlite3.IntegrityError as e:
+        raise TreasuryError(f"Error: {str(e)}") from e
+    return department_id
+
+
+def add_user(conn, username, password, role, department_id, created_by='system'):
+    if not username.strip() or not password.strip():
+        raise TreasuryError("Username and password required.")
+    c = conn.cursor()
+    try:
+        with conn:
+            c.execute("""
+            INSERT INTO users (
+                username, password, role, department_id, created_by, created_at
+            ) VALUES (?, ?, ?, ?, ?, ?)
+            """, (username, hash_password(password), role, department_id, created_by, _now()))
+            bump_generation(c, 'users')
+    except sqlite3.IntegrityError as e:
+        raise TreasuryError(f"Error: {str(e)}") from e
@@ -0,0 +1,398 @@
+import argparse
+import datetime
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+import pandas as pd
+
+# Statements slower than this (execute plus fetch) are logged; 0 turns the log off
+SLOW_QUERY_MS = float(os.environ.get('TREASURY_SLOW_QUERY_MS', 250))
+SLOW_QUERY_LOG = os.environ.get('TREASURY_SLOW_QUERY_LOG', 'slow_queries.jsonl')
+
+# Scans of tables up to this many rows are cheap and not reported
+SMALL_TABLE_ROWS = 1000
+# Wider suggestions are not made covering; the index would cost more than it saves
+MAX_INDEX_COLUMNS = 6
+
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+REPORT_COLUMNS = ['sql', 'count', 'max_ms', 'median_ms', 'last_seen', 'pages', 'findings', 'suggestions']
+
+_KEYWORDS = {
+    'on', 'where', 'join', 'left', 'right', 'inner', 'outer', 'cross', 'natural', 'group', 'order', 'limit',
+    'using', 'set', 'values', 'select', 'union', 'having', 'as', 'and', 'or', 'not', 'null', 'is', 'in',
+    'by', 'desc', 'asc', 'case', 'when', 'then', 'else', 'end', 'distinct', 'from', 'with', 'offset',
+}
+_string_literals = re.compile(r"'(?:[^']|'')*'")
+_table_refs = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+_column_refs = re.compile(r'\b(?:(\w+)\.)?(\w+)\b')
+_scan = re.compile(r'^SCAN (\w+)( USING (?:COVERING )?INDEX (\w+))?')
+_loop = re.compile(r'^(?:SCAN|SEARCH) (\w+)')
+_temp_btree = re.compile(r'^USE TEMP B-TREE FOR (ORDER BY|GROUP BY|DISTINCT|RIGHT PART OF ORDER BY)')
+
+
+def _clause(sql, keyword, stop):
+    """Text of the last ``keyword`` clause up to ``stop`` or an unmatched ')'."""
+    start = sql.upper().rfind(keyword)
+    if start < 0:
+        return None, None
+    start += len(keyword)
+    end = re.search(stop, sql[start:], re.IGNORECASE)
+    end = start + end.start() if end else len(sql)
+    depth = 0
+    for i in range(start, end):
+        if sql[i] == '(':
+            depth += 1
+        elif sql[i] == ')':
+            if depth == 0:
+                return start, i
+            depth -= 1
+    return start, end
+
+
+def _in_or_group(text, position):
+    """Whether the predicate at ``position`` is one branch of an OR, which a composite index cannot serve."""
+    depth, start = 0, 0
+    for i in range(position - 1, -1, -1):
+        if text[i] == ')':
+            depth += 1
+        elif text[i] == '(':
+            if depth == 0:
+                start = i + 1
+                break
+            depth -= 1
+    depth, end = 0, len(text)
+    for i in range(position, len(text)):
+        if text[i] == '(':
+            depth += 1
+        elif text[i] == ')':
+            if depth == 0:
+                end = i
+                break
+            depth -= 1
+    # Drop nested groups; only an OR at this predicate's own level matters
+    group, flattened = None, text[start:end]
+    while flattened != group:
+        group, flattened = flattened, re.sub(r'\([^()]*\)', '', flattened)
+    return re.search(r'\bOR\b', group, re.IGNORECASE) is not None
+
+
+def table_aliases(sql, tables):
+    """``{name used in the statement: table}`` for the real tables a statement reads or writes."""
+    aliases = {}
+    for table, alias in _table_refs.findall(sql):
+        if table.lower() in tables:
+            aliases[table.lower()] = table.lower()
+            if alias and alias.lower() not in _KEYWORDS:
+                aliases[alias.lower()] = table.lower()
+    return aliases
+
+
+def column_roles(sql, table, aliases, columns):
+    """How a statement uses one table's columns.
+
+    Returns ``{'eq': [...], 'join': [...], 'range': [...], 'order': [...],
+    'group': [...], 'referenced': [...]}``, each in order of first
+    appearance; ``eq`` compares with a value, ``join`` with another column.
+    Bare column names count when the statement reads only this table.
+    """
+    text = _string_literals.sub("''", sql)
+    if re.match(r'\s*UPDATE\b', text, re.IGNORECASE):
+        # Assignments in SET are not predicates
+        text = re.sub(r'\bSET\b.*?(?=\bWHERE\b|$)', 'SET ', text, flags=re.IGNORECASE | re.DOTALL)
+    names = {name for name, target in aliases.items() if target == table}
+    bare = set(aliases.values()) == {table}
+    spans = {
+        'order': _clause(text, 'ORDER BY', r'\b(LIMIT|OFFSET)\b'),
+        'group': _clause(text, 'GROUP BY', r'\b(HAVING|ORDER|LIMIT|WINDOW)\b'),
+    }
+    roles = {'eq': [], 'join': [], 'range': [], 'order': [], 'group': [], 'referenced': []}
+
+    def add(role, column):
+        if column not in roles[role]:
+            roles[role].append(column)
+
+    for match in _column_refs.finditer(text):
+        qualifier, column = match.group(1), match.group(2).lower()
+        if column not in columns:
+            continue
+        if qualifier is None and not bare or qualifier is not None and qualifier.lower() not in names:
+            continue
+        add('referenced', column)
+        before, after = text[:match.start()].rstrip(), text[match.end():].lstrip()
+        either = _in_or_group(text, match.start())
+        if not either and re.match(r'(==?|IS\b|IN\s*\()', after, re.IGNORECASE):
+            value = re.match(r'(?:==?|IS|IN\s*\()\s*(\?|:\w+|\'|-?\d|NULL\b|NOT\b)', after, re.IGNORECASE)
+            add('eq' if value else 'join', column)
+        elif not either and re.search(r'[^<>!]=$', before):
+            value = re.search(r'(\?|:\w+|\'|\d|NULL)\s*==?$', before, re.IGNORECASE)
+            add('eq' if value else 'join', column)
+        elif not either and (re.match(r'(<=?|>=?|BETWEEN\b)', after, re.IGNORECASE)
+                             or re.search(r'(<|>|<=|>=)$', before)):
+            add('range', column)
+        for role, (start, end) in spans.items():
+            if start is not None and start <= match.start() < end:
+                add(role, column)
+    star = '|'.join(map(re.escape, names))
+    if re.search(rf'\bSELECT\s+(DISTINCT\s+)?\*|\b({star})\.\*', text, re.IGNORECASE):
+        # Every column is read, so no index can cover the statement
+        roles['referenced'] = list(columns)
+    return roles
+
+
+def _table_columns(c, table):
+    return [row[1].lower() for row in c.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _table_indexes(c, table):
+    """``{index name: [columns]}``, including the implicit unique indexes."""
+    names = [row[1] for row in c.execute(f"PRAGMA index_list({table})").fetchall()]
+    return {name: [info[2].lower() for info in c.execute(f"PRAGMA index_info({name})").fetchall() if info[2]]
+            for name in names}
+
+
+def _approximate_rows(c, table):
+    # MAX(rowid) reads one page, unlike COUNT(*)
+    return c.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {table}").fetchone()[0]
+
+
+def suggest_index(table, roles, sorted_by=None, outer=True):
+    """The index columns that would serve a statement's use of ``table``, and whether it covers it.
+
+    Equality columns come first (join columns too when ``table`` is an inner
+    loop of a join), then the sort columns when the index should replace a
+    temp B-tree, otherwise the first range column; the remaining referenced
+    columns are appended when that keeps the index narrow enough.
+    """
+    columns = list(roles['eq']) + ([] if outer else [c for c in roles['join'] if c not in roles['eq']])
+    tail = roles[sorted_by] if sorted_by else roles['range'][:1]
+    columns += [column for column in tail if column not in columns]
+    if not columns:
+        return None, False
+    rest = [column for column in roles['referenced'] if column not in columns]
+    covering = len(columns) + len(rest) <= MAX_INDEX_COLUMNS
+    if covering:
+        columns += rest
+    return columns, covering
+
+
+def _index_statement(table, columns):
+    name = f"idx_{table}_{'_'.join(columns[:3])}"
+    return f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+
+
+def advise(conn, sql, plan):
+    """Findings and index suggestions for a statement's query plan.
+
+    Flags full scans of tables larger than ``SMALL_TABLE_ROWS`` and temp
+    B-trees built to sort or group, and suggests the covering index that
+    would let SQLite search instead. Returns ``(findings, suggestions)``.
+    """
+    # A plain cursor, so the advisor's own catalog reads are not profiled
+    c = conn.cursor(sqlite3.Cursor)
+    tables = {row[0].lower() for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+    aliases = table_aliases(sql, tables)
+    findings, suggestions = [], []
+    roles_by_table = {}
+
+    def roles_for(table):
+        if table not in roles_by_table:
+            roles_by_table[table] = column_roles(sql, table, aliases, _table_columns(c, table))
+        return roles_by_table[table]
+
+    # The first table in the plan drives the join; the rest are looked up per row
+    loops = [aliases.get(match.group(1).lower()) for match in map(_loop.match, plan) if match]
+    outermost = next((table for table in loops if table), None)
+
+    def suggest(table, reason, sorted_by=None):
+        # Only the driving table's index order can remove a sort
+        outer = table == outermost or sorted_by is not None
+        columns, covering = suggest_index(table, roles_for(table), sorted_by, outer)
+        if columns is None:
+            findings.append(f"{reason}: no indexable filter on {table}, so an index cannot avoid reading it")
+            return
+        for name, existing in _table_indexes(c, table).items():
+            if existing[:len(columns)] == columns:
+                findings.append(f"{reason}: {name} already matches; run ANALYZE if the planner ignores it")
+                return
+        statement = _index_statement(table, columns)
+        if statement not in suggestions:
+            suggestions.append(statement)
+            if not covering:
+                findings.append(f"The index suggested for {table} is not covering; the statement reads too many columns")
+
+    for detail in plan:
+        scan = _scan.match(detail)
+        if scan and not scan.group(2):
+            table = aliases.get(scan.group(1).lower())
+            if table is None:
+                # A subquery, CTE or view; its own tables appear in their own plan rows
+                continue
+            rows = _approximate_rows(c, table)
+            if rows <= SMALL_TABLE_ROWS:
+                continue
+            findings.append(f"Full scan of {table} (~{rows:,} rows)")
+            suggest(table, f"Full scan of {table}")
+            continue
+        temp = _temp_btree.match(detail)
+        if temp:
+            role = 'group' if temp.group(1) == 'GROUP BY' else 'order'
+            findings.append(f"Temp B-tree for {temp.group(1)}")
+            if temp.group(1) == 'DISTINCT':
+                continue
+            owners = [table for table in set(aliases.values()) if roles_for(table)[role]]
+            if len(owners) != 1:
+                findings.append(f"{temp.group(1)} mixes columns of several tables; no single index can sort it")
+            elif owners[0] != outermost and not roles_for(owners[0])['eq']:
+                findings.append(f"{temp.group(1)} is on {owners[0]} but {outermost} drives the join; "
+                                f"an index on {owners[0]} cannot remove the sort")
+            else:
+                suggest(owners[0], f"Temp B-tree for {temp.group(1)}", sorted_by=role)
+    return findings, suggestions
+
+
+def explain(conn, sql, parameters=()):
+    """``EXPLAIN QUERY PLAN`` detail lines, run on an unprofiled cursor of ``conn``."""
+    cursor = conn.cursor(sqlite3.Cursor)
+    try:
+        return [row[3] for row in cursor.execute(f"EXPLAIN QUERY PLAN {sql}", parameters or ())]
+    finally:
+        cursor.close()
+
+
+def _first_parameters(parameters, many):
+    if not many:
+        return parameters
+    # executemany: explain with the first row when the rows can be indexed
+    return parameters[0] if isinstance(parameters, (list, tuple)) and parameters else None
+
+
+class SlowQueryLog:
+    """Appends statements slower than ``threshold_ms`` to a JSON-lines file.
+
+    Each entry carries the statement, its timing and parameter shape, the
+    page it ran on, its ``EXPLAIN QUERY PLAN`` and the advisor's findings at
+    the moment it was slow.
+    """
+
+    def __init__(self, path=SLOW_QUERY_LOG, threshold_ms=SLOW_QUERY_MS):
+        self.path = path
+        self.threshold_ms = threshold_ms
+        self.logged = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def is_slow(self, duration):
+        return self.threshold_ms > 0 and duration * 1000 >= self.threshold_ms
+
+    def capture(self, conn, sql, parameters, duration, rows=None, params=None, page=None, many=False):
+        entry = {
+            'at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'page': page,
+            'duration_ms': round(duration * 1000, 2),
+            'rows': rows,
+            'params': params,
+            'sql': ' '.join(sql.split()),
+            'plan': None,
+            'findings': [],
+            'suggestions': [],
+        }
+        try:
+            if sql.lstrip().upper().startswith(EXPLAINABLE):
+                first = _first_parameters(parameters, many)
+                if first is not None:
+                    entry['plan'] = explain(conn, sql, first)
+                    entry['findings'], entry['suggestions'] = advise(conn, sql, entry['plan'])
+        except sqlite3.Error as e:
+            entry['findings'] = [f"Could not explain: {e}"]
+        try:
+            line = json.dumps(entry, default=str)
+            with self._lock:
+                with open(self.path, 'a', encoding='utf-8') as log:
+                    log.write(line + '\n')
+                self.logged += 1
+        except OSError as e:
+            # A full disk or read-only directory must not fail the query itself
+            self.last_error = e
+        return entry
+
+
+_log = SlowQueryLog()
+
+
+def get_slow_query_log():
+    return _log
+
+
+def read_log(path=None, since=None):
+    """Logged entries as a frame, optionally only those at or after ``since`` (ISO text)."""
+    path = path or _log.path
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=['at', 'page', 'duration_ms', 'rows', 'params', 'sql', 'plan',
+                                     'findings', 'suggestions'])
+    entries = pd.read_json(path, lines=True, dtype={'at': str})
+    if since is not None:
+        entries = entries[entries['at'] >= str(since)]
+    return entries
+
+
+def advisor_report(entries):
+    """One row per distinct statement, worst first, with its latest findings and suggestions."""
+    if entries.empty:
+        return pd.DataFrame(columns=REPORT_COLUMNS)
+    entries = entries.sort_values('at')
+    grouped = entries.groupby('sql', sort=False)
+    report = grouped.agg(count=('duration_ms', 'count'), max_ms=('duration_ms', 'max'),
+                         median_ms=('duration_ms', 'median'), last_seen=('at', 'last'))
+    report['pages'] = grouped['page'].agg(lambda pages: ', '.join(sorted({str(p) for p in pages if p})))
+    latest = grouped.tail(1).set_index('sql')
+    report['findings'] = latest['findings'].map('; '.join)
+    report['suggestions'] = latest['suggestions'].map('\n'.join)
+    return report.reset_index()[REPORT_COLUMNS].sort_values(['max_ms', 'count'], ascending=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Slow query log report and index advisor.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    report = commands.add_parser('report', help="Summarize the slow query log")
+    report.add_argument('--log', default=SLOW_QUERY_LOG)
+    report.add_argument('--since', help="Only entries at or after this date/time")
+    check = commands.add_parser('explain', help="Explain and advise on one statement now")
+    check.add_argument('sql')
+    check.add_argument('params', nargs='*', help="Values for the statement's ? placeholders")
+    args = parser.parse_args(argv)
+
+    if args.command == 'report':
+        summary = advisor_report(read_log(args.log, args.since))
+        if summary.empty:
+            print(f"No slow queries logged in {args.log}")
+            return 0
+        for row in summary.itertuples(index=False):
+            print(f"{row.count:,}x  max {row.max_ms:,.1f} ms  median {row.median_ms:,.1f} ms  "
+                  f"last {row.last_seen}  [{row.pages or 'background'}]")
+            print(f"  {row.sql}")
+            if row.findings:
+                print(f"  findings: {row.findings}")
+            for suggestion in filter(None, row.suggestions.split('\n')):
+                print(f"  suggest:  {suggestion}")
+            print()
+        return 0
+
+    from database import ensure_schema, get_connection
+
+    ensure_schema()
+    with get_connection() as conn:
+        plan = explain(conn, args.sql, args.params)
+        findings, suggestions = advise(conn, args.sql, plan)
+    print("\n".join(["Plan:"] + [f"  {detail}" for detail in plan]))
+    print("\n".join(["Findings:"] + [f"  {finding}" for finding in findings or ["none"]]))
+    print("\n".join(["Suggestions:"] + [f"  {suggestion}" for suggestion in suggestions or ["none"]]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import pandas as pd
+
+DASHBOARD_ACCOUNTS = ('CBZ Account One', 'CBZ Account Two', 'ZB Account One', 'ZB Account Two')
+
+
+# Write paths call the record_* helpers with the cursor of their own transaction,
+# so summary_state always agrees with the rows it counts.
+def bump(c, metric, amount=1, dimension='', bucket=''):
+    c.execute("""
+    INSERT INTO summary_state (metric, dimension, bucket, value) VALUES (?, ?, ?, ?)
+    ON CONFLICT (metric, dimension, bucket) DO UPDATE SET value = value + excluded.value
+    """, (metric, dimension, bucket, amount))
+
+
+def record_transactions(c, account_counts):
+    """Count new transactions; ``account_counts`` maps account_name to rows added."""
+    total = 0
+    for account_name, count in account_counts.items():
+        if count:
+            bump(c, 'account_transactions', count, dimension=account_name or '')
+            total += count
+    if total:
+        bump(c, 'transactions', total)
+
+
+def record_department(c):
+    bump(c, 'departments')
+
+
+def record_investment_confirmed(c, department_id, maturity_date):
+    """Count a confirmed investment under its department and maturity date."""
+    c.execute("SELECT name FROM departments WHERE id = ?", (department_id,))
+    row = c.fetchone()
+    if row:
+        bump(c, 'active_investments', dimension=row[0], bucket=str(maturity_date)[:10])
+
+
+def record_investment_matured(c, department_id, maturity_date):
+    """Remove a settled investment from the active count it was recorded under."""
+    c.execute("SELECT name FROM departments WHERE id = ?", (department_id,))
+    row = c.fetchone()
+    if row:
+        bump(c, 'active_investments', -1, dimension=row[0], bucket=str(maturity_date)[:10])
+
+
+def _rebuild(c):
+    c.execute("DELETE FROM summary_state")
+    c.execute("""
+    INSERT INTO summary_state (metric, dimension, bucket, value)
+    SELECT 'transactions', '', '', COUNT(*) FROM transactions
+    """)
+    c.execute("""
+    INSERT INTO summary_state (metric, dimension, bucket, value)
+    SELECT 'departments', '', '', COUNT(*) FROM departments
+    """)
+    c.execute("""
+    INSERT INTO summary_state (metric, dimension, bucket, value)
+    SELECT 'account_transactions', COALESCE(account_name, ''), '', COUNT(*)
+    FROM transactions
+    GROUP BY COALESCE(account_name, '')
+    """)
+    c.execute("""
+    INSERT INTO summary_state (metric, dimension, bucket, value)
+    SELECT 'active_investments', d.name, substr(i.maturity_date, 1, 10), COUNT(i.id)
+    FROM investments i
+    JOIN departments d ON i.department_id = d.id
+    WHERE i.status = 'confirmed' AND i.maturity_date IS NOT NULL
+    GROUP BY d.name, substr(i.maturity_date, 1, 10)
+    """)
+
+
+def rebuild_summary(conn):
+    """Recompute summary_state from the base tables in one transaction.
+
+    Also available from the command line: ``python summary.py``.
+    """
+    with conn:
+        _rebuild(conn.cursor())
+
+
+def load_dashboard_summary(conn):
+    """Read every dashboard aggregate from summary_state."""
+    c = conn.cursor()
+    c.execute("""
+    SELECT metric, value FROM summary_state
+    WHERE metric IN ('transactions', 'departments') AND dimension = '' AND bucket = ''
+    """)
+    counters = dict(c.fetchall())
+
+    placeholders = ', '.join('?' for _ in DASHBOARD_ACCOUNTS)
+    account_dist = pd.read_sql(f"""
+    SELECT dimension AS account_name, value AS count
+    FROM summary_state
+    WHERE metric = 'account_transactions' AND dimension IN ({placeholders}) AND value > 0
+    """, conn, params=DASHBOARD_ACCOUNTS)
+
+    # Buckets are maturity dates, so expired deals drop out without a rewrite
+    active_investments = pd.read_sql("""
+    SELECT dimension AS department, SUM(value) AS count
+    FROM summary_state
+    WHERE metric = 'active_investments' AND bucket >= date('now')
+    GROUP BY dimension
+    HAVING SUM(value) > 0
+    """, conn)
+
+    return {
+        'transaction_count': counters.get('transactions', 0),
+        'department_count': counters.get('departments', 0),
+        'account_dist': account_dist,
+        'active_investments': active_investments,
+    }
+
+
+if __name__ == "__main__":
+    from database import ensure_schema, get_connection
+
+    ensure_schema()
+    with get_connection() as conn:
+        rebuild_summary(conn)
+        print(load_dashboard_summary(conn))
@@ -0,0 +1,273 @@
+import argparse
+import datetime
+import os
+import sys
+import time
+from dataclasses import asdict, dataclass
+
+import numpy as np
+import pandas as pd
+
+from allocation import allocate_batch
+from auto_allocate import save_rule
+from ingest import REQUIRED_COLUMNS, post_statement, prepare_statement, validate_statement
+from ledger import MAIN_ACCOUNT, OPENING, post_entry
+from money import CENTS, to_cents
+from query_cache import bump_generation
+from services import (TreasuryError, add_department, add_tax, add_transaction, allocate_investment,
+                      confirm_investment)
+from summary import DASHBOARD_ACCOUNTS
+
+# (narration, side, weight); the first word or phrase is what tax rules match on
+NARRATIONS = [
+    ("Bank charges", 'Debit', 8),
+    ("Intermediated Money Transfer Tax", 'Debit', 6),
+    ("Salary payment", 'Debit', 10),
+    ("Supplier payment", 'Debit', 14),
+    ("Utilities", 'Debit', 4),
+    ("Fuel purchase", 'Debit', 5),
+    ("Customer receipt", 'Credit', 30),
+    ("Interest received", 'Credit', 5),
+    ("Transfer in", 'Credit', 20),
+    ("VAT refund", 'Credit', 2),
+]
+
+TAX_RULES = [("Bank charges", 15.0), ("Money Transfer Tax", 2.0), ("Interest received", 20.0)]
+
+INVESTMENT_TENURES = [30, 60, 91, 182, 365]
+
+# Rows per allocate_batch call while seeding allocations
+ALLOCATION_CHUNK = 50_000
+
+
+@dataclass
+class SyntheticScale:
+    """Size and shape of a generated dataset; equal scales and seeds give equal data."""
+    transactions: int = 100_000
+    statements: int = 50
+    departments: int = 8
+    investments: int = 200
+    allocated_share: float = 0.6
+    discrepancy_rate: float = 0.01
+    days: int = 365
+    seed: int = 42
+    end_date: str = None
+
+    @property
+    def end(self):
+        return datetime.date.fromisoformat(self.end_date) if self.end_date else datetime.date.today()
+
+    @property
+    def start(self):
+        return self.end - datetime.timedelta(days=self.days - 1)
+
+
+def _statement_rows(scale):
+    """Rows per statement, spreading the remainder over the first statements."""
+    base, extra = divmod(scale.transactions, scale.statements)
+    return [base + (1 if i < extra else 0) for i in range(scale.statements)]
+
+
+def generate_statement(rng, rows, start, end, ref_offset, seed, discrepancy_rate=0.0):
+    """A statement frame in the upload CSV layout, dated between ``start`` and ``end``.
+
+    Taxes follow ``TAX_RULES`` except for ``discrepancy_rate`` of the rows,
+    whose tax amount is off by up to $50 so reconciliation has work to do.
+    """
+    weights = np.array([weight for _, _, weight in NARRATIONS], dtype=float)
+    kind = rng.choice(len(NARRATIONS), size=rows, p=weights / weights.sum())
+    narration = np.array([text for text, _, _ in NARRATIONS], dtype=object)[kind]
+    is_debit = np.array([side == 'Debit' for _, side, _ in NARRATIONS])[kind]
+    # Log-normal amounts: median about $1,100 with a long tail of large payments
+    amount = np.round(rng.lognormal(mean=7.0, sigma=1.2, size=rows), 2)
+
+    rates = dict(TAX_RULES)
+    rate = np.array([next((r for d, r in rates.items() if d.lower() in text.lower()), 0.0)
+                     for text, _, _ in NARRATIONS])[kind]
+    tax = np.round(amount * rate / 100, 2)
+    off = rng.random(rows) < discrepancy_rate
+    tax[off] += np.round(rng.uniform(1, 50, size=int(off.sum())), 2)
+
+    span = (end - start).days + 1
+    dates = np.sort(rng.integers(0, span, size=rows))
+    dates = (np.datetime64(start) + dates.astype('timedelta64[D]')).astype(str)
+    suffix = rng.integers(100_000, 999_999, size=rows).astype(str)
+    return pd.DataFrame({
+        'transaction_date': dates,
+        'value_date': dates,
+        'narration': pd.Series(narration).str.cat(suffix, sep=' ').to_numpy(),
+        'ref_number': [f"SYN{seed}-{ref_offset + i:09d}" for i in range(rows)],
+        'debit_amount': np.where(is_debit, amount, 0.0),
+        'credit_amount': np.where(is_debit, 0.0, amount),
+        'tax_percentage': rate,
+        'tax_amount': tax,
+    }, columns=REQUIRED_COLUMNS)
+
+
+def iter_statements(scale):
+    """Yield ``(account_name, filename, frame)`` per statement, oldest first."""
+    rng = np.random.default_rng(scale.seed)
+    window = max(scale.days // scale.statements, 1)
+    offset = 0
+    for i, rows in enumerate(_statement_rows(scale)):
+        start = min(scale.start + datetime.timedelta(days=i * window), scale.end)
+        end = scale.end if i == scale.statements - 1 else min(start + datetime.timedelta(days=window - 1), scale.end)
+        account_name = DASHBOARD_ACCOUNTS[i % len(DASHBOARD_ACCOUNTS)]
+        filename = f"{account_name.lower().replace(' ', '_')}_{end.isoformat()}.csv"
+        yield account_name, filename, generate_statement(rng, rows, start, end, offset, scale.seed,
+                                                         scale.discrepancy_rate)
+        offset += rows
+
+
+def write_statement_files(directory, scale):
+    """Write the generated statements as upload CSVs named for their account; returns the paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, (_, filename, frame) in enumerate(iter_statements(scale)):
+        # Several statements of one account can end on the same date
+        path = os.path.join(directory, filename.replace('.csv', f'_{i:04d}.csv'))
+        frame.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def seed_database(conn, scale, created_by='synthetic', progress=None):
+    """Fill an empty database through the app's own write paths.
+
+    Departments, tax rules and allocation rules first, then an opening main
+    account balance, every statement, a share of the pending allocations and
+    a set of allocated and confirmed investments. ``progress`` is called with
+    a short message per step. Returns the row counts and elapsed seconds.
+    """
+    started = time.perf_counter()
+    rng = np.random.default_rng(scale.seed + 1)
+    report = progress or (lambda message: None)
+    counts = {}
+
+    department_ids = [add_department(conn, f"Department {i + 1:02d}", created_by)
+                      for i in range(scale.departments)]
+    for description, rate in TAX_RULES:
+        add_tax(conn, description, rate, created_by)
+    save_rule(conn, "Payroll", {department_ids[0]: 100}, created_by, narration_pattern="Salary")
+    save_rule(conn, "Receipts", {department_id: 100 / len(department_ids) for department_id in department_ids},
+              created_by, narration_pattern="Customer receipt", priority=200)
+    counts['departments'] = len(department_ids)
+
+    # Enough opening cash that no statement is rejected for an overdrawn main account
+    opening = scale.transactions * 10_000 * CENTS
+    c = conn.cursor()
+    with conn:
+        c.execute("UPDATE main_account SET balance = COALESCE(balance, 0) + ?", (opening,))
+        post_entry(c, scale.start - datetime.timedelta(days=1), 'opening', 'synthetic',
+                   [(MAIN_ACCOUNT, opening), (OPENING, -opening)])
+        bump_generation(c, 'main_account')
+
+    rows = 0
+    for account_name, filename, frame in iter_statements(scale):
+        validate_statement(frame)
+        post_statement(conn, prepare_statement(frame), account_name, filename, created_by)
+        rows += len(frame)
+        report(f"posted {rows:,} of {scale.transactions:,} transactions")
+    counts['transactions'] = rows
+    counts['statements'] = scale.statements
+
+    # Credits first, so departments hold the balances their debits draw on
+    pending = pd.read_sql("""
+    SELECT id, amount, transaction_type FROM allocations
+    WHERE department_id IS NULL
+    ORDER BY transaction_type = 'Debit', rowid
+    """, conn)
+    chosen = pending[rng.random(len(pending)) < scale.allocated_share]
+    targets = rng.choice(department_ids, size=len(chosen))
+    allocated = 0
+    for start in range(0, len(chosen), ALLOCATION_CHUNK):
+        chunk = chosen.iloc[start:start + ALLOCATION_CHUNK]
+        splits = {allocation_id: {department_id: amount} for allocation_id, department_id, amount
+                  in zip(chunk['id'], targets[start:start + ALLOCATION_CHUNK], chunk['amount'])}
+        allocated += len(allocate_batch(conn, splits, created_by).allocated)
+        report(f"allocated {allocated:,} of {len(chosen):,} selected allocations")
+    counts['allocated'] = allocated
+
+    confirmed = 0
+    for i in range(scale.investments):
+        value_date = scale.start + datetime.timedelta(days=int(rng.integers(0, scale.days)))
+        department_id = department_ids[i % len(department_ids)]
+        balance = c.execute("SELECT COALESCE(balance, 0) FROM departments WHERE id = ?",
+                            (department_id,)).fetchone()[0]
+        # Place a slice of what the department holds, as a treasurer would
+        amount = to_cents(min(rng.uniform(5_000, 250_000), balance / CENTS * rng.uniform(0.05, 0.25)))
+        if amount < 100 * CENTS:
+            continue
+        try:
+            posted = add_transaction(conn, value_date, f"Placement {i + 1}", DASHBOARD_ACCOUNTS[i % 4],
+                                     debit_amount=amount, investment=True, created_by=created_by)
+            allocation_id = c.execute("SELECT id FROM allocations WHERE treasury_ref = ? AND department_id IS NULL",
+                                      (posted.ref_number,)).fetchone()[0]
+            allocate_investment(conn, allocation_id, posted.ref_number, {department_id: amount}, created_by)
+        except TreasuryError:
+            # The department could not cover it; the deal stays pending
+            continue
+        confirm_investment(conn, posted.ref_number, DASHBOARD_ACCOUNTS[i % 4],
+                           int(rng.choice(INVESTMENT_TENURES)), float(np.round(rng.uniform(4, 15), 2)))
+        confirmed += 1
+    counts['investments'] = confirmed
+    report(f"confirmed {confirmed:,} of {scale.investments:,} investments")
+
+    counts['elapsed'] = time.perf_counter() - started
+    return counts
+
+
+def add_scale_arguments(parser):
+    defaults = SyntheticScale()
+    parser.add_argument('--transactions', type=int, default=defaults.transactions)
+    parser.add_argument('--statements', type=int, default=defaults.statements)
+    parser.add_argument('--departments', type=int, default=defaults.departments)
+    parser.add_argument('--investments', type=int, default=defaults.investments)
+    parser.add_argument('--allocated-share', type=float, default=defaults.allocated_share,
+                        help="Share of pending allocations to allocate (0-1)")
+    parser.add_argument('--discrepancy-rate', type=float, default=defaults.discrepancy_rate,
+                        help="Share of rows with a wrong tax amount (0-1)")
+    parser.add_argument('--days', type=int, default=defaults.days, help="Days of history")
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--end-date', help="Last transaction date (default: today)")
+
+
+def scale_from_args(args):
+    return SyntheticScale(
+        transactions=args.transactions, statements=args.statements, departments=args.departments,
+        investments=args.investments, allocated_share=args.allocated_share,
+        discrepancy_rate=args.discrepancy_rate, days=args.days, seed=args.seed, end_date=args.end_date)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a seeded synthetic treasury dataset.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--db', help="New database file to create and fill")
+    target.add_argument('--csv-dir', help="Only write statement CSVs to this directory")
+    add_scale_arguments(parser)
+    args = parser.parse_args(argv)
+    scale = scale_from_args(args)
+
+    if args.csv_dir:
+        paths = write_statement_files(args.csv_dir, scale)
+        print(f"Wrote {len(paths)} statement file(s), {scale.transactions:,} rows, to {args.csv_dir}")
+        return 0
+
+    if os.path.exists(args.db):
+        print(f"{args.db} already exists; synthetic data must go into a new database", file=sys.stderr)
+        return 2
+
+    from database import configure, ensure_schema, get_connection
+
+    configure(path=args.db)
+    ensure_schema()
+    with get_connection() as conn:
+        counts = seed_database(conn, scale, progress=lambda message: print(message, flush=True))
+    print(f"Seeded {args.db} in {counts.pop('elapsed'):.1f}s: "
+          + ", ".join(f"{value:,} {name}" for name, value in counts.items()))
+    print(f"Scale: {asdict(scale)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
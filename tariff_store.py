@@ -0,0 +1,66 @@
+import hashlib
+import os
+import tempfile
+
+
+class TariffStore:
+    """Content-addressed file store for tariff guide documents.
+
+    A document lives at ``<root>/<sha256[:2]>/<sha256>``, so identical uploads
+    share one file and SQLite only keeps the hash and size.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    def put(self, data):
+        """Store ``data`` (bytes) and return ``(sha256, size_bytes)``."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write under a temp name so readers never see a partial document
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.upload-')
+            try:
+                with os.fdopen(fd, 'wb') as tmp:
+                    tmp.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return digest, len(data)
+
+    def open(self, digest):
+        return open(self.path_for(digest), 'rb')
+
+    def read(self, digest):
+        with self.open(digest) as f:
+            return f.read()
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = TariffStore(os.environ.get('TREASURY_TARIFF_STORE', 'tariff_store'))
+    return _store
+
+
+def save_tariff_guide(c, bank_name, document_name, data, created_by, uploaded_at):
+    """Store the document bytes and insert its metadata row; returns the row id."""
+    digest, size = get_store().put(data)
+    c.execute("""
+    INSERT INTO bank_tariff_guides (
+        bank_name, document_name, content_hash, size_bytes, upload_date, created_by, created_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (bank_name, document_name, digest, size, uploaded_at, created_by, uploaded_at))
+    return c.lastrowid
@@ -0,0 +1,134 @@
+import functools
+import importlib.util
+
+import numpy as np
+import pandas as pd
+
+from money import percent_of
+from query_cache import cached_read_sql
+
+# Arrow-backed strings run substring scans in C
+STRING_DTYPE = pd.StringDtype('pyarrow' if importlib.util.find_spec('pyarrow') else 'python')
+
+# Cents a bank's tax may differ from the rule before it is reported; banks
+# round half cents differently, amounts otherwise compare exactly
+TAX_TOLERANCE = 1
+
+
+class TaxRuleMatcher:
+    """Case-insensitive substring matcher over tax rule descriptions.
+
+    Rules keep their table order and the first rule whose description occurs
+    in a narration wins, as in the old nested loop. Narrations are lowercased
+    and de-duplicated once, then each rule is one vectorized substring scan
+    over the distinct narrations.
+    """
+
+    def __init__(self, descriptions, rates):
+        self.descriptions = np.array(list(descriptions), dtype=object)
+        self.rates = np.asarray(list(rates), dtype=float)
+        self._patterns = [str(d).lower() for d in self.descriptions]
+        # A trailing sentinel lets rule index -1 (no match) look up as 0% / ''
+        self._rate_lookup = np.append(self.rates, 0.0)
+        self._description_lookup = np.append(self.descriptions, '')
+
+    def match(self, narrations):
+        """Return the index of the first matching rule per narration (-1 if none)."""
+        narrations = pd.Series(narrations, dtype=object).fillna('').astype(str)
+        if not self._patterns or narrations.empty:
+            return np.full(len(narrations), -1, dtype=np.int64)
+        # Statements repeat the same narrations heavily; match each distinct one once
+        codes, uniques = pd.factorize(narrations.str.lower())
+        uniques = pd.Series(uniques, dtype=STRING_DTYPE)
+        first_rule = np.full(len(uniques), -1, dtype=np.int64)
+        # Scan in reverse so earlier rules overwrite later ones
+        for rule in range(len(self._patterns) - 1, -1, -1):
+            hits = uniques.str.contains(self._patterns[rule], regex=False).to_numpy(dtype=bool)
+            first_rule[hits] = rule
+        return first_rule[codes]
+
+    def rates_for(self, rules):
+        return self._rate_lookup[rules]
+
+    def descriptions_for(self, rules):
+        return self._description_lookup[rules]
+
+
+@functools.lru_cache(maxsize=8)
+def matcher_for_rules(rules):
+    """Compiled matcher for a tuple of ``(description, rate)`` pairs, memoised per rule set."""
+    return TaxRuleMatcher([d for d, _ in rules], [r for _, r in rules])
+
+
+def load_rules(conn):
+    tax_rates = cached_read_sql("SELECT description, rate FROM taxes_tariffs ORDER BY id",
+                                conn, ('taxes_tariffs',))
+    return tuple(zip(tax_rates['description'].astype(str), tax_rates['rate'].astype(float)))
+
+
+def load_matcher(conn):
+    return matcher_for_rules(load_rules(conn))
+
+
+def _cents(column):
+    return column.fillna(0).to_numpy(dtype=np.int64)
+
+
+def apply_tax_rules(transactions, matcher):
+    """Add ``expected_tax``, ``tax_diff`` and ``tax_applied`` columns in place.
+
+    A matching rule sets the expected tax from its rate; otherwise a positive
+    ``tax_percentage`` is used ("Transaction Tax"). Rows with neither get an
+    expected tax of 0 and an empty ``tax_applied``. Amounts are int64 cents.
+    """
+    debit = _cents(transactions['debit_amount'])
+    credit = _cents(transactions['credit_amount'])
+    tax_percentage = transactions['tax_percentage'].fillna(0.0).to_numpy(dtype=float)
+    amount = np.where(debit > 0, debit, credit)
+
+    rule = matcher.match(transactions['narration'])
+    matched = rule >= 0
+    has_percentage = tax_percentage > 0
+
+    rate = np.where(matched, matcher.rates_for(rule), np.where(has_percentage, tax_percentage, 0.0))
+    expected_tax = percent_of(amount, rate)
+    tax_applied = np.where(matched, matcher.descriptions_for(rule),
+                           np.where(has_percentage, 'Transaction Tax', ''))
+
+    transactions['expected_tax'] = expected_tax
+    transactions['tax_diff'] = _cents(transactions['tax_amount']) - expected_tax
+    transactions['tax_applied'] = tax_applied
+    return transactions
+
+
+def reconcile_transactions(transactions, matcher, tolerance=TAX_TOLERANCE):
+    """Return the discrepancy report for a statement/account's transactions."""
+    transactions = apply_tax_rules(transactions.copy(), matcher)
+    debit = _cents(transactions['debit_amount'])
+    credit = _cents(transactions['credit_amount'])
+    narration = transactions['narration'].fillna('').astype(str)
+
+    tax_mismatch = np.abs(transactions['tax_diff'].to_numpy()) > tolerance
+    both_amounts = (debit > 0) & (credit > 0)
+    no_amount = (debit == 0) & (credit == 0)
+    empty_narration = (narration.str.strip() == '').to_numpy()
+
+    flags = np.column_stack([tax_mismatch, both_amounts, no_amount, empty_narration])
+    labels = np.array(["Tax mismatch", "Both debit and credit amounts",
+                       "No debit or credit amount", "Empty narration"], dtype=object)
+    flagged = flags.any(axis=1)
+
+    report = transactions.loc[flagged]
+    return pd.DataFrame({
+        'ref': report['ref_number'].to_numpy(),
+        'date': report['transaction_date'].to_numpy(),
+        'narration': report['narration'].to_numpy(),
+        'debit': report['debit_amount'].to_numpy(),
+        'credit': report['credit_amount'].to_numpy(),
+        'actual_tax': report['tax_amount'].to_numpy(),
+        'expected_tax': report['expected_tax'].to_numpy(),
+        'tax_diff': report['tax_diff'].to_numpy(),
+        # Unmatched rows were always reported under the transaction's own tax
+        'tax_applied': np.where(report['tax_applied'] == '', 'Transaction Tax', report['tax_applied']),
+        'error_reason': ['; '.join(labels[row]) for row in flags[flagged]],
+    })